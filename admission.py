@@ -0,0 +1,132 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+import instrumentation
+
+# Сколько дорогих поисков в секунду разрешено одному пользователю (0 — без ограничения)
+# и сколько можно сделать подряд
+SEARCH_RATE = float(os.environ.get('SEARCH_RATE', '5'))
+SEARCH_BURST = int(os.environ.get('SEARCH_BURST', '10'))
+# Сколько поисков процесс выполняет одновременно и сколько ждут своей очереди. Ждущий поиск
+# занимает поток обработчиков, поэтому вместе они должны оставлять потоки дешёвым запросам
+SEARCH_MAX_ACTIVE = int(os.environ.get('SEARCH_MAX_ACTIVE', str(max(1, db.POOL_SIZE // 4))))
+SEARCH_MAX_QUEUED = int(os.environ.get('SEARCH_MAX_QUEUED', str(max(1, db.POOL_SIZE // 4))))
+# Сколько поиск может ждать в очереди (миллисекунды)
+SEARCH_QUEUE_TIMEOUT_MS = int(os.environ.get('SEARCH_QUEUE_TIMEOUT_MS', '1000'))
+# Сколько пользователей помнит ограничитель скорости; забытый начинает с полным запасом
+ADMISSION_USERS = 10000
+
+class TokenBuckets:
+    """Ограничение скорости по пользователям: запас до burst запросов, пополняется со скоростью rate"""
+
+    def __init__(self, rate=SEARCH_RATE, burst=SEARCH_BURST, max_users=ADMISSION_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        # id пользователя -> (токены, время последнего пересчёта)
+        self.buckets = OrderedDict()
+
+    def take(self, user_id):
+        """Забирает токен; возвращает None или через сколько секунд токен появится"""
+        if self.rate <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = None
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[user_id] = (tokens, now)
+            while len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def refund(self, user_id):
+        """Возвращает токен запроса, который так и не был выполнен"""
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is not None:
+                self.buckets[user_id] = (min(self.burst, bucket[0] + 1), bucket[1])
+
+class SearchAdmission:
+    """Допуск дорогих поисков: ведро токенов пользователя и общий лимит одновременных поисков.
+
+    Поиск сверх лимита ждёт в короткой очереди не дольше timeout_ms; если очередь полна
+    или срок вышел, он сразу отклоняется — клиент повторит его позже, а потоки процесса
+    остаются списку заметок и автосохранениям.
+    """
+
+    def __init__(self, max_active=SEARCH_MAX_ACTIVE, max_queued=SEARCH_MAX_QUEUED,
+                 timeout_ms=SEARCH_QUEUE_TIMEOUT_MS, buckets=None):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.timeout = timeout_ms / 1000
+        self.buckets = buckets or TokenBuckets()
+        self.condition = threading.Condition()
+        self.active = 0
+        self.queued = 0
+
+    def acquire(self, user_id):
+        """Занимает место для поиска; возвращает None или через сколько секунд повторить запрос.
+
+        Занятое место освобождает release.
+        """
+        wait = self.buckets.take(user_id)
+        if wait is not None:
+            instrumentation.SEARCH_REJECTED.inc(reason='rate')
+            return retry_after(wait)
+
+        with self.condition:
+            if self.active < self.max_active:
+                self.active += 1
+                instrumentation.SEARCH_ACTIVE.set(self.active)
+                return None
+            if self.queued >= self.max_queued:
+                reason = 'queue_full'
+            else:
+                reason = self._wait()
+                if reason is None:
+                    return None
+        self.buckets.refund(user_id)
+        instrumentation.SEARCH_REJECTED.inc(reason=reason)
+        return retry_after(self.timeout)
+
+    def _wait(self):
+        # Вызывается под self.condition
+        started = time.monotonic()
+        deadline = started + self.timeout
+        self.queued += 1
+        instrumentation.SEARCH_QUEUED.set(self.queued)
+        try:
+            while self.active >= self.max_active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return 'timeout'
+                self.condition.wait(remaining)
+            self.active += 1
+            instrumentation.SEARCH_ACTIVE.set(self.active)
+            return None
+        finally:
+            self.queued -= 1
+            instrumentation.SEARCH_QUEUED.set(self.queued)
+            instrumentation.SEARCH_QUEUE_SECONDS.observe(time.monotonic() - started)
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            instrumentation.SEARCH_ACTIVE.set(self.active)
+            self.condition.notify()
+
+def retry_after(seconds):
+    """Значение заголовка Retry-After: целое число секунд, не меньше одной"""
+    return max(1, math.ceil(seconds))
+
+search_admission = SearchAdmission()
@@ -1,102 +1,535 @@
-from flask import Flask, request, jsonify, redirect, session
+from flask import Blueprint, Flask, current_app, request, jsonify, redirect, session, stream_with_context
 from flask_cors import CORS
-import sqlite3
+import base64
 import datetime
+import hashlib
+import json
+import logging
+import zlib
 from functools import wraps
-from google.oauth2 import id_token
-from google.auth.transport import requests
 import os
-import requests as requests_lib
+import note_bodies
+import response_encoder
+import search_index
+from edit_distance import highlight_spans, rank_matches
+from search_cache import search_cache
+from search_executor import search_executor
+from admission import search_admission
+from autosave import autosave, writer as autosave_writer
+from note_cache import CACHED_FIELDS, note_cache
+from response_encoder import encoded_cache
+import db
+import instrumentation
+import schema
+from db import get_db, get_notes_db
 
 # Режим разработки
 DEBUG_MODE = os.environ.get('DEBUG_MODE', 'false').lower() == 'true'
 
-app = Flask(__name__)
-CORS(app, supports_credentials=True)
-app.secret_key = os.urandom(24)  # для сессий
+# Маршруты API; приложение с ними собирает create_app
+api = Blueprint('notes', __name__)
+
+logger = logging.getLogger('notes')
 
 # Конфигурация Google OAuth
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
-if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
-    raise ValueError("GOOGLE_CLIENT_ID и GOOGLE_CLIENT_SECRET должны быть установлены в переменных окружения")
 
 REDIRECT_URI = "https://notes.narkis.ru/api/auth/callback"
 BASE_URL = "https://notes.narkis.ru"
 
-def levenshtein_distance(s1, s2):
-    if len(s1) < len(s2):
-        return levenshtein_distance(s2, s1)
+def fuzzy_search(text, query, threshold=3):
+    """Выполняет нечеткий поиск подстрок в тексте"""
+    return rank_matches(text, query, threshold) is not None
 
-    if len(s2) == 0:
-        return len(s1)
+# Триграммный индекс не находит запросы короче трёх символов
+FTS_MIN_QUERY_LENGTH = 3
+# Сколько результатов поиска отдавать, если клиент не указал limit
+SEARCH_LIMIT = 50
 
-    previous_row = range(len(s2) + 1)
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1.lower() != c2.lower())
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
+def make_snippet(text, query, radius=40):
+    """Возвращает фрагмент текста вокруг первого вхождения запроса"""
+    pos = text.lower().find(query.lower())
+    if pos == -1:
+        return text[:radius * 2]
+    start = max(pos - radius, 0)
+    end = min(pos + len(query) + radius, len(text))
+    snippet = text[start:pos] + '<b>' + text[pos:pos + len(query)] + '</b>' + text[pos + len(query):end]
+    if start > 0:
+        snippet = '…' + snippet
+    if end < len(text):
+        snippet += '…'
+    return snippet
 
-    return previous_row[-1]
+def snippet_with_spans(text, spans, radius=40):
+    """Фрагмент текста вокруг первого совпадения и позиции совпадений внутри фрагмента"""
+    if not spans:
+        return text[:radius * 2], []
+    start = max(spans[0][0] - radius, 0)
+    end = min(spans[0][1] + radius, len(text))
+    prefix = '…' if start > 0 else ''
+    snippet = prefix + text[start:end] + ('…' if end < len(text) else '')
+    shift = len(prefix) - start
+    return snippet, [[first + shift, last + shift] for first, last in spans if first >= start and last <= end]
 
-def fuzzy_search(text, query, threshold=3):
-    """Выполняет нечеткий поиск подстрок в тексте"""
-    text = text.lower()
-    query = query.lower()
+def fts_phrase(query):
+    """Запрос целиком — одна фраза, чтобы искать подстроку, а не отдельные слова"""
+    return '"' + query.replace('"', '""') + '"'
+
+def candidate_filter(candidates):
+    """Условие, ограничивающее поиск заметками из результатов предыдущего запроса"""
+    if candidates is None:
+        return '', []
+    return ' AND n.id IN (SELECT value FROM json_each(?))', [json.dumps(list(candidates))]
+
+def match_ids(notes, limit):
+    """id всех найденных заметок, если лимит их не обрезал, иначе None"""
+    return {note['id'] for note in notes} if len(notes) < limit else None
+
+def load_found_notes(c, user_id, note_ids):
+    """Найденные заметки: id -> (id, заголовок, текст, created_at, updated_at, автор).
+
+    Тексты распаковываются только у этих заметок — для фрагментов.
+    """
+    c.execute('''
+        SELECT n.id, n.title, n.created_at, n.updated_at, u.username
+        FROM notes n
+        JOIN users u ON n.user_id = u.id
+        WHERE n.id IN (SELECT value FROM json_each(?)) AND n.user_id = ?
+    ''', (json.dumps(list(note_ids)), user_id))
+    rows = c.fetchall()
+    bodies = note_bodies.load_bodies(c, [row[0] for row in rows])
+    return {row[0]: (row[0], row[1], bodies.get(row[0], ''), row[2], row[3], row[4]) for row in rows}
+
+def strict_search_notes(conn, user_id, query, limit, candidates=None):
+    """Строгий поиск по полнотекстовому индексу нормализованных заметок с ранжированием BM25"""
+    c = conn.cursor()
+    condition, condition_params = candidate_filter(candidates)
+    normalized = search_index.normalize_fragment(query)
+    
+    if len(normalized) < FTS_MIN_QUERY_LENGTH:
+        # Короткий запрос индекс не обслуживает — проверяем нормализованные заметки
+        rows = search_index.fetch_note_terms(c, f'n.user_id = ?{condition} ORDER BY n.updated_at DESC',
+                                             [user_id] + condition_params)
+        found = [(row[0], normalized in row[2], None) for row in rows
+                 if normalized in row[1] or normalized in row[2]][:limit]
+    else:
+        c.execute(f'''
+            SELECT n.id, bm25(notes_fts)
+            FROM notes_fts
+            JOIN notes n ON n.id = notes_fts.rowid
+            WHERE notes_fts MATCH ? AND n.user_id = ?{condition}
+            ORDER BY bm25(notes_fts)
+            LIMIT ?
+        ''', [fts_phrase(normalized), user_id] + condition_params + [limit])
+        found = [(note_id, True, rank) for note_id, rank in c.fetchall()]
+        # В индексе нет заметок без нормализованной формы (базы до note_terms, правки
+        # в обход приложения) — их проверяем так же, как при коротком запросе
+        if len(found) < limit:
+            rows = search_index.fetch_note_terms(
+                c, f'n.user_id = ?{condition} AND NOT EXISTS (SELECT 1 FROM note_terms t WHERE t.note_id = n.id) '
+                   'ORDER BY n.updated_at DESC',
+                [user_id] + condition_params)
+            found += [(row[0], normalized in row[2], None) for row in rows
+                      if normalized in row[1] or normalized in row[2]][:limit - len(found)]
+    
+    rows = load_found_notes(c, user_id, [note_id for note_id, _, _ in found])
+    results = []
+    for note_id, in_content, rank in found:
+        row = rows.get(note_id)
+        if row is None:
+            continue
+        result = {
+            'id': row[0],
+            'title': row[1],
+            'created_at': row[3],
+            'updated_at': row[4],
+            'author': row[5],
+            'snippet': make_snippet(row[2] if in_content else row[1], query)
+        }
+        if rank is not None:
+            result['rank'] = rank
+        results.append(result)
+    return results
+
+def search_results(conn, user_id, ranked, query, threshold=3):
+    """Результаты нечеткого поиска без текста заметок: оценка, фрагмент и позиции совпадений"""
+    if not ranked:
+        return []
+    
+    rows = load_found_notes(conn.cursor(), user_id, [note_id for note_id, _ in ranked])
+    
+    results = []
+    for note_id, score in ranked:
+        row = rows.get(note_id)
+        if row is None:
+            continue
+        snippet, snippet_spans = snippet_with_spans(row[2], highlight_spans(row[2], query, threshold))
+        results.append({
+            'id': row[0],
+            'title': row[1],
+            'created_at': row[3],
+            'updated_at': row[4],
+            'author': row[5],
+            'score': score,
+            'snippet': snippet,
+            'highlights': {
+                'title': highlight_spans(row[1], query, threshold),
+                'snippet': snippet_spans
+            }
+        })
+    return results
+
+def fuzzy_search_notes(conn, user_id, query, limit, threshold=3, candidates=None):
+    """Нечеткий поиск: те же правила, что и в fuzzy_search, но по словарю пользователя.
+
+    Возвращает лучшие limit заметок и id всех подходящих заметок.
+    """
+    index = search_index.get_index(conn, user_id)
+    fields = index.score_notes(query, threshold, candidates)
+    condition, condition_params = candidate_filter(candidates)
     
-    # Сначала проверяем точное вхождение (регистронезависимое)
-    if query in text:
-        return True
-        
-    # Если точного вхождения нет, ищем подстроки с близким расстоянием Левенштейна
-    words = text.split()
-    query_words = query.split()
-    
-    for q_word in query_words:
-        found = False
-        for word in words:
-            if levenshtein_distance(word, q_word) <= threshold:
-                found = True
-                break
-        if not found:
-            return False
-    return True
-
-def init_db():
-    conn = sqlite3.connect('notes.db')
     c = conn.cursor()
+    normalized = search_index.normalize_fragment(query)
+    # Точное вхождение запроса находим по полнотекстовому индексу, отдельно в каждом поле
+    if len(normalized) >= FTS_MIN_QUERY_LENGTH:
+        for column, field in (('title', search_index.TITLE_FIELD), ('content', search_index.CONTENT_FIELD)):
+            c.execute(f'''
+                SELECT n.id
+                FROM notes_fts
+                JOIN notes n ON n.id = notes_fts.rowid
+                WHERE notes_fts MATCH ? AND n.user_id = ?{condition}
+            ''', [f'{column} : {fts_phrase(normalized)}', user_id] + condition_params)
+            fields.update(((row[0], field), 1.0) for row in c.fetchall())
+    elif normalized.split() == [normalized]:
+        for note_id, mask in index.substring_notes(normalized).items():
+            if candidates is None or note_id in candidates:
+                for field in (search_index.TITLE_FIELD, search_index.CONTENT_FIELD):
+                    if mask & field:
+                        fields[(note_id, field)] = 1.0
+    else:
+        # Короткий запрос с пробелами зависит от границ слов — проверяем нормализованные заметки
+        for note_id, title, content, _ in search_index.fetch_note_terms(c, f'n.user_id = ?{condition}',
+                                                                         [user_id] + condition_params):
+            if normalized in title:
+                fields[(note_id, search_index.TITLE_FIELD)] = 1.0
+            if normalized in content:
+                fields[(note_id, search_index.CONTENT_FIELD)] = 1.0
     
-    # Таблица пользователей
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users
-        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-         email TEXT UNIQUE NOT NULL,
-         username TEXT NOT NULL,
-         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-         last_login TIMESTAMP,
-         google_id TEXT UNIQUE)
-    ''')
-    
-    # Таблица заметок
+    ranked = search_index.rank_notes(fields, index.updated, limit)
+    return search_results(conn, user_id, ranked, query, threshold), {note_id for note_id, _ in fields}
+
+def parallel_search_notes(conn, user_id, version, query, limit, threshold=3):
+    """Нечеткий поиск в пуле процессов: лучшие limit заметок, id всех найденных и признак неполного результата"""
+    ranked, truncated = search_executor.search(conn, user_id, version, query, limit, threshold)
+    ids = {note_id for note_id, _ in ranked} if not truncated and len(ranked) < limit else None
+    return search_results(conn, user_id, ranked, query, threshold), ids, truncated
+
+# Поля, которые клиент может запросить через ?fields=. Текст заметки хранится отдельно,
+# в note_bodies, и подставляется после выборки (fill_content), поэтому в запросе на его месте NULL
+NOTE_FIELDS = {
+    'id': 'n.id',
+    'title': 'n.title',
+    'content': 'NULL',
+    'created_at': 'n.created_at',
+    'updated_at': 'n.updated_at',
+    'author': 'u.username',
+    # Начало текста хранится в notes; у заметок, ещё не перенесённых migrate_bodies.py, — в content
+    'preview': f'COALESCE(n.preview, substr(n.content, 1, {note_bodies.PREVIEW_LENGTH}))',
+    'version': 'n.version',
+}
+DEFAULT_NOTE_FIELDS = ('id', 'title', 'content', 'created_at', 'updated_at', 'author')
+MAX_PAGE_SIZE = 500
+
+def fill_content(c, notes, note_ids, fields, key='content'):
+    """Подставляет тексты заметок, если клиент их запросил: распаковываются только заметки ответа.
+
+    Заметки — словари или списки значений полей; key — ключ или индекс текста в них.
+    """
+    if 'content' not in fields:
+        return
+    bodies = note_bodies.load_bodies(c, note_ids)
+    for note, note_id in zip(notes, note_ids):
+        note[key] = bodies.get(note_id, '')
+
+def encode_cursor(updated_at, note_id):
+    """Курсор — позиция последней выданной заметки в порядке (updated_at DESC, id)"""
+    return base64.urlsafe_b64encode(json.dumps([updated_at, note_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        updated_at, note_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(updated_at, str) or not isinstance(note_id, int):
+        raise ValueError('Invalid cursor')
+    return updated_at, note_id
+
+# Каждая правка добавляет в SQL-выражение до двух звеньев, а глубина выражений в SQLite ограничена
+MAX_PATCH_OPS = 200
+
+def parse_text_ops(ops):
+    """Проверяет правки текста и возвращает их вместе с длиной затронутой части текста.
+
+    Правка — [позиция, сколько символов удалить, что вставить] относительно базовой
+    версии текста. Позиции считаются в символах Unicode, правки идут по возрастанию
+    и не пересекаются.
+    """
+    if not isinstance(ops, list) or len(ops) > MAX_PATCH_OPS:
+        raise ValueError(f'ops must be a list of at most {MAX_PATCH_OPS} operations')
+    
+    pos = 0
+    for op in ops:
+        if not isinstance(op, list) or len(op) != 3:
+            raise ValueError('Each operation must be [offset, delete, insert]')
+        offset, delete, insert = op
+        if (type(offset) is not int or type(delete) is not int or not isinstance(insert, str)
+                or offset < 0 or delete < 0):
+            raise ValueError('Each operation must be [offset, delete, insert]')
+        if offset < pos:
+            raise ValueError('Operations must be sorted and must not overlap')
+        pos = offset + delete
+    return ops, pos
+
+def apply_text_ops(text, ops):
+    """Применяет проверенные parse_text_ops правки к базовой версии текста"""
+    parts = []
+    pos = 0
+    for offset, delete, insert in ops:
+        # Неизменённый кусок базового текста перед правкой
+        parts.append(text[pos:offset])
+        parts.append(insert)
+        pos = offset + delete
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+def note_write_failure(conn, note_id, user_id, base_version):
+    """Объясняет, почему условный UPDATE заметки не изменил ни одной строки"""
+    c = conn.cursor()
+    c.execute('SELECT version FROM notes WHERE id = ? AND user_id = ?', (note_id, user_id))
+    note = c.fetchone()
+    
+    if not note:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if base_version is not None and note[0] != base_version:
+        return jsonify({'error': 'Version conflict', 'version': note[0]}), 409
+    return jsonify({'error': 'Operations are out of range'}), 400
+
+MAX_BATCH_OPERATIONS = 1000
+# По сколько строк NDJSON-потока выполняется в одной транзакции
+IMPORT_CHUNK_SIZE = 500
+
+def validate_operation(op):
+    """Возвращает текст ошибки для некорректной операции пакета или None"""
+    if not isinstance(op, dict):
+        return 'Operation must be a JSON object'
+    kind = op.get('op')
+    if kind not in ('create', 'update', 'delete'):
+        return 'op must be one of create, update, delete'
+    if kind != 'create' and type(op.get('id')) is not int:
+        return 'id is required'
+    if kind != 'delete' and not (isinstance(op.get('title'), str) and isinstance(op.get('content'), str)):
+        return 'title and content are required'
+    if kind == 'update' and op.get('base_version') is not None and type(op['base_version']) is not int:
+        return 'base_version must be an integer'
+    return None
+
+def save_note_text(c, user_id, notes):
+    """Сохраняет текст заметок [(id, заголовок, текст)]: сжатое тело и нормализованную форму для поиска"""
+    note_bodies.save_bodies(c, user_id, [(note_id, content) for note_id, _, content in notes])
+    search_index.save_note_terms(c, notes)
+
+def apply_note_operations(conn, user_id, operations, writer=None):
+    """Выполняет операции над заметками в уже открытой транзакции.
+
+    Подряд идущие изменения и удаления отправляются одним executemany.
+    base_version изменений сверяется с учётом автосохранений сессии writer.
+    Возвращает результат для каждой операции в том же порядке.
+    """
+    c = conn.cursor()
+    results = [None] * len(operations)
+    now = datetime.datetime.now().isoformat()
+    
+    # Одним запросом узнаём, какие из упомянутых заметок принадлежат пользователю
+    ids = [op['id'] for op in operations if validate_operation(op) is None and op['op'] != 'create']
     c.execute('''
-        CREATE TABLE IF NOT EXISTS notes
-        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-         title TEXT NOT NULL,
-         content TEXT NOT NULL,
-         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-         user_id INTEGER,
-         FOREIGN KEY (user_id) REFERENCES users(id))
-    ''')
+        SELECT id, version FROM notes
+        WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))
+    ''', (user_id, json.dumps(ids)))
+    versions = dict(c.fetchall())
     
-    conn.commit()
-    conn.close()
+    pending = []
+    
+    def flush():
+        if not pending:
+            return
+        if pending[0][0] == 'update':
+            updates = [params for _, _, params in pending]
+            c.executemany('''
+                UPDATE notes SET title = ?, preview = ?, updated_at = ?
+                WHERE id = ? AND user_id = ?
+            ''', [(title, note_bodies.preview(content), updated_at, note_id, owner)
+                  for title, content, updated_at, note_id, owner in updates])
+            save_note_text(c, user_id, [(note_id, title, content) for title, content, _, note_id, _ in updates])
+        else:
+            c.executemany('DELETE FROM notes WHERE id = ? AND user_id = ?',
+                          [params for _, _, params in pending])
+        for _, index, params in pending:
+            results[index] = {'status': 200, 'id': params[-2]}
+        pending.clear()
+    
+    for index, op in enumerate(operations):
+        error = validate_operation(op)
+        if error:
+            results[index] = {'status': 400, 'error': error}
+            continue
+        
+        kind = op['op']
+        if kind == 'create':
+            # Новому id нужен lastrowid, поэтому создание идёт отдельными INSERT
+            flush()
+            c.execute('''
+                INSERT INTO notes (title, content, preview, user_id, created_at, updated_at)
+                VALUES (?, '', ?, ?, ?, ?)
+            ''', (op['title'], note_bodies.preview(op['content']), user_id, now, now))
+            results[index] = {'status': 201, 'id': c.lastrowid}
+            save_note_text(c, user_id, [(c.lastrowid, op['title'], op['content'])])
+            continue
+        
+        note_id = op['id']
+        if note_id not in versions:
+            results[index] = {'status': 401, 'id': note_id, 'error': 'Unauthorized'}
+            continue
+        
+        if kind == 'update':
+            base_version = autosave.resolve_version(note_id, op.get('base_version'), writer)
+            if base_version is not None and versions[note_id] != base_version:
+                results[index] = {'status': 409, 'id': note_id, 'error': 'Version conflict',
+                                  'version': versions[note_id]}
+                continue
+            # Точную новую версию узнаем только после записи
+            versions[note_id] = None
+            params = (op['title'], op['content'], now, note_id, user_id)
+        else:
+            del versions[note_id]
+            params = (note_id, user_id)
+        
+        if pending and pending[0][0] != kind:
+            flush()
+        pending.append((kind, index, params))
+    
+    flush()
+    return results
+
+def save_autosaved_notes(conn, user_id, notes):
+    """Записывает отложенные автосохранения пользователя {id: (заголовок, текст, базовая версия)}
+    в открытой транзакции и возвращает новые версии записанных заметок"""
+    results = apply_note_operations(conn, user_id, [
+        {'op': 'update', 'id': note_id, 'title': title, 'content': content, 'base_version': base_version}
+        for note_id, (title, content, base_version) in notes.items()
+    ])
+    c = conn.cursor()
+    # Удалённые и изменённые с другого устройства заметки не записываются и версии не получают
+    c.execute('''
+        SELECT id, version FROM notes
+        WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))
+    ''', (user_id, json.dumps([result['id'] for result in results if result['status'] == 200])))
+    return dict(c.fetchall())
+
+def queue_autosave(conn, note_id, user_id, base_version, title=None, content=None, ops=None):
+    """Откладывает автосохранение заметки. Правки ops применяются к версии этой же сессии
+    в очереди, а если её нет — к тексту из базы"""
+    writer = autosave_writer()
+    flushed = False
+    while True:
+        pending = autosave.get(note_id)
+        if pending is not None and pending.user_id == user_id and pending.writer != writer:
+            # В очереди правка другого устройства: сначала записываем её, а эту сверяем
+            # уже с базой — к чужому незаписанному тексту свои правки не применяются
+            if flushed:
+                return jsonify({'error': 'Version conflict', 'version': pending.version}), 409
+            autosave.flush(user_id)
+            flushed = True
+            continue
+        
+        if pending is not None and pending.user_id == user_id:
+            version = pending.version
+            current_title, current_content = pending.title, pending.content
+            base = base_version
+        else:
+            pending = None
+            c = conn.cursor()
+            c.execute('SELECT title, version FROM notes WHERE id = ? AND user_id = ?', (note_id, user_id))
+            row = c.fetchone()
+            if row is None:
+                return jsonify({'error': 'Unauthorized'}), 401
+            current_title, version = row
+            base = autosave.resolve_version(note_id, base_version, writer)
+            current_content = note_bodies.load_body(c, note_id) if content is None else None
+        
+        if base is not None and base != version:
+            return jsonify({'error': 'Version conflict', 'version': version}), 409
+        new_content = content
+        if new_content is None:
+            text_ops, end = ops
+            if len(current_content) < end:
+                return jsonify({'error': 'Operations are out of range'}), 400
+            new_content = apply_text_ops(current_content, text_ops)
+        
+        # Если очередь заметки изменилась, пока мы сверяли версию, сверяем заново
+        if autosave.put(user_id, note_id, current_title if title is None else title, new_content, version,
+                        writer, replaces=pending.seq if pending is not None else None):
+            return jsonify({'message': 'Note update queued', 'version': version}), 202
+
+EXPORT_PAGE_SIZE = 500
+EXPORT_FIELDS = ('id', 'title', 'content', 'created_at', 'updated_at', 'version')
+
+def iter_export_pages(conn, user_id, after=0):
+    """Отдаёт заметки пользователя страницами по возрастанию id, начиная после after.
+
+    Каждая страница — отдельный короткий запрос, поэтому память не растёт с объёмом
+    аккаунта, а долгий экспорт не держит открытой транзакцию чтения.
+    """
+    c = conn.cursor()
+    while True:
+        c.execute('''
+            SELECT id, title, NULL, created_at, updated_at, version
+            FROM notes
+            WHERE user_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (user_id, after, EXPORT_PAGE_SIZE))
+        rows = c.fetchall()
+        if not rows:
+            return
+        notes = [dict(zip(EXPORT_FIELDS, row)) for row in rows]
+        fill_content(c, notes, [row[0] for row in rows], EXPORT_FIELDS)
+        yield notes
+        after = rows[-1][0]
+
+def gzip_stream(chunks):
+    """Сжимает поток кусков в формат gzip на лету"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def parse_fields(fields, allowed=NOTE_FIELDS, default=DEFAULT_NOTE_FIELDS):
+    """Разбирает параметр ?fields= в список полей"""
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(default)
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    return fields
 
-init_db()
+def get_notes_version(conn, user_id):
+    """Текущее значение счётчика изменений заметок пользователя"""
+    c = conn.cursor()
+    c.execute('SELECT notes_version FROM note_versions WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
 
 def login_required(f):
     @wraps(f)
@@ -112,7 +545,7 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@app.route('/api/auth/check')
+@api.route('/api/auth/check')
 def check_auth():
     if DEBUG_MODE:
         return jsonify({
@@ -129,39 +562,69 @@ def check_auth():
         
     return jsonify({'authenticated': True})
 
-@app.route('/api/auth/login', methods=['GET'])
+@api.route('/api/auth/login', methods=['GET'])
 def login():
     # Редирект на страницу авторизации Google
     return redirect(f"https://accounts.google.com/o/oauth2/v2/auth?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={REDIRECT_URI}&scope=email profile")
 
-def get_google_user_info(code):
-    # Получаем токен доступа от Google
-    token_url = "https://oauth2.googleapis.com/token"
-    data = {
+GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v3/userinfo"
+
+def google_token_data(code):
+    """Параметры обмена кода авторизации на токен доступа"""
+    return {
         'code': code,
         'client_id': GOOGLE_CLIENT_ID,
         'client_secret': GOOGLE_CLIENT_SECRET,
         'redirect_uri': REDIRECT_URI,
         'grant_type': 'authorization_code'
     }
+
+def get_google_user_info(code):
+    # requests и google-auth нужны только для входа: загружаются при первом
+    import google_transport
     
-    response = requests_lib.post(token_url, data=data)
+    # Получаем токен доступа от Google
+    response = google_transport.post(GOOGLE_TOKEN_URL, data=google_token_data(code))
     if not response.ok:
         raise Exception('Failed to get token from Google')
     
     token_data = response.json()
     
     # Получаем информацию о пользователе
-    userinfo_url = "https://www.googleapis.com/oauth2/v3/userinfo"
     headers = {'Authorization': f'Bearer {token_data["access_token"]}'}
-    response = requests_lib.get(userinfo_url, headers=headers)
+    response = google_transport.get(GOOGLE_USERINFO_URL, headers=headers)
     
     if not response.ok:
         raise Exception('Failed to get user info from Google')
     
     return response.json()
 
-@app.route('/api/auth/callback')
+def login_google_user(conn, user_info):
+    """Находит или создаёт пользователя по данным Google и возвращает его id"""
+    c = conn.cursor()
+    
+    # Проверяем существование пользователя или создаем нового
+    c.execute('SELECT id FROM users WHERE email = ?', (user_info['email'],))
+    user = c.fetchone()
+    
+    if user is None:
+        username = user_info['email'].split('@')[0]
+        c.execute('''
+            INSERT INTO users (email, username, google_id, last_login)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (user_info['email'], username, user_info['sub']))
+        user_id = c.lastrowid
+        # Новые пользователи сразу получают свой шард; существующих переносит migrate_shards.py
+        c.execute('UPDATE users SET shard = ? WHERE id = ?', (db.home_shard(user_id), user_id))
+    else:
+        user_id = user[0]
+        c.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
+    
+    conn.commit()
+    return user_id
+
+@api.route('/api/auth/callback')
 def callback():
     try:
         code = request.args.get('code')
@@ -171,46 +634,34 @@ def callback():
         # Получаем информацию о пользователе
         user_info = get_google_user_info(code)
         
-        conn = sqlite3.connect('notes.db')
-        c = conn.cursor()
-        
-        # Проверяем существование пользователя или создаем нового
-        c.execute('SELECT id FROM users WHERE email = ?', (user_info['email'],))
-        user = c.fetchone()
-        
-        if user is None:
-            username = user_info['email'].split('@')[0]
-            c.execute('''
-                INSERT INTO users (email, username, google_id, last_login)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_info['email'], username, user_info['sub']))
-            user_id = c.lastrowid
-        else:
-            user_id = user[0]
-            c.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
-        
-        session['user_id'] = user_id
+        session['user_id'] = login_google_user(get_db(), user_info)
         return redirect('/')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/auth/logout')
+@api.route('/api/auth/logout')
 def logout():
     session.clear()
     return jsonify({'message': 'Logged out'})
 
-@app.route('/api/auth/user')
+@api.route('/api/auth/user')
 @login_required
 def get_user():
-    conn = sqlite3.connect('notes.db')
+    # Профиль активного пользователя лежит в кэше вместе с его заметками
+    entry = note_cache.get(session['user_id'])
+    if entry is not None:
+        return jsonify({
+            'id': entry.user_id,
+            'email': entry.email,
+            'username': entry.username,
+            'created_at': entry.created_at
+        })
+    
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, email, username, created_at FROM users WHERE id = ?', (session['user_id'],))
     user = c.fetchone()
-    conn.close()
     
     return jsonify({
         'id': user[0],
@@ -219,88 +670,325 @@ def get_user():
         'created_at': user[3]
     })
 
-@app.route('/api/notes', methods=['GET'])
+def notes_etag(version):
+    """ETag списка заметок: ответ меняется только с версией заметок или параметрами запроса"""
+    return hashlib.sha1(f"{session['user_id']}:{version}:{request.query_string.decode()}".encode()).hexdigest()
+
+def notes_page_response(body, next_cursor, version, content_encoding=None):
+    """Ответ со страницей списка заметок; body — готовый JSON, сжатый content_encoding"""
+    response = response_encoder.json_response(body, content_encoding)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    response.set_etag(notes_etag(version))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Sync-Token'] = str(version)
+    return response
+
+def send_notes_page(fields, rows, next_cursor, version, cache_key):
+    """Кодирует строки страницы, сжимает и запоминает готовое тело для этой версии заметок"""
+    data = response_encoder.encode_rows(fields, rows)
+    body, content_encoding = response_encoder.encode_body(data, cache_key[1])
+    encoded_cache.put(session['user_id'], version, cache_key, data, body, content_encoding, next_cursor)
+    return notes_page_response(body, next_cursor, version, content_encoding)
+
+@api.route('/api/notes', methods=['GET'])
 @login_required
 def get_notes():
-    conn = sqlite3.connect('notes.db')
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        if limit < 1:
+            return jsonify({'error': 'limit must be positive'}), 400
+        limit = min(limit, MAX_PAGE_SIZE)
+    
+    where = 'n.user_id = ?'
+    params = [session['user_id']]
+    
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            updated_at, last_id = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # Первое условие задаёт диапазон по индексу, второе отбрасывает уже выданные заметки
+        where += ' AND n.updated_at <= ? AND (n.updated_at < ? OR n.id > ?)'
+        params += [updated_at, updated_at, last_id]
+    
+    # Список без текстов у активного пользователя собирается из кэша, без запросов к базе
+    entry = note_cache.get(session['user_id']) if CACHED_FIELDS.issuperset(fields) else None
+    if entry is not None:
+        version = entry.version
+    else:
+        conn = get_notes_db(session['user_id'])
+        version = get_notes_version(conn, session['user_id'])
+    
+    # Пока заметки пользователя не менялись, ответ на тот же запрос тоже не меняется
+    etag = notes_etag(version)
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['X-Sync-Token'] = str(version)
+        return response
+    
+    # Большой список той же версии отдаётся готовыми байтами, без сборки и сжатия
+    cache_key = (request.query_string, response_encoder.accepted_encoding())
+    cached = encoded_cache.get(session['user_id'], version, cache_key)
+    if cached is not None:
+        body, content_encoding, next_cursor = cached
+        return notes_page_response(body, next_cursor, version, content_encoding)
+    
+    if entry is not None:
+        rows, next_cursor, version = note_cache.page(entry, fields, (updated_at, last_id) if cursor else None, limit)
+        return send_notes_page(fields, rows, next_cursor and encode_cursor(*next_cursor), version, cache_key)
+    
+    join = 'JOIN users u ON n.user_id = u.id' if 'author' in fields else ''
+    columns = ', '.join(NOTE_FIELDS[f] for f in fields)
+    params.append(limit + 1 if limit else -1)
+    
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT n.updated_at, n.id, {columns}
+        FROM notes n
+        {join}
+        WHERE {where}
+        ORDER BY n.updated_at DESC, n.id
+        LIMIT ?
+    ''', params)
+    rows = c.fetchall()
+    
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+    
+    notes = [row[2:] for row in rows]
+    if 'content' in fields:
+        notes = [list(note) for note in notes]
+        fill_content(c, notes, [row[1] for row in rows], fields, fields.index('content'))
+    return send_notes_page(fields, notes, next_cursor, version, cache_key)
+
+@api.route('/api/notes/changes', methods=['GET'])
+@login_required
+def get_note_changes():
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid sync token'}), 400
+    
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    
+    entry = note_cache.get(session['user_id']) if CACHED_FIELDS.issuperset(fields) else None
+    changes = note_cache.changes(entry, fields, since) if entry is not None else None
+    if changes is not None:
+        notes, deleted, version = changes
+        return jsonify({
+            'notes': notes,
+            'deleted': deleted,
+            'token': str(version)
+        })
+    
+    join = 'JOIN users u ON n.user_id = u.id' if 'author' in fields else ''
+    columns = ', '.join(NOTE_FIELDS[f] for f in fields)
+    
+    conn = get_notes_db(session['user_id'])
+    c = conn.cursor()
+    # Все чтения — из одного снимка базы, чтобы токен соответствовал выданным изменениям
+    c.execute('BEGIN')
+    try:
+        version = get_notes_version(conn, session['user_id'])
+        
+        if since is None:
+            # Без токена — полная выдача, удалённых заметок клиент ещё не видел
+            c.execute(f'''
+                SELECT {columns} FROM notes n {join}
+                WHERE n.user_id = ?
+                ORDER BY n.version
+            ''', (session['user_id'],))
+            notes = [dict(zip(fields, row)) for row in c.fetchall()]
+            fill_content(c, notes, [note['id'] for note in notes], fields)
+            deleted = []
+        else:
+            c.execute(f'''
+                SELECT {columns} FROM notes n {join}
+                WHERE n.user_id = ? AND n.version > ?
+                ORDER BY n.version
+            ''', (session['user_id'], since))
+            notes = [dict(zip(fields, row)) for row in c.fetchall()]
+            fill_content(c, notes, [note['id'] for note in notes], fields)
+            c.execute('''
+                SELECT note_id FROM note_tombstones
+                WHERE user_id = ? AND version > ?
+                ORDER BY version
+            ''', (session['user_id'], since))
+            deleted = [row[0] for row in c.fetchall()]
+    finally:
+        conn.commit()
+    
+    return jsonify({
+        'notes': notes,
+        'deleted': deleted,
+        'token': str(version)
+    })
+
+@api.route('/api/notes/<int:note_id>', methods=['GET'])
+@login_required
+def get_note(note_id):
+    conn = get_notes_db(session['user_id'])
     c = conn.cursor()
     c.execute('''
-        SELECT n.*, u.username 
-        FROM notes n 
-        JOIN users u ON n.user_id = u.id 
-        WHERE user_id = ? 
-        ORDER BY n.updated_at DESC
-    ''', (session['user_id'],))
-    
-    notes = [{
+        SELECT n.id, n.title, n.created_at, n.updated_at, u.username, n.version
+        FROM notes n
+        JOIN users u ON n.user_id = u.id
+        WHERE n.id = ? AND n.user_id = ?
+    ''', (note_id, session['user_id']))
+    row = c.fetchone()
+    
+    if not row:
+        return jsonify({'error': 'Note not found'}), 404
+    
+    return jsonify({
         'id': row[0],
         'title': row[1],
-        'content': row[2],
-        'created_at': row[3],
-        'updated_at': row[4],
-        'author': row[6]
-    } for row in c.fetchall()]
-    
-    conn.close()
-    return jsonify(notes)
+        'content': note_bodies.load_body(c, note_id),
+        'created_at': row[2],
+        'updated_at': row[3],
+        'author': row[4],
+        'version': row[5]
+    })
 
-@app.route('/api/notes', methods=['POST'])
+@api.route('/api/notes', methods=['POST'])
 @login_required
 def create_note():
     try:
         data = request.json
-        print(f"Creating note with data: {data}")
-        print(f"Current user_id in session: {session.get('user_id')}")
         
-        conn = sqlite3.connect('notes.db')
+        conn = get_notes_db(session['user_id'])
         c = conn.cursor()
         
         now = datetime.datetime.now().isoformat()
+        # Сам текст хранится сжатым в note_bodies, в notes — только его начало
         c.execute('''
-            INSERT INTO notes (title, content, user_id, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (data['title'], data['content'], session['user_id'], now, now))
+            INSERT INTO notes (title, content, preview, user_id, created_at, updated_at)
+            VALUES (?, '', ?, ?, ?, ?)
+        ''', (data['title'], note_bodies.preview(data['content']), session['user_id'], now, now))
         
         note_id = c.lastrowid
-        print(f"Created note with ID: {note_id}")
-        
+        save_note_text(c, session['user_id'], [(note_id, data['title'], data['content'])])
+        version = get_notes_version(conn, session['user_id'])
         conn.commit()
-        conn.close()
+        note_cache.write_note(session['user_id'], version, note_id, data['title'], now,
+                              note_bodies.preview(data['content']), created_at=now)
         
-        return jsonify({'id': note_id, 'message': 'Note created successfully'})
+        # Текст заметки в лог не пишем — только размеры
+        logger.info('note created', extra={
+            'user_id': session['user_id'],
+            'note_id': note_id,
+            'title_length': len(data['title']),
+            'content_length': len(data['content'])
+        })
+        return jsonify({'id': note_id, 'version': version, 'message': 'Note created successfully'})
     except Exception as e:
-        print(f"Error creating note: {str(e)}")
+        logger.exception('note creation failed', extra={'user_id': session.get('user_id')})
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/notes/<int:note_id>', methods=['PUT'])
+@api.route('/api/notes/<int:note_id>', methods=['PUT'])
 @login_required
 def update_note(note_id):
     data = request.json
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
+    conn = get_notes_db(session['user_id'])
+    # Автосохранение откладывается: из нескольких подряд записана будет только последняя версия
+    if request.args.get('autosave'):
+        return queue_autosave(conn, note_id, session['user_id'], data.get('base_version'),
+                              title=data['title'], content=data['content'])
     
-    # Проверяем, принадлежит ли заметка пользователю
-    c.execute('SELECT user_id FROM notes WHERE id = ?', (note_id,))
-    note = c.fetchone()
+    base_version = autosave.resolve_version(note_id, data.get('base_version'), autosave_writer())
+    c = conn.cursor()
     
-    if not note or note[0] != session['user_id']:
-        conn.close()
-        return jsonify({'error': 'Unauthorized'}), 401
+    # Принадлежность заметки пользователю (и версия, если клиент её прислал)
+    # проверяется условием самого UPDATE
+    now = datetime.datetime.now().isoformat()
+    where = 'id = ? AND user_id = ?'
+    params = [data['title'], note_bodies.preview(data['content']), now, note_id, session['user_id']]
+    if base_version is not None:
+        where += ' AND version = ?'
+        params.append(base_version)
     
-    c.execute('''
+    c.execute(f'''
         UPDATE notes 
-        SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP 
-        WHERE id = ? AND user_id = ?
-    ''', (data['title'], data['content'], note_id, session['user_id']))
+        SET title = ?, preview = ?, updated_at = ? 
+        WHERE {where}
+    ''', params)
+    
+    if c.rowcount == 0:
+        return note_write_failure(conn, note_id, session['user_id'], base_version)
     
+    save_note_text(c, session['user_id'], [(note_id, data['title'], data['content'])])
+    version = get_notes_version(conn, session['user_id'])
     conn.commit()
-    conn.close()
-    return jsonify({'message': 'Note updated successfully'})
+    note_cache.write_note(session['user_id'], version, note_id, data['title'], now, params[1])
+    return jsonify({'message': 'Note updated successfully', 'version': version})
 
-@app.route('/api/notes/<int:note_id>', methods=['DELETE'])
+@api.route('/api/notes/<int:note_id>', methods=['PATCH'])
+@login_required
+def patch_note(note_id):
+    data = request.json or {}
+    base_version = data.get('base_version')
+    title = data.get('title')
+    
+    if type(base_version) is not int:
+        return jsonify({'error': 'base_version is required'}), 400
+    if title is not None and not isinstance(title, str):
+        return jsonify({'error': 'title must be a string'}), 400
+    try:
+        ops, end = parse_text_ops(data.get('ops', []))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_notes_db(session['user_id'])
+    if request.args.get('autosave'):
+        return queue_autosave(conn, note_id, session['user_id'], base_version, title=title, ops=(ops, end))
+    
+    base_version = autosave.resolve_version(note_id, base_version, autosave_writer())
+    c = conn.cursor()
+    
+    # Текст хранится сжатым, поэтому правки применяются здесь, а не в SQL. Чтение и запись —
+    # в одной транзакции записи: между ними заметку никто не изменит
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('SELECT title FROM notes WHERE id = ? AND user_id = ? AND version = ?',
+              (note_id, session['user_id'], base_version))
+    row = c.fetchone()
+    content = note_bodies.load_body(c, note_id) if row else ''
+    if row is None or len(content) < end:
+        return note_write_failure(conn, note_id, session['user_id'], base_version)
+    
+    title = row[0] if title is None else title
+    content = apply_text_ops(content, ops)
+    preview = note_bodies.preview(content)
+    now = datetime.datetime.now().isoformat()
+    c.execute('UPDATE notes SET title = ?, preview = ?, updated_at = ? WHERE id = ?',
+              (title, preview, now, note_id))
+    save_note_text(c, session['user_id'], [(note_id, title, content)])
+    version = get_notes_version(conn, session['user_id'])
+    conn.commit()
+    note_cache.write_note(session['user_id'], version, note_id, title, now, preview)
+    return jsonify({'message': 'Note updated successfully', 'version': version})
+
+@api.route('/api/notes/<int:note_id>', methods=['DELETE'])
 @login_required
 def delete_note(note_id):
-    conn = sqlite3.connect('notes.db')
+    conn = get_notes_db(session['user_id'])
     c = conn.cursor()
     
     # Проверяем, принадлежит ли заметка пользователю
@@ -308,15 +996,129 @@ def delete_note(note_id):
     note = c.fetchone()
     
     if not note or note[0] != session['user_id']:
-        conn.close()
         return jsonify({'error': 'Unauthorized'}), 401
     
     c.execute('DELETE FROM notes WHERE id = ? AND user_id = ?', (note_id, session['user_id']))
+    version = get_notes_version(conn, session['user_id'])
     conn.commit()
-    conn.close()
+    note_cache.delete_note(session['user_id'], version, note_id)
     return jsonify({'message': 'Note deleted successfully'})
 
-@app.route('/api/notes/search', methods=['GET'])
+@api.route('/api/notes/export', methods=['GET'])
+@login_required
+def export_notes():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'json'):
+        return jsonify({'error': 'format must be ndjson or json'}), 400
+    compress = request.args.get('compress')
+    if compress not in (None, 'gzip'):
+        return jsonify({'error': 'compress must be gzip'}), 400
+    # Продолжение прерванного экспорта: заметки с id больше after
+    after = request.args.get('after', 0, type=int)
+    
+    user_id = session['user_id']
+    conn = get_notes_db(user_id)
+    
+    def generate():
+        if export_format == 'json':
+            yield '['
+        first = True
+        for page in iter_export_pages(conn, user_id, after):
+            if export_format == 'ndjson':
+                yield ''.join(json.dumps(note, ensure_ascii=False) + '\n' for note in page)
+            else:
+                chunk = ','.join(json.dumps(note, ensure_ascii=False) for note in page)
+                yield chunk if first else ',' + chunk
+            first = False
+        if export_format == 'json':
+            yield ']'
+    
+    mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'application/json'
+    filename = f'notes.{export_format}'
+    body = generate()
+    if compress == 'gzip':
+        body = gzip_stream(body)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+    
+    response = current_app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+@api.route('/api/notes/batch', methods=['POST'])
+@login_required
+def batch_notes():
+    user_id = session['user_id']
+    
+    writer = autosave_writer()
+    if request.mimetype == 'application/x-ndjson':
+        return stream_note_operations(user_id, writer)
+    
+    data = request.json
+    operations = data.get('operations') if isinstance(data, dict) else data
+    if not isinstance(operations, list):
+        return jsonify({'error': 'operations must be a list'}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per batch'}), 400
+    
+    conn = get_notes_db(session['user_id'])
+    # Весь пакет — одна транзакция и один коммит
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        results = apply_note_operations(conn, user_id, operations, writer)
+        version = get_notes_version(conn, user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    note_cache.sync(conn, user_id)
+    
+    return jsonify({'results': results, 'version': version})
+
+def stream_note_operations(user_id, writer):
+    """NDJSON-режим пакета: операции читаются из тела запроса построчно и выполняются
+    транзакциями по IMPORT_CHUNK_SIZE, результаты отдаются тоже построчно"""
+    conn = get_notes_db(user_id)
+    
+    def run(chunk):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            results = apply_note_operations(conn, user_id, chunk, writer)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        note_cache.sync(conn, user_id)
+        for result in results:
+            yield json.dumps(result) + '\n'
+    
+    def generate():
+        chunk = []
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                chunk.append(json.loads(line))
+            except ValueError:
+                chunk.append(None)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                yield from run(chunk)
+                chunk = []
+        if chunk:
+            yield from run(chunk)
+    
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@api.route('/api/notes/save', methods=['POST'])
+@login_required
+def save_notes():
+    # Явное сохранение: отложенные автосохранения пользователя записываются сразу
+    autosave.flush(session['user_id'])
+    conn = get_notes_db(session['user_id'])
+    return jsonify({'message': 'Notes saved', 'version': get_notes_version(conn, session['user_id'])})
+
+@api.route('/api/notes/search', methods=['GET'])
 @login_required
 def search_notes():
     query = request.args.get('q', '')
@@ -325,46 +1127,77 @@ def search_notes():
     if not query:
         return get_notes()
     
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('''
-        SELECT n.*, u.username 
-        FROM notes n 
-        JOIN users u ON n.user_id = u.id 
-        WHERE n.user_id = ? 
-        ORDER BY n.updated_at DESC
-    ''', (session['user_id'],))
-    all_notes = c.fetchall()
-    conn.close()
-
-    if strict_search:
-        notes = [
-            {
-                'id': row[0],
-                'title': row[1],
-                'content': row[2],
-                'created_at': row[3],
-                'updated_at': row[4],
-                'author': row[6]
-            }
-            for row in all_notes
-            if query.lower() in row[1].lower() or query.lower() in row[2].lower()
-        ]
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+    
+    user_id = session['user_id']
+    # Версия активного пользователя известна из кэша: повторный поиск обходится без базы
+    entry = note_cache.get(user_id)
+    if entry is not None:
+        version = entry.version
     else:
-        notes = [
-            {
-                'id': row[0],
-                'title': row[1],
-                'content': row[2],
-                'created_at': row[3],
-                'updated_at': row[4],
-                'author': row[6]
-            }
-            for row in all_notes
-            if fuzzy_search(row[1], query) or fuzzy_search(row[2], query)
-        ]
+        version = get_notes_version(get_notes_db(user_id), user_id)
+    
+    # Ключ кэша включает версию заметок, так что любое изменение делает старые записи ненужными
+    notes, candidates = search_cache.get(user_id, query, strict_search, version, limit)
+    truncated = False
+    if notes is None:
+        # Сам поиск дорогой: частые запросы пользователя и поиски сверх общего лимита
+        # отклоняются, чтобы не занимать потоки, нужные остальным запросам
+        retry_after = search_admission.acquire(user_id)
+        if retry_after is not None:
+            response = jsonify({'error': 'Too many search requests', 'retry_after': retry_after})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+        try:
+            conn = get_notes_db(user_id)
+            # Запрос продолжает уже найденный — ищем только среди его результатов
+            if strict_search:
+                notes = strict_search_notes(conn, user_id, query, limit, candidates)
+                ids = match_ids(notes, limit)
+            elif candidates is None and search_executor.should_parallelize(conn, user_id, version):
+                notes, ids, truncated = parallel_search_notes(conn, user_id, version, query, limit)
+            else:
+                notes, ids = fuzzy_search_notes(conn, user_id, query, limit, candidates=candidates)
+        finally:
+            search_admission.release()
+        # Результат, не успевший к сроку, повторно не выдаём
+        if not truncated:
+            search_cache.put(user_id, query, strict_search, version, limit, notes, ids)
+    
+    response = jsonify(notes)
+    if truncated:
+        response.headers['X-Search-Truncated'] = 'true'
+    return response
+
+@api.route('/api/notes/search/stats', methods=['GET'])
+@login_required
+def search_stats():
+    return jsonify(search_cache.stats())
 
-    return jsonify(notes)
+def create_app():
+    """Собирает приложение и доводит схему баз до текущей версии.
+
+    Сам импорт модуля ничего не открывает и не создаёт, а библиотеки Google
+    загружаются при первом входе.
+    """
+    if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
+        raise ValueError("GOOGLE_CLIENT_ID и GOOGLE_CLIENT_SECRET должны быть установлены в переменных окружения")
+    
+    app = Flask(__name__)
+    CORS(app, supports_credentials=True, expose_headers=['X-Next-Cursor', 'X-Sync-Token', 'X-Search-Truncated', 'ETag', 'Retry-After'])
+    app.secret_key = os.urandom(24)  # для сессий
+    db.init_app(app)
+    instrumentation.init_app(app)
+    response_encoder.init_app(app)
+    # Записанные автосохранения сразу попадают в кэш метаданных
+    autosave.init_app(app, save_autosaved_notes, note_cache.sync)
+    app.register_blueprint(api)
+    
+    schema.migrate()
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0')
\ No newline at end of file
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import dump_cookie
+
+import app as notes_app
+import db
+from autosave import autosave
+
+# Потоки для синхронных обработчиков Flask: каждому нужно соединение из пула базы
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', str(db.POOL_SIZE)))
+
+CALLBACK_PATH = '/api/auth/callback'
+
+def save_google_user(user_info):
+    """Выполняется в пуле потоков: запись пользователя в базу"""
+    conn = db.pool.acquire()
+    try:
+        return notes_app.login_google_user(conn, user_info)
+    finally:
+        db.pool.release(conn)
+
+def session_cookie(flask_app, user_id):
+    """Кука сессии Flask с user_id — та же, что ставит session['user_id'] в callback"""
+    interface = flask_app.session_interface
+    value = interface.get_signing_serializer(flask_app).dumps({'user_id': user_id})
+    return dump_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        value,
+        domain=interface.get_cookie_domain(flask_app),
+        path=interface.get_cookie_path(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=interface.get_cookie_samesite(flask_app)
+    )
+
+async def send_response(send, status, body=b'', headers=()):
+    await send({'type': 'http.response.start', 'status': status, 'headers': list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, status, data):
+    await send_response(send, status, json.dumps(data).encode(), [(b'content-type', b'application/json')])
+
+class NotesASGI:
+    """ASGI-режим для тех же маршрутов.
+
+    Обработчики Flask выполняются в ограниченном пуле потоков, а вход через Google
+    обслуживается асинхронно: ожидание ответа Google не занимает поток, нужный для
+    работы с заметками.
+    """
+
+    def __init__(self, flask_app, threads=ASGI_THREADS):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=threads)
+        self.google = None
+
+    def google_client(self):
+        if self.google is None:
+            # httpx и настройки транспорта нужны только для входа: загружаются при первом
+            import httpx
+            from google_transport import GOOGLE_CONNECT_TIMEOUT, GOOGLE_POOL_SIZE, GOOGLE_READ_TIMEOUT, GOOGLE_RETRIES
+
+            # Те же таймауты, что и у синхронного google_transport; повторяются только ошибки соединения
+            self.google = httpx.AsyncClient(
+                timeout=httpx.Timeout(GOOGLE_READ_TIMEOUT, connect=GOOGLE_CONNECT_TIMEOUT),
+                transport=httpx.AsyncHTTPTransport(
+                    retries=GOOGLE_RETRIES,
+                    limits=httpx.Limits(max_connections=GOOGLE_POOL_SIZE)
+                )
+            )
+        return self.google
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == CALLBACK_PATH and scope['method'] == 'GET':
+            await self.callback(scope, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Клиент Google создаётся при первом входе, а не при старте процесса
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.google is not None:
+                    await self.google.aclose()
+                    self.google = None
+                self.wsgi.executor.shutdown(wait=False)
+                # uvicorn завершает процесс повторным сигналом, и atexit может не успеть:
+                # отложенные автосохранения записываются здесь
+                await asyncio.get_running_loop().run_in_executor(None, autosave.flush)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_google_user_info(self, code):
+        client = self.google_client()
+        response = await client.post(notes_app.GOOGLE_TOKEN_URL, data=notes_app.google_token_data(code))
+        if not response.is_success:
+            raise Exception('Failed to get token from Google')
+
+        token_data = response.json()
+        headers = {'Authorization': f'Bearer {token_data["access_token"]}'}
+        response = await client.get(notes_app.GOOGLE_USERINFO_URL, headers=headers)
+        if not response.is_success:
+            raise Exception('Failed to get user info from Google')
+
+        return response.json()
+
+    async def callback(self, scope, send):
+        code = parse_qs(scope['query_string'].decode()).get('code', [None])[0]
+        if not code:
+            await send_json(send, 400, {'error': 'No authorization code provided'})
+            return
+
+        try:
+            user_info = await self.get_google_user_info(code)
+            # Запись в базу — в том же ограниченном пуле, что и остальные обработчики
+            loop = asyncio.get_running_loop()
+            user_id = await loop.run_in_executor(self.wsgi.executor, save_google_user, user_info)
+        except Exception as e:
+            await send_json(send, 500, {'error': str(e)})
+            return
+
+        await send_response(send, 302, headers=[
+            (b'location', b'/'),
+            (b'set-cookie', session_cookie(self.flask_app, user_id).encode('latin-1'))
+        ])
+
+app = NotesASGI(notes_app.create_app())
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='127.0.0.1', port=5000)
@@ -0,0 +1,329 @@
+import atexit
+import contextlib
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flask import has_request_context, request, session
+
+import db
+import instrumentation
+
+# Как часто записываются отложенные автосохранения (миллисекунды); 0 — записывать сразу
+AUTOSAVE_FLUSH_MS = int(os.environ.get('AUTOSAVE_FLUSH_MS', '2000'))
+# При скольких отложенных заметках запись начинается, не дожидаясь интервала
+AUTOSAVE_MAX_PENDING = int(os.environ.get('AUTOSAVE_MAX_PENDING', '1000'))
+# Отложенные автосохранения лежат в отдельной базе, общей для рабочих процессов
+AUTOSAVE_DB = os.environ.get('AUTOSAVE_DB', 'autosave.db')
+# Для скольких записанных заметок помнится версия, которую знает клиент
+AUTOSAVE_ALIASES = 10000
+
+logger = logging.getLogger('notes.autosave')
+
+# writer — сессия, приславшая правку; seq — метка именно этой версии в очереди
+PendingNote = namedtuple('PendingNote', 'user_id title content version writer seq')
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS pending (
+        note_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        writer TEXT NOT NULL,
+        seq INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS pending_user ON pending (user_id)',
+    # Версия заметки, которую знает writer, -> версия после записи его правки
+    '''
+    CREATE TABLE IF NOT EXISTS aliases (
+        note_id INTEGER PRIMARY KEY,
+        writer TEXT NOT NULL,
+        known INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        written REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS aliases_written ON aliases (written)',
+)
+
+def writer():
+    """Идентификатор сессии текущего запроса: правки разных устройств не принимаются друг за друга"""
+    if 'writer' not in session:
+        session['writer'] = secrets.token_hex(8)
+    return session['writer']
+
+def new_seq():
+    return secrets.randbits(62)
+
+class AutosaveQueue:
+    """Отложенная запись автосохранений с групповым коммитом.
+
+    Для каждой заметки хранится только последняя присланная версия. Раз в интервал
+    все отложенные заметки записываются — по одной транзакции на базу с заметками.
+    Любой другой запрос пользователя сначала записывает его отложенные заметки,
+    поэтому он видит свои правки.
+
+    Очередь лежит в отдельной базе SQLite без fsync и общая для рабочих процессов
+    serve.py: запросы пользователя могут попадать в разные процессы. Записи идут по
+    очереди под файловой блокировкой, а строка очереди удаляется только после коммита
+    в базу заметок, поэтому запрос, не нашедший правку в очереди, найдёт её в базе.
+
+    Пока правка ждёт записи, клиент продолжает работать с версией заметки, которую
+    получил в ответе. После записи эта версия ещё принимается как базовая, но только
+    от той же сессии: она запоминается как псевдоним новой версии. Правка другой сессии
+    с той же базовой версией получает конфликт.
+    """
+
+    def __init__(self, path=AUTOSAVE_DB, interval_ms=AUTOSAVE_FLUSH_MS, max_pending=AUTOSAVE_MAX_PENDING):
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        # Защищает соединение с очередью
+        self.lock = threading.Lock()
+        # Одновременно идёт только одна запись: внутри процесса — этот замок,
+        # между процессами — блокировка файла
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.conn = None
+        self.lock_file = None
+        self.save = None
+        self.on_write = None
+        self.thread = None
+        self.pid = None
+
+    def init_app(self, app, save, on_write=None):
+        """save(conn, user_id, {id: (заголовок, текст, базовая версия)}) записывает в открытой транзакции
+        заметки, которые всё ещё в базовой версии, и возвращает их новые версии {id: версия};
+        on_write(conn, user_id) вызывается после коммита"""
+        self.save = save
+        self.on_write = on_write
+        app.before_request(self.before_request)
+        # Отложенные правки не теряются при остановке сервера
+        atexit.register(self.flush)
+
+    def before_request(self):
+        if request.args.get('autosave') or 'user_id' not in session:
+            return
+        self.flush(session['user_id'])
+
+    def _connect(self):
+        # Вызывается под self.lock. Соединение и поток записи принадлежат процессу,
+        # который их создал: после fork открываются заново
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.conn = None
+            self.lock_file = None
+            self.thread = None
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=db.BUSY_TIMEOUT, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            # Без fsync: при сбое ОС теряются только правки последних секунд, как и раньше в памяти
+            conn.execute('PRAGMA synchronous = OFF')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self.conn = conn
+        return self.conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Вызывается под self.lock
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @contextlib.contextmanager
+    def _flush_lock(self):
+        with self.flush_lock:
+            if fcntl is None:
+                yield
+                return
+            with self.lock:
+                self._connect()
+                if self.lock_file is None:
+                    self.lock_file = open(self.path + '.lock', 'a')
+                lock_file = self.lock_file
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('autosave flush failed')
+
+    def get(self, note_id):
+        """Отложенная версия заметки или None"""
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT user_id, title, content, version, writer, seq FROM pending WHERE note_id = ?',
+                (note_id,)).fetchone()
+        return PendingNote(*row) if row else None
+
+    def resolve_version(self, note_id, version, writer):
+        """Базовая версия клиента writer с учётом его записанных автосохранений"""
+        if version is None or writer is None:
+            return version
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT version FROM aliases WHERE note_id = ? AND writer = ? AND known = ?',
+                (note_id, writer, version)).fetchone()
+        return row[0] if row else version
+
+    def put(self, user_id, note_id, title, content, version, writer, replaces=None):
+        """Откладывает запись заметки вместо отложенной версии с меткой replaces.
+
+        Возвращает False, если очередь заметки за это время изменилась: тогда правку
+        нужно заново сверить с тем, что лежит в очереди.
+        """
+        with self.lock:
+            with self._transaction() as conn:
+                row = conn.execute('SELECT seq FROM pending WHERE note_id = ?', (note_id,)).fetchone()
+                if (row[0] if row else None) != replaces:
+                    return False
+                conn.execute('''
+                    INSERT OR REPLACE INTO pending (note_id, user_id, title, content, version, writer, seq)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (note_id, user_id, title, content, version, writer, new_seq()))
+                full = conn.execute('SELECT COUNT(*) FROM pending').fetchone()[0] >= self.max_pending
+            if row is not None:
+                instrumentation.AUTOSAVE_COALESCED.inc()
+            if self.thread is None and self.interval > 0:
+                self.thread = threading.Thread(target=self._run, name='autosave', daemon=True)
+                self.thread.start()
+
+        if self.interval <= 0:
+            self.flush(user_id)
+        elif full:
+            self.wakeup.set()
+        return True
+
+    def _take(self, user_id):
+        with self.lock:
+            conn = self._connect()
+            if user_id is None:
+                rows = conn.execute('SELECT note_id, user_id, title, content, version, writer, seq FROM pending')
+            else:
+                rows = conn.execute('SELECT note_id, user_id, title, content, version, writer, seq FROM pending '
+                                    'WHERE user_id = ?', (user_id,))
+            return {row[0]: PendingNote(*row[1:]) for row in rows.fetchall()}
+
+    def flush(self, user_id=None):
+        """Записывает отложенные заметки пользователя или, без user_id, все"""
+        with self.lock:
+            conn = self._connect()
+            if user_id is None:
+                row = conn.execute('SELECT 1 FROM pending LIMIT 1').fetchone()
+            else:
+                row = conn.execute('SELECT 1 FROM pending WHERE user_id = ? LIMIT 1', (user_id,)).fetchone()
+        # Строки очереди удаляются после коммита, поэтому запись, которую сейчас ведёт
+        # другой поток или процесс, здесь ещё видна — её дожидаемся на блокировке
+        if row is None:
+            return
+        with self._flush_lock():
+            notes = self._take(user_id)
+            if notes:
+                self._write(notes)
+
+    def _write(self, notes):
+        started = time.perf_counter()
+        by_user = {}
+        for note_id, note in notes.items():
+            by_user.setdefault(note.user_id, {})[note_id] = note
+
+        # Внутри запроса запись идёт через его соединения: при AUTOSAVE_FLUSH_MS=0 запрос
+        # уже держит соединение из пула, и второе он ждал бы у самого себя
+        in_request = has_request_context()
+
+        # Заметки пользователей группируются по базам, в которых они лежат
+        directory = db.get_db() if in_request else db.pool.acquire()
+        try:
+            by_shard = {}
+            for user_id, user_notes in by_user.items():
+                by_shard.setdefault(db.user_shard(directory, user_id), {})[user_id] = user_notes
+        finally:
+            if not in_request:
+                db.pool.release(directory)
+
+        for shard, users in by_shard.items():
+            path = db.shard_path(shard)
+            pool = db.get_pool(path)
+            conn = db.get_shard_db(shard) if in_request else pool.acquire()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                versions = {}
+                for user_id, user_notes in users.items():
+                    # Правка записывается, только если заметка всё ещё в той версии, от которой
+                    # её сделали, — или в версии, получившейся из прошлой правки той же сессии
+                    versions.update(self.save(conn, user_id, {
+                        note_id: (note.title, note.content, self.resolve_version(note_id, note.version, note.writer))
+                        for note_id, note in user_notes.items()
+                    }))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # Строки остаются в очереди, запись повторится в следующий раз
+                logger.exception('autosave write failed', extra={'path': path})
+                continue
+            else:
+                if self.on_write is not None:
+                    for user_id in users:
+                        try:
+                            self.on_write(conn, user_id)
+                        except Exception:
+                            logger.exception('autosave on_write failed', extra={'user_id': user_id})
+            finally:
+                if not in_request:
+                    pool.release(conn)
+
+            taken = [(note_id, note) for user_notes in users.values() for note_id, note in user_notes.items()]
+            conflicts = [note_id for note_id, note in taken if note_id not in versions]
+            with self.lock:
+                with self._transaction() as queue:
+                    now = time.time()
+                    queue.executemany('''
+                        INSERT OR REPLACE INTO aliases (note_id, writer, known, version, written)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', [(note_id, note.writer, note.version, versions[note_id], now)
+                          for note_id, note in taken if note_id in versions])
+                    # Правку, присланную заново за время записи, оставляем в очереди
+                    queue.executemany('DELETE FROM pending WHERE note_id = ? AND seq = ?',
+                                      [(note_id, note.seq) for note_id, note in taken])
+                    queue.execute('''
+                        DELETE FROM aliases WHERE written < (
+                            SELECT written FROM aliases ORDER BY written DESC LIMIT 1 OFFSET ?
+                        )
+                    ''', (AUTOSAVE_ALIASES,))
+            if conflicts:
+                # Заметку удалили или изменили с другого устройства: чужую правку не затираем.
+                # Клиент узнает о конфликте при следующем сохранении
+                logger.warning('autosave conflict', extra={'note_ids': conflicts})
+                instrumentation.AUTOSAVE_CONFLICTS.inc(len(conflicts))
+            instrumentation.AUTOSAVE_WRITTEN.inc(len(versions))
+
+        instrumentation.AUTOSAVE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+autosave = AutosaveQueue()
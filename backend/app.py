@@ -1,11 +1,9 @@
 from flask import Flask, request, jsonify, make_response
 
-from google.oauth2 import id_token
-from google.auth.transport import requests
 import os
 import secrets
 from dotenv import load_dotenv
-from auth import create_token, token_required, decode_token
+from auth import create_token, token_required, decode_token, revoke_token, token_cache
 
 # Загружаем .env если есть
 load_dotenv()
@@ -54,8 +52,10 @@ def setup_env():
         except Exception as e:
             print(f"Ошибка записи .env: {e}")
 
-# Настраиваем переменные окружения
-setup_env()
+# Настраиваем переменные окружения. .env дописывается только при запуске сервера
+# разработки: при импорте рабочими процессами файл не переписывается
+if __name__ == '__main__':
+    setup_env()
 
 # Проверяем обязательные переменные
 if not os.getenv('GOOGLE_CLIENT_ID'):
@@ -75,7 +75,10 @@ def google_auth():
         if not token:
             return jsonify({'error': 'Token not provided'}), 400
 
-        idinfo = id_token.verify_oauth2_token(token, requests.Request(), GOOGLE_CLIENT_ID)
+        # google-auth и requests загружаются при первом входе, а не при импорте
+        from google.oauth2 import id_token
+        from google_transport import google_request
+        idinfo = id_token.verify_oauth2_token(token, google_request, GOOGLE_CLIENT_ID)
         
         user_id = idinfo['sub']
         
@@ -151,6 +154,11 @@ def refresh_auth():
     if not payload or payload.get('type') != 'refresh':
         return jsonify({'message': 'Invalid refresh token'}), 401
 
+    # Прежний access token больше не нужен
+    old_access_token = request.cookies.get('auth_token')
+    if old_access_token:
+        revoke_token(old_access_token)
+
     # Генерим новый access token 
     access_token = create_token(payload['user_id'], 'access')
     
@@ -169,6 +177,11 @@ def refresh_auth():
 
 @app.route('/auth/logout', methods=['POST'])
 def logout():
+    for cookie in ('auth_token', 'refresh_token'):
+        token = request.cookies.get(cookie)
+        if token:
+            revoke_token(token)
+
     response = make_response(jsonify({'message': 'Logged out'}))
     response.delete_cookie('auth_token')
     response.delete_cookie('refresh_token')
@@ -198,5 +211,21 @@ def get_user(user_id):
         'username': 'User ' + user_id[:6]  # Временное решение
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Счётчики кэша проверенных токенов в текстовом формате Prometheus; наружу не проксируется
+    stats = token_cache.stats()
+    lines = [
+        '# TYPE backend_token_cache_hits_total counter',
+        f"backend_token_cache_hits_total {stats['hits']}",
+        '# TYPE backend_token_cache_misses_total counter',
+        f"backend_token_cache_misses_total {stats['misses']}",
+        '# TYPE backend_token_cache_size gauge',
+        f"backend_token_cache_size {stats['size']}",
+        '# TYPE backend_token_cache_revoked gauge',
+        f"backend_token_cache_revoked {stats['revoked']}",
+    ]
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 if __name__ == '__main__':
     app.run(debug=False)
\ No newline at end of file
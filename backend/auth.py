@@ -1,5 +1,9 @@
 from datetime import datetime, timedelta
+from collections import OrderedDict
 import jwt
+import hashlib
+import threading
+import time
 from functools import wraps
 from flask import request, jsonify
 import os
@@ -8,6 +12,76 @@ JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
 JWT_ALGORITHM = 'HS256'
 JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
 JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=30)
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))
+
+class TokenCache:
+    """LRU-кэш проверенных токенов: хэш токена -> payload.
+
+    Запись живёт ровно до exp токена. Отозванные токены хранятся отдельно,
+    тоже до своего exp, чтобы их не вернуло повторной проверкой подписи.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.revoked = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                payload, expires = entry
+                if time.time() < expires:
+                    self.entries.move_to_end(digest)
+                    self.hits += 1
+                    return payload
+                del self.entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, digest, payload, expires):
+        with self.lock:
+            self.entries[digest] = (payload, expires)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def revoke(self, digest, expires):
+        with self.lock:
+            self.entries.pop(digest, None)
+            self.revoked[digest] = expires
+            # Истёкшие токены и так не пройдут проверку — чистим список отозванных
+            if len(self.revoked) > self.maxsize:
+                now = time.time()
+                self.revoked = {d: e for d, e in self.revoked.items() if e > now}
+
+    def is_revoked(self, digest):
+        with self.lock:
+            expires = self.revoked.get(digest)
+            if expires is None:
+                return False
+            if time.time() >= expires:
+                del self.revoked[digest]
+                return False
+            return True
+
+    def stats(self):
+        """Попадания и промахи кэша, число записей и отозванных токенов"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'revoked': len(self.revoked)
+            }
+
+token_cache = TokenCache()
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
 
 def create_token(user_id, token_type='access'):
     expires_delta = JWT_ACCESS_TOKEN_EXPIRES if token_type == 'access' else JWT_REFRESH_TOKEN_EXPIRES
@@ -23,11 +97,30 @@ def create_token(user_id, token_type='access'):
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 def decode_token(token):
+    digest = token_digest(token)
+    if token_cache.is_revoked(digest):
+        return None
+
+    payload = token_cache.get(digest)
+    if payload is not None:
+        return dict(payload)
+
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except:
         return None
 
+    # Токен без срока действия не кэшируем — запись в кэше должна истекать вместе с ним
+    if 'exp' in payload:
+        token_cache.put(digest, payload, payload['exp'])
+    return dict(payload)
+
+def revoke_token(token):
+    """Отзывает токен: он перестаёт приниматься до истечения срока действия"""
+    payload = decode_token(token)
+    if payload and 'exp' in payload:
+        token_cache.revoke(token_digest(token), payload['exp'])
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -0,0 +1 @@
+../google_transport.py
\ No newline at end of file
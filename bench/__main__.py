@@ -0,0 +1,46 @@
+import argparse
+
+from bench.drivers import DRIVERS
+from bench.generate import generate
+from bench.runner import ENDPOINTS, compare, run, save
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Нагрузочное тестирование API заметок')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='создать синтетическую базу notes.db')
+    gen.add_argument('directory', help='каталог, в котором будет создан notes.db')
+    gen.add_argument('--notes', type=int, default=1000, help='число заметок пользователя (от 1k до 1M)')
+    gen.add_argument('--seed', type=int, default=0)
+
+    bench = commands.add_parser('run', help='замерить задержки и пропускную способность')
+    bench.add_argument('directory', help='каталог с notes.db из generate; база будет изменена')
+    bench.add_argument('--driver', choices=sorted(DRIVERS), default='client',
+                       help='client — тестовый клиент Flask, server — локальный uvicorn')
+    bench.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                       help='точки через запятую: ' + ', '.join(ENDPOINTS))
+    bench.add_argument('--requests', type=int, default=200, help='запросов на точку и уровень параллельности')
+    bench.add_argument('--concurrency', default='1,8', help='уровни параллельности через запятую')
+    bench.add_argument('--warmup', type=int, default=10)
+    bench.add_argument('--output', help='куда сохранить JSON (по умолчанию bench/results/)')
+
+    cmp = commands.add_parser('compare', help='сравнить два сохранённых прогона')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args.directory, args.notes, args.seed)
+    elif args.command == 'run':
+        endpoints = [name.strip() for name in args.endpoints.split(',') if name.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            parser.error(f"неизвестные точки: {', '.join(sorted(unknown))}")
+        concurrency = [int(level) for level in args.concurrency.split(',')]
+        report = run(DRIVERS[args.driver], args.directory, endpoints, args.requests, concurrency, args.warmup)
+        print(f"Результаты сохранены в {save(report, args.output)}")
+    else:
+        compare(args.old, args.new)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import importlib
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Сколько ждать запуска сервера (секунды)
+SERVER_START_TIMEOUT = 30
+
+def bench_environ():
+    """Переменные окружения приложения: DEBUG_MODE вместо входа через Google.
+
+    Ограничение поисков снято: замер идёт от одного пользователя с десятками потоков,
+    и иначе часть поисков получала бы 429 за доли миллисекунды, искажая задержки.
+    """
+    return {
+        'DEBUG_MODE': 'true',
+        'GOOGLE_CLIENT_ID': 'bench',
+        'GOOGLE_CLIENT_SECRET': 'bench',
+        'SEARCH_RATE': '0',
+        'SEARCH_MAX_ACTIVE': '1000',
+        'SEARCH_MAX_QUEUED': '1000'
+    }
+
+def import_app(directory):
+    """Создаёт приложение, работающее с directory/notes.db"""
+    os.environ.update(bench_environ())
+    os.chdir(directory)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return importlib.import_module('app').create_app()
+
+def peak_rss_mb(pid):
+    """Пиковый RSS процесса (VmHWM) с последнего reset_peak_rss, МБ"""
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+def reset_peak_rss(pid):
+    """Сбрасывает пик RSS процесса до текущего RSS, чтобы замерить следующую точку отдельно"""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        # Без прав на clear_refs пик остаётся общим для всего прогона
+        pass
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class ClientDriver:
+    """Запросы через тестовый клиент Flask в текущем процессе"""
+
+    name = 'client'
+
+    def __init__(self, directory):
+        self.app = import_app(directory)
+
+    def session(self):
+        # У каждого потока свой клиент со своей кукой сессии
+        return self.app.test_client()
+
+    def request(self, session, method, path, body=None):
+        response = session.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+    def reset_peak_rss(self):
+        reset_peak_rss(os.getpid())
+
+    def peak_rss_mb(self):
+        return peak_rss_mb(os.getpid())
+
+    def close(self):
+        pass
+
+class ServerDriver:
+    """Запросы по HTTP к отдельному процессу uvicorn — так же, как приложение работает на сервере"""
+
+    name = 'server'
+
+    def __init__(self, directory):
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT, **bench_environ())
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(self.port), '--log-level', 'warning'],
+            cwd=directory, env=env
+        )
+        self.wait_ready()
+
+    def wait_ready(self):
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Сервер завершился при запуске')
+            try:
+                requests.get(self.base_url + '/api/auth/check', timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError('Сервер не запустился вовремя')
+
+    def session(self):
+        return requests.Session()
+
+    def request(self, session, method, path, body=None):
+        response = session.request(method, self.base_url + path, json=body)
+        return response.status_code
+
+    def reset_peak_rss(self):
+        reset_peak_rss(self.process.pid)
+
+    def peak_rss_mb(self):
+        # Пиковый RSS процесса сервера, а не генератора нагрузки
+        return peak_rss_mb(self.process.pid)
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+DRIVERS = {driver.name: driver for driver in (ClientDriver, ServerDriver)}
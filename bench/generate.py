@@ -0,0 +1,106 @@
+import datetime
+import os
+import random
+import sqlite3
+
+from bench.drivers import import_app
+
+# Словари для синтетических заметок: частые слова встречаются чаще (закон Ципфа)
+WORDS = {
+    'ru': ('заметка список дела купить молоко встреча завтра проект отчёт идея книга '
+           'фильм позвонить маме работа отпуск поездка билеты гостиница задача срок '
+           'программа поиск база данных сервер ошибка исправить проверить прочитать '
+           'рецепт борщ картошка погода весна лето осень зима москва петербург '
+           'понедельник вторник среда четверг пятница суббота воскресенье').split(),
+    'en': ('note list todo buy milk meeting tomorrow project report idea book movie '
+           'call work vacation trip tickets hotel task deadline program search '
+           'database server error fix check read recipe weather spring summer '
+           'autumn winter london monday tuesday friday weekend').split(),
+    'de': ('notiz liste einkaufen milch treffen morgen projekt bericht idee buch '
+           'arbeit urlaub reise aufgabe fehler prüfen lesen wetter frühling sommer').split(),
+    'uk': ('нотатка список справи купити зустріч завтра проєкт звіт ідея книжка '
+           'робота відпустка подорож завдання помилка перевірити читати погода').split()
+}
+# Доли языков в тексте
+LANGUAGE_WEIGHTS = {'ru': 0.5, 'en': 0.3, 'de': 0.1, 'uk': 0.1}
+BATCH_SIZE = 10000
+
+def zipf_weights(count):
+    return [1 / (rank + 1) for rank in range(count)]
+
+class TextGenerator:
+    """Синтетический многоязычный текст с опечатками и числами"""
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.languages = list(LANGUAGE_WEIGHTS)
+        self.language_weights = list(LANGUAGE_WEIGHTS.values())
+        self.weights = {lang: zipf_weights(len(words)) for lang, words in WORDS.items()}
+
+    def word(self):
+        lang = self.rng.choices(self.languages, self.language_weights)[0]
+        word = self.rng.choices(WORDS[lang], self.weights[lang])[0]
+        roll = self.rng.random()
+        if roll < 0.05 and len(word) > 3:
+            # Опечатка: пропущенная буква
+            pos = self.rng.randrange(len(word))
+            word = word[:pos] + word[pos + 1:]
+        elif roll < 0.08:
+            word = str(self.rng.randint(1, 2025))
+        elif roll < 0.1:
+            word = word.capitalize()
+        return word
+
+    def words(self, count):
+        return ' '.join(self.word() for _ in range(count))
+
+    def title(self):
+        return self.words(self.rng.randint(1, 6))
+
+    def content(self):
+        # Длина текста — логнормальная: много коротких заметок и немного очень длинных
+        return self.words(max(1, min(int(self.rng.lognormvariate(3.5, 1.0)), 5000)))
+
+def generate(directory, notes, seed=0, days=365):
+    """Создаёт directory/notes.db со схемой приложения и notes заметками пользователя 1"""
+    directory = os.path.abspath(directory)
+    path = os.path.join(directory, 'notes.db')
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(path):
+        raise FileExistsError(f'{path} уже существует')
+
+    # Схему создаёт само приложение, чтобы она не расходилась с рабочей
+    import_app(directory)
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute("INSERT OR IGNORE INTO users (id, email, username) VALUES (1, 'debug@example.com', 'debug')")
+
+    text = TextGenerator(seed)
+    now = datetime.datetime.now()
+    created = 0
+    while created < notes:
+        batch = []
+        for _ in range(min(BATCH_SIZE, notes - created)):
+            updated_at = (now - datetime.timedelta(seconds=text.rng.randint(0, days * 86400))).isoformat()
+            batch.append((text.title(), text.content(), updated_at, updated_at))
+        conn.executemany('''
+            INSERT INTO notes (title, content, user_id, created_at, updated_at)
+            VALUES (?, ?, 1, ?, ?)
+        ''', batch)
+        conn.commit()
+        created += len(batch)
+        print(f"Создано заметок: {created}/{notes}")
+
+    # Тексты сжимает и нормализует тот же перенос, что и на рабочей базе
+    from migrate_bodies import migrate_bodies
+    from migrate_terms import migrate_terms
+    migrate_bodies(path, pause=0)
+    migrate_terms(path, pause=0)
+
+    conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')")
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    return path
@@ -0,0 +1,187 @@
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import threading
+import time
+from urllib.parse import urlencode
+
+from bench.drivers import REPO_ROOT
+from bench.generate import TextGenerator
+
+RESULTS_DIR = os.path.join(REPO_ROOT, 'bench', 'results')
+# Сколько id заметок и слов берём из базы для построения запросов
+SAMPLE_SIZE = 1000
+
+class Context:
+    """Данные базы, из которых собираются запросы: id заметок и слова из них"""
+
+    def __init__(self, directory):
+        conn = sqlite3.connect(os.path.join(directory, 'notes.db'))
+        self.notes = conn.execute('SELECT COUNT(*) FROM notes WHERE user_id = 1').fetchone()[0]
+        rows = conn.execute('''
+            SELECT id, title FROM notes WHERE user_id = 1 ORDER BY random() LIMIT ?
+        ''', (SAMPLE_SIZE,)).fetchall()
+        conn.close()
+        self.ids = [row[0] for row in rows] or [1]
+        self.words = [word for row in rows for word in row[1].split() if len(word) > 3] or ['note']
+
+def typo(rng, word):
+    """Слово с заменённой буквой — для нечеткого поиска"""
+    pos = rng.randrange(len(word))
+    return word[:pos] + rng.choice('аеиоуaeiou') + word[pos + 1:]
+
+def get_notes(rng, ctx, text):
+    return 'GET', '/api/notes?limit=50', None
+
+def search_strict(rng, ctx, text):
+    return 'GET', '/api/notes/search?' + urlencode({'q': rng.choice(ctx.words), 'strict': 'true'}), None
+
+def search_fuzzy(rng, ctx, text):
+    return 'GET', '/api/notes/search?' + urlencode({'q': typo(rng, rng.choice(ctx.words))}), None
+
+def create_note(rng, ctx, text):
+    return 'POST', '/api/notes', {'title': text.title(), 'content': text.content()}
+
+def update_note(rng, ctx, text):
+    return 'PUT', f'/api/notes/{rng.choice(ctx.ids)}', {'title': text.title(), 'content': text.content()}
+
+ENDPOINTS = {
+    'get_notes': get_notes,
+    'search_strict': search_strict,
+    'search_fuzzy': search_fuzzy,
+    'create_note': create_note,
+    'update_note': update_note
+}
+
+def percentile(sorted_values, fraction):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def to_ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+def run_endpoint(driver, ctx, name, requests_count, concurrency, warmup=10, seed=0):
+    """Прогоняет requests_count запросов к одной точке в concurrency потоков"""
+    build = ENDPOINTS[name]
+    latencies = []
+    # Отказы 429 считаются отдельно от ошибок: их задержка — не время выполнения запроса
+    errors = [0, 0]
+    lock = threading.Lock()
+
+    def worker(count, worker_seed, record):
+        rng = random.Random(worker_seed)
+        text = TextGenerator(worker_seed)
+        session = driver.session()
+        local = []
+        failed = rejected = 0
+        for _ in range(count):
+            method, path, body = build(rng, ctx, text)
+            start = time.perf_counter()
+            status = driver.request(session, method, path, body)
+            local.append(time.perf_counter() - start)
+            if status == 429:
+                rejected += 1
+            elif status >= 400:
+                failed += 1
+        if record:
+            with lock:
+                latencies.extend(local)
+                errors[0] += failed
+                errors[1] += rejected
+
+    # Пик RSS считается для каждой точки отдельно, а не с начала прогона
+    driver.reset_peak_rss()
+    worker(warmup, seed, record=False)
+
+    per_thread = [requests_count // concurrency + (i < requests_count % concurrency) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(count, seed + i + 1, True))
+               for i, count in enumerate(per_thread)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'endpoint': name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rejected': errors[1],
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p95_ms': to_ms(percentile(latencies, 0.95)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'mean_ms': to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'peak_rss_mb': round(driver.peak_rss_mb(), 1)
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(driver_class, directory, endpoints, requests_count, concurrency_levels, warmup=10):
+    directory = os.path.abspath(directory)
+    ctx = Context(directory)
+    driver = driver_class(directory)
+    results = []
+    try:
+        for concurrency in concurrency_levels:
+            for name in endpoints:
+                result = run_endpoint(driver, ctx, name, requests_count, concurrency, warmup)
+                results.append(result)
+                print(f"{name:>14} x{concurrency:<3} p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, "
+                      f"p99 {result['p99_ms']} мс, {result['throughput_rps']} запр/с, "
+                      f"RSS {result['peak_rss_mb']} МБ, ошибок {result['errors']}, отказов 429 {result['rejected']}")
+    finally:
+        driver.close()
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'driver': driver_class.name,
+        'notes': ctx.notes,
+        'results': results
+    }
+
+def save(report, output=None):
+    if output is None:
+        commit = (report['commit'] or 'unknown')[:10]
+        output = os.path.join(RESULTS_DIR, f"{commit}-{report['driver']}-{report['notes']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return output
+
+def compare(old_path, new_path):
+    """Печатает изменение задержек и пропускной способности между двумя прогонами"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    old_results = {(r['endpoint'], r['concurrency']): r for r in old['results']}
+    print(f"{(old['commit'] or '?')[:10]} -> {(new['commit'] or '?')[:10]}")
+    for result in new['results']:
+        base = old_results.get((result['endpoint'], result['concurrency']))
+        if base is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'peak_rss_mb'):
+            if base[key] and result[key] is not None:
+                changes.append(f"{key} {base[key]} -> {result[key]} ({(result[key] / base[key] - 1) * 100:+.1f}%)")
+        print(f"{result['endpoint']:>14} x{result['concurrency']:<3} " + ', '.join(changes))
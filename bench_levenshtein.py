@@ -0,0 +1,79 @@
+import random
+import time
+from edit_distance import WordBatch, levenshtein_distance, np, rank_matches
+
+# Буквы для синтетических заметок: кириллица и латиница
+ALPHABET = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz'
+QUERIES = ['заметка', 'привет', 'sqlite', 'поиск', 'levenshtein', 'мир']
+
+def random_word(rng):
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 12)))
+
+def make_note(rng, vocabulary, words):
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+def check_correctness(rng, rounds=2000, threshold=3):
+    """Сравнивает пакетный подсчёт с levenshtein_distance на случайных словах"""
+    for _ in range(rounds):
+        words = [random_word(rng) for _ in range(rng.randint(1, 30))]
+        query = random_word(rng)
+        expected = [min(levenshtein_distance(word, query), threshold + 1) for word in words]
+        actual = WordBatch(words).distances(query, threshold)
+        if actual != expected:
+            raise AssertionError(f'{query!r}: ожидалось {expected}, получено {actual}')
+    print(f"Корректность: {rounds} наборов слов совпадают с levenshtein_distance")
+
+def fuzzy_search_reference(text, query, threshold=3):
+    """Прежняя реализация нечеткого поиска — по одному слову за раз"""
+    text = text.lower()
+    query = query.lower()
+    if query in text:
+        return True
+    words = text.split()
+    for q_word in query.split():
+        if not any(levenshtein_distance(word, q_word) <= threshold for word in words):
+            return False
+    return True
+
+def bench(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def run_benchmark(rng, note_words=(50, 300, 1500), repeat=5):
+    vocabulary = [random_word(rng) for _ in range(20000)]
+    print(f"NumPy: {'есть' if np is not None else 'нет, используется запасной путь'}")
+    print(f"{'слов в заметке':>15} {'по слову, мс':>14} {'пакетом, мс':>12} {'ускорение':>10}")
+    for words in note_words:
+        notes = [make_note(rng, vocabulary, words) for _ in range(20)]
+
+        def reference():
+            for note in notes:
+                for query in QUERIES:
+                    fuzzy_search_reference(note, query)
+
+        def batched():
+            for note in notes:
+                for query in QUERIES:
+                    rank_matches(note, query)
+
+        for note in notes:
+            for query in QUERIES:
+                assert fuzzy_search_reference(note, query) == (rank_matches(note, query) is not None)
+
+        old = bench(reference, repeat)
+        new = bench(batched, repeat)
+        print(f"{words:>15} {old:>14.1f} {new:>12.1f} {old / new:>9.1f}x")
+
+    # Поиск кандидатов по всему словарю пользователя
+    batch = WordBatch(vocabulary)
+    for query in QUERIES[:3]:
+        old = bench(lambda: [levenshtein_distance(w, query) for w in vocabulary], 1)
+        new = bench(lambda: batch.distances(query, 3), repeat)
+        print(f"Словарь {len(vocabulary)} слов, '{query}': {old:.1f} мс -> {new:.1f} мс")
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    check_correctness(rng)
+    run_benchmark(rng)
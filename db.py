@@ -0,0 +1,188 @@
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import zlib
+from flask import g
+
+from instrumentation import InstrumentedConnection
+
+# Каталог: пользователи и заметки тех, кто ещё не распределён по шардам
+DB_PATH = 'notes.db'
+
+# Число шардов с заметками; 0 — все заметки хранятся в каталоге
+DB_SHARDS = int(os.environ.get('DB_SHARDS', '0'))
+DB_SHARD_DIR = os.environ.get('DB_SHARD_DIR', 'shards')
+# У каждого шарда свой диапазон id заметок, поэтому заметки переезжают между шардами со своими id
+SHARD_ID_BITS = 40
+
+# Сколько соединений держит один процесс
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+# Сколько ждать свободное соединение, прежде чем сдаться (секунды)
+POOL_TIMEOUT = 10
+# Сколько ждать снятия блокировки записи (секунды)
+BUSY_TIMEOUT = 5
+
+PRAGMAS = (
+    # WAL: читатели не блокируют писателя и наоборот
+    'PRAGMA journal_mode = WAL',
+    # В режиме WAL fsync на каждый коммит не нужен для целостности базы
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA mmap_size = 268435456',
+    # Отрицательное значение — размер кэша в КиБ
+    'PRAGMA cache_size = -16000',
+    'PRAGMA temp_store = MEMORY',
+)
+
+def shard_path(shard):
+    """Файл базы с заметками шарда; None — каталог"""
+    if shard is None:
+        return DB_PATH
+    return os.path.join(DB_SHARD_DIR, f'notes-{shard}.db')
+
+def shard_paths():
+    """Все базы с заметками: каталог и шарды"""
+    return [DB_PATH] + [shard_path(shard) for shard in range(DB_SHARDS)]
+
+def home_shard(user_id, shards=None):
+    """Шард пользователя по устойчивому хешу user_id; None, если шардов нет"""
+    shards = DB_SHARDS if shards is None else shards
+    if shards <= 0:
+        return None
+    return zlib.crc32(str(user_id).encode()) % shards
+
+def shard_id_base(shard):
+    """С какого id начинаются заметки и словари шарда; у каталога — с начала"""
+    if shard is None:
+        return 0
+    return (shard + 1) << SHARD_ID_BITS
+
+def connect(path=DB_PATH):
+    """Открывает соединение с настроенными прагмами.
+
+    К шарду подключается каталог, чтобы запросы с JOIN users работали в любой базе.
+    Каталог подключается только для чтения: иначе BEGIN IMMEDIATE в шарде брал бы
+    и блокировку записи каталога, и шарды снова писали бы по очереди.
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, factory=InstrumentedConnection,
+                           uri=True)
+    conn.path = os.path.abspath(path)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if conn.path != os.path.abspath(DB_PATH):
+        conn.execute('ATTACH DATABASE ? AS directory', (pathlib.Path(DB_PATH).absolute().as_uri() + '?mode=ro',))
+    return conn
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений SQLite"""
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Соединения нельзя использовать в дочернем процессе после fork
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.created = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return connect(self.path)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        try:
+            return self.idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError('Нет свободных соединений с базой данных')
+
+    def release(self, conn):
+        if self.pid != os.getpid():
+            return
+        try:
+            # Незавершённую транзакцию следующему запросу не отдаём
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self.lock:
+                self.created -= 1
+            return
+        self.idle.put(conn)
+
+    def close_all(self):
+        with self.lock:
+            while True:
+                try:
+                    self.idle.get_nowait().close()
+                except queue.Empty:
+                    break
+                self.created -= 1
+
+pool = ConnectionPool()
+# Пулы шардов создаются при первом обращении
+_pools = {os.path.abspath(DB_PATH): pool}
+_pools_lock = threading.Lock()
+
+def get_pool(path):
+    key = os.path.abspath(path)
+    with _pools_lock:
+        shard_pool = _pools.get(key)
+        if shard_pool is None:
+            shard_pool = _pools[key] = ConnectionPool(path)
+        return shard_pool
+
+def get_db():
+    """Соединение текущего запроса с каталогом: берётся из пула один раз и возвращается при teardown"""
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+def user_shard(conn, user_id):
+    """Шард, в котором сейчас лежат заметки пользователя; None — каталог"""
+    row = conn.execute('SELECT shard FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+def get_notes_db(user_id):
+    """Соединение текущего запроса с базой, где лежат заметки пользователя"""
+    return get_shard_db(user_shard(get_db(), user_id))
+
+def get_shard_db(shard):
+    """Соединение текущего запроса с базой заметок шарда; None — каталог"""
+    path = shard_path(shard)
+    if path == DB_PATH:
+        return get_db()
+    shards = g.setdefault('shard_dbs', {})
+    if path not in shards:
+        shards[path] = get_pool(path).acquire()
+    return shards[path]
+
+def close_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+    for path, conn in g.pop('shard_dbs', {}).items():
+        get_pool(path).release(conn)
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
@@ -1,23 +1,38 @@
-import sqlite3
+import os
+
+import db
 
 def check_db():
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    
+    directory = db.connect()
+    c = directory.cursor()
+
     print("=== Пользователи ===")
-    c.execute('SELECT * FROM users')
+    c.execute('SELECT id, email, username, created_at, last_login, google_id, shard FROM users')
     users = c.fetchall()
     for user in users:
-        print(f"ID: {user[0]}, Email: {user[1]}, Username: {user[2]}, Created: {user[3]}, Last Login: {user[4]}, Google ID: {user[5]}")
-    
-    print("\n=== Заметки ===")
-    c.execute('SELECT * FROM notes')
-    notes = c.fetchall()
-    for note in notes:
-        print(f"ID: {note[0]}, Title: {note[1]}, Content: {note[2][:50]}..., Created: {note[3]}, Updated: {note[4]}, User ID: {note[5]}")
-    
-    conn.close()
+        # Пользователь ещё не перенесён туда, куда его кладёт DB_SHARDS
+        pending = ' (ожидает migrate_shards.py)' if user[6] != db.home_shard(user[0]) else ''
+        print(f"ID: {user[0]}, Email: {user[1]}, Username: {user[2]}, Created: {user[3]}, Last Login: {user[4]}, "
+              f"Google ID: {user[5]}, DB: {db.shard_path(user[6])}{pending}")
 
-if __name__ == "__main__":
-    check_db() 
+    # Каталог и шарды смотрятся одинаково; несуществующие файлы не создаются
+    for path in db.shard_paths():
+        if not os.path.exists(path):
+            continue
+        conn = directory if path == db.DB_PATH else db.connect(path)
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*), COUNT(DISTINCT user_id) FROM notes')
+        notes_count, users_count = c.fetchone()
+        print(f"\n=== Заметки: {path} ({os.path.getsize(path)} байт, заметок: {notes_count}, "
+              f"пользователей: {users_count}) ===")
+        c.execute('SELECT id, title, COALESCE(preview, content), created_at, updated_at, user_id FROM notes')
+        for note in c.fetchall():
+            print(f"ID: {note[0]}, Title: {note[1]}, Content: {note[2][:50]}..., Created: {note[3]}, "
+                  f"Updated: {note[4]}, User ID: {note[5]}")
+        if conn is not directory:
+            conn.close()
 
+    directory.close()
+
+if __name__ == "__main__":
+    check_db()
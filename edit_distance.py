@@ -0,0 +1,280 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from instrumentation import FUZZY_WORDS_COMPARED, LEVENSHTEIN_CALLS
+
+# Битовый алгоритм Майерса держит столбец матрицы в одном uint64
+MAX_BIT_PARALLEL_LENGTH = 64
+
+# Символы, у которых lower() даёт несколько символов, получают коды за пределами Unicode
+_special_codes = {}
+
+def levenshtein_distance(s1, s2):
+    if len(s1) < len(s2):
+        return levenshtein_distance(s2, s1)
+
+    if len(s2) == 0:
+        return len(s1)
+
+    previous_row = range(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            insertions = previous_row[j + 1] + 1
+            deletions = current_row[j] + 1
+            substitutions = previous_row[j] + (c1.lower() != c2.lower())
+            current_row.append(min(insertions, deletions, substitutions))
+        previous_row = current_row
+
+    return previous_row[-1]
+
+def bounded_levenshtein(s1, s2, limit):
+    """Расстояние Левенштейна с ранним выходом.
+
+    Считает только полосу шириной limit вокруг диагонали и прекращает работу,
+    как только расстояние гарантированно превысило limit — тогда возвращает limit + 1.
+    """
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    n, m = len(s1), len(s2)
+    over = limit + 1
+
+    if n - m > limit:
+        return over
+    if m == 0:
+        return n
+
+    previous_row = [j if j <= limit else over for j in range(m + 1)]
+    for i in range(1, n + 1):
+        c1 = s1[i - 1]
+        lo = max(1, i - limit)
+        hi = min(m, i + limit)
+        current_row = [over] * (m + 1)
+        if i <= limit:
+            current_row[0] = i
+        row_min = current_row[0]
+
+        for j in range(lo, hi + 1):
+            value = previous_row[j - 1] + (c1 != s2[j - 1])
+            if previous_row[j] + 1 < value:
+                value = previous_row[j] + 1
+            if current_row[j - 1] + 1 < value:
+                value = current_row[j - 1] + 1
+            if value > over:
+                value = over
+            current_row[j] = value
+            if value < row_min:
+                row_min = value
+
+        # Значения в строке не убывают дальше — можно остановиться
+        if row_min > limit:
+            return over
+        previous_row = current_row
+
+    return min(previous_row[m], over)
+
+def char_code(ch):
+    """Код символа без учёта регистра — сравнение как в levenshtein_distance"""
+    lowered = ch.lower()
+    if len(lowered) == 1:
+        return ord(lowered)
+    return _special_codes.setdefault(lowered, 0x110000 + len(_special_codes))
+
+class WordBatch:
+    """Слова, закодированные в матрицу кодов символов для пакетного подсчёта расстояний.
+
+    Ширина матрицы — длина самого длинного слова, поэтому слова длиннее
+    MAX_BIT_PARALLEL_LENGTH (ссылки, base64) в неё не попадают: одно такое слово
+    раздуло бы все строки. Их расстояния считаются по одному, обычным алгоритмом.
+    """
+
+    def __init__(self, words=()):
+        self.words = list(words)
+        self.lengths = [len(word) for word in self.words]
+        # Добавленные слова кодируются пачкой при следующем поиске
+        self.pending = []
+        if np is None:
+            return
+
+        # Номера длинных слов в self.words и номера слов, лежащих в строках матрицы
+        self.long_rows = [row for row, length in enumerate(self.lengths) if length > MAX_BIT_PARALLEL_LENGTH]
+        rows = [row for row, length in enumerate(self.lengths) if length <= MAX_BIT_PARALLEL_LENGTH]
+        self.rows = np.array(rows, dtype=np.int64)
+        self.lengths_array = np.array([self.lengths[row] for row in rows], dtype=np.int32)
+
+        width = int(self.lengths_array.max()) if rows else 0
+        # -1 не совпадает ни с одним кодом символа запроса
+        self.codes = np.full((len(rows), width), -1, dtype=np.int32)
+        for index, row in enumerate(rows):
+            self.codes[index, :self.lengths[row]] = [char_code(ch) for ch in self.words[row]]
+
+    @property
+    def size(self):
+        return len(self.words) + len(self.pending)
+
+    def add(self, word):
+        self.pending.append(word)
+
+    def _flush(self):
+        if not self.pending:
+            return
+        added = WordBatch(self.pending)
+        self.pending = []
+        offset = len(self.words)
+        self.words += added.words
+        self.lengths += added.lengths
+        if np is None:
+            return
+
+        width = max(self.codes.shape[1], added.codes.shape[1])
+        self.codes = np.concatenate([_pad(self.codes, width), _pad(added.codes, width)])
+        self.lengths_array = np.concatenate([self.lengths_array, added.lengths_array])
+        self.rows = np.concatenate([self.rows, added.rows + offset])
+        self.long_rows += [row + offset for row in added.long_rows]
+
+    def search(self, word, threshold):
+        """Пары (слово, расстояние) не дальше threshold — как у BKTree.search"""
+        self._flush()
+        return self.matches(word, threshold)
+
+    def distances(self, query_word, threshold):
+        """Расстояния от всех слов до query_word; всё, что больше threshold, — threshold + 1"""
+        over = threshold + 1
+        FUZZY_WORDS_COMPARED.inc(len(self.words))
+        if np is None or len(query_word) > MAX_BIT_PARALLEL_LENGTH or not self.words:
+            LEVENSHTEIN_CALLS.inc(len(self.words))
+            return [bounded_levenshtein(word.lower(), query_word.lower(), threshold)
+                    for word in self.words]
+
+        # Расстояние не меньше разницы длин — такие слова даже не считаем
+        m = len(query_word)
+        selected = np.flatnonzero(np.abs(self.lengths_array - m) <= threshold)
+        result = np.full(len(self.words), over, dtype=np.int32)
+        if m == 0:
+            result[self.rows[selected]] = self.lengths_array[selected]
+        elif len(selected):
+            LEVENSHTEIN_CALLS.inc(len(selected))
+            codes = self.codes[selected]
+            lengths = self.lengths_array[selected]
+            width = int(lengths.max())
+            scores = _myers(codes[:, :width], lengths, [char_code(ch) for ch in query_word])
+            result[self.rows[selected]] = np.minimum(scores, over)
+
+        # Запрос здесь не длиннее MAX_BIT_PARALLEL_LENGTH, так что длинное слово
+        # может подойти, только если оно длиннее запроса не больше чем на threshold
+        close = [row for row in self.long_rows if self.lengths[row] - m <= threshold]
+        if close:
+            LEVENSHTEIN_CALLS.inc(len(close))
+            for row in close:
+                result[row] = bounded_levenshtein(self.words[row].lower(), query_word.lower(), threshold)
+        return result.tolist()
+
+    def matches(self, query_word, threshold):
+        """Слова не дальше threshold от query_word, от ближних к дальним"""
+        found = [(word, distance)
+                 for word, distance in zip(self.words, self.distances(query_word, threshold))
+                 if distance <= threshold]
+        found.sort(key=lambda match: match[1])
+        return found
+
+def _pad(codes, width):
+    return np.pad(codes, ((0, 0), (0, width - codes.shape[1])), constant_values=-1)
+
+def _myers(codes, lengths, query_codes):
+    """Битовый алгоритм Майерса (вариант Хирё для глобального расстояния) сразу для всех слов.
+
+    Столбец матрицы расстояний по запросу хранится битами приращений в uint64,
+    а цикл идёт только по позициям в словах — каждая итерация обрабатывает все слова.
+    """
+    count, width = codes.shape
+    m = len(query_codes)
+    query = np.array(query_codes, dtype=np.int32)
+    bits = np.left_shift(np.uint64(1), np.arange(m, dtype=np.uint64))
+    one = np.uint64(1)
+    high = np.uint64(1 << (m - 1))
+
+    pv = np.full(count, np.uint64((1 << m) - 1))
+    mv = np.zeros(count, dtype=np.uint64)
+    score = np.full(count, m, dtype=np.int32)
+
+    for j in range(width):
+        active = lengths > j
+        # Битовая маска позиций запроса, где стоит тот же символ, что и j-й символ слова
+        eq = np.bitwise_or.reduce(np.where(codes[:, j, None] == query[None, :], bits, np.uint64(0)), axis=1)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+
+        score += np.where(active, (ph & high != 0).astype(np.int32) - (mh & high != 0), 0).astype(np.int32)
+
+        # Верхняя строка матрицы растёт на единицу с каждым символом слова
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = np.where(active, mh | ~(xv | ph), pv)
+        mv = np.where(active, ph & xv, mv)
+
+    return score
+
+def rank_matches(text, query, threshold=3):
+    """Нечеткий поиск с оценкой: те же правила, что и в fuzzy_search.
+
+    Возвращает None, если текст не подходит, иначе словарь со score от 0 до 1 и
+    найденными словами для каждого слова запроса, от ближних к дальним.
+    """
+    text = text.lower()
+    query = query.lower()
+
+    if query in text:
+        return {'score': 1.0, 'matches': {}}
+
+    query_words = query.split()
+    if not query_words:
+        return {'score': 1.0, 'matches': {}}
+
+    batch = WordBatch(set(text.split()))
+    matches = {}
+    score = 0.0
+    for query_word in query_words:
+        found = batch.matches(query_word, threshold)
+        if not found:
+            return None
+        matches[query_word] = found
+        score += 1 - found[0][1] / (threshold + 1)
+
+    return {'score': score / len(query_words), 'matches': matches}
+
+def highlight_spans(text, query, threshold=3):
+    """Позиции [начало, конец) в text, из-за которых он подошёл под запрос.
+
+    Точное вхождение запроса подсвечивается целиком, иначе — ближайшие слова
+    для каждого слова запроса.
+    """
+    lowered = text.lower()
+    # Позиции ищем в исходном тексте: lower() может изменить длину строки
+    if len(lowered) != len(text):
+        return []
+
+    query = query.lower()
+    if query.strip() and query in lowered:
+        start = lowered.find(query)
+        return [[start, start + len(query)]]
+
+    match = rank_matches(text, query, threshold)
+    if match is None:
+        return []
+
+    closest = set()
+    for found in match['matches'].values():
+        closest.update(word for word, distance in found if distance == found[0][1])
+
+    spans = []
+    pos = 0
+    for word in lowered.split():
+        start = lowered.index(word, pos)
+        pos = start + len(word)
+        if word in closest:
+            spans.append([start, pos])
+    return spans
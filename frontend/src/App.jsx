@@ -9,6 +9,28 @@ import './App.css'
 axios.defaults.withCredentials = true
 
 const API_URL = '/api'
+// Для списка в сайдбаре текст заметок не нужен — он догружается при открытии
+const LIST_FIELDS = 'id,title,created_at,updated_at,author,preview'
+
+// Одна правка вида [позиция, сколько удалить, что вставить]: общий префикс и суффикс
+// сохраняются, меняется только середина. Позиции — в символах Unicode, как на сервере
+const diffText = (oldText, newText) => {
+  const a = Array.from(oldText)
+  const b = Array.from(newText)
+  let start = 0
+  while (start < a.length && start < b.length && a[start] === b[start]) {
+    start++
+  }
+  let end = 0
+  while (end < a.length - start && end < b.length - start &&
+         a[a.length - 1 - end] === b[b.length - 1 - end]) {
+    end++
+  }
+  if (start === a.length && start === b.length) {
+    return []
+  }
+  return [[start, a.length - start - end, b.slice(start, b.length - end).join('')]]
+}
 
 function App() {
   const [notes, setNotes] = useState([])
@@ -17,14 +39,21 @@ function App() {
   const [searchQuery, setSearchQuery] = useState('')
   const [strictSearch, setStrictSearch] = useState(false)
   const [selectedNote, setSelectedNote] = useState(null)
+  // Последняя сохранённая на сервере версия открытой заметки — основа для патчей
+  const [noteBase, setNoteBase] = useState(null)
   const [saveTimeout, setSaveTimeout] = useState(null)
   const [connectionError, setConnectionError] = useState(false)
   const [saveError, setSaveError] = useState(null)
+  // Несохранённые правки, которые разошлись с версией на сервере
+  const [conflict, setConflict] = useState(null)
   const [user, setUser] = useState(null)
   const [isAuthenticated, setIsAuthenticated] = useState(null)
   const [isSidebarOpen, setIsSidebarOpen] = useState(false)
   const [touchStart, setTouchStart] = useState(null)
   const [touchEnd, setTouchEnd] = useState(null)
+  const [syncToken, setSyncToken] = useState(null)
+  // Увеличивается, когда отклонённый сервером поиск пора повторить
+  const [searchRetry, setSearchRetry] = useState(0)
 
   // Минимальное расстояние для свайпа (в пикселях)
   const minSwipeDistance = 50
@@ -112,7 +141,14 @@ function App() {
     } else {
       fetchNotes()
     }
-  }, [searchQuery, strictSearch])
+  }, [searchQuery, strictSearch, searchRetry])
+
+  // При закрытии вкладки просим сервер сразу записать отложенные автосохранения
+  useEffect(() => {
+    const flushSaves = () => navigator.sendBeacon(`${API_URL}/notes/save`)
+    window.addEventListener('pagehide', flushSaves)
+    return () => window.removeEventListener('pagehide', flushSaves)
+  }, [])
 
   useEffect(() => {
     if (saveTimeout) {
@@ -122,10 +158,30 @@ function App() {
     if (title.trim() || content.trim()) {
       const timeout = setTimeout(async () => {
         try {
-          let updatedNote;
           if (selectedNote) {
-            const response = await axios.put(`${API_URL}/notes/${selectedNote.id}`, { title, content })
-            updatedNote = response.data.note
+            let response
+            try {
+              if (noteBase && noteBase.id === selectedNote.id) {
+                // autosave: сервер пишет в базу только последнюю из частых правок
+                response = await axios.patch(`${API_URL}/notes/${selectedNote.id}?autosave=1`, {
+                  base_version: noteBase.version,
+                  title: title !== noteBase.title ? title : undefined,
+                  ops: diffText(noteBase.content, content)
+                })
+              } else {
+                response = await axios.put(`${API_URL}/notes/${selectedNote.id}?autosave=1`, { title, content })
+              }
+            } catch (error) {
+              // Заметку успели изменить в другом месте: чужую правку не затираем,
+              // а показываем последнюю версию и даём вернуть свою
+              if (error.response && error.response.status === 409) {
+                await showConflict(selectedNote.id, { title, content })
+                setSaveError(null)
+                return
+              }
+              throw error
+            }
+            setNoteBase({ id: selectedNote.id, version: response.data.version, title, content })
             // Обновляем заметку в списке без полной перезагрузки
             setNotes(prevNotes => {
               const newNotes = prevNotes.map(note => 
@@ -135,10 +191,11 @@ function App() {
             })
           } else {
             const response = await axios.post(`${API_URL}/notes`, { title, content })
-            updatedNote = response.data.note
-            setSelectedNote(updatedNote)
+            const createdNote = { id: response.data.id, title, content, created_at: new Date().toISOString() }
+            setSelectedNote(createdNote)
+            setNoteBase({ id: createdNote.id, version: response.data.version, title, content })
             // Добавляем новую заметку в список без полной перезагрузки
-            setNotes(prevNotes => sortNotes([updatedNote, ...prevNotes]))
+            setNotes(prevNotes => sortNotes([createdNote, ...prevNotes]))
           }
           setSaveError(null)
         } catch (error) {
@@ -183,15 +240,17 @@ function App() {
 
   const fetchNotes = async () => {
     try {
-      const response = await axios.get(`${API_URL}/notes`)
+      const response = await axios.get(`${API_URL}/notes`, { params: { fields: LIST_FIELDS } })
       setNotes(sortNotes(response.data))  // Применяем сортировку
+      setSyncToken(response.headers['x-sync-token'])
       setConnectionError(false)
     } catch (error) {
       console.error('Ошибка при загрузке заметок:', error)
       if (await handleApiError(error)) {
         try {
-          const retryResponse = await axios.get(`${API_URL}/notes`)
-          setNotes(sortNotes(retryResponse.data))  // Применяем сортировку
+          const retryResponse = await axios.get(`${API_URL}/notes`, { params: { fields: LIST_FIELDS } })
+          setNotes(sortNotes(retryResponse.data))
+          setSyncToken(retryResponse.headers['x-sync-token'])
           setConnectionError(false)
           return
         } catch (retryError) {
@@ -203,21 +262,49 @@ function App() {
     }
   }
 
+  // Догружаем только изменения с момента последней загрузки списка
+  const syncChanges = async () => {
+    if (!syncToken) {
+      return fetchNotes()
+    }
+    try {
+      const response = await axios.get(`${API_URL}/notes/changes`, {
+        params: { since: syncToken, fields: LIST_FIELDS }
+      })
+      const { notes: changed, deleted, token } = response.data
+      setNotes(prevNotes => {
+        const removed = new Set([...deleted, ...changed.map(note => note.id)])
+        return sortNotes([...changed, ...prevNotes.filter(note => !removed.has(note.id))])
+      })
+      setSyncToken(token)
+      setConnectionError(false)
+    } catch (error) {
+      console.error('Ошибка при синхронизации заметок:', error)
+      fetchNotes()
+    }
+  }
+
   const searchNotes = async () => {
     try {
       const response = await axios.get(
         `${API_URL}/notes/search?q=${searchQuery}&strict=${strictSearch}`
       )
-      setNotes(sortNotes(response.data))  // Применяем сортировку
+      setNotes(response.data)  // Сервер уже упорядочил результаты по релевантности
       setConnectionError(false)
     } catch (error) {
+      if (error.response?.status === 429) {
+        // Сервер перегружен поиском: оставляем прежние результаты и повторяем, когда он разрешит
+        const delay = Number(error.response.headers['retry-after'] || 1) * 1000
+        setTimeout(() => setSearchRetry(retry => retry + 1), delay)
+        return
+      }
       console.error('Ошибка при поиске заметок:', error)
       if (await handleApiError(error)) {
         try {
           const retryResponse = await axios.get(
             `${API_URL}/notes/search?q=${searchQuery}&strict=${strictSearch}`
           )
-          setNotes(sortNotes(retryResponse.data))  // Применяем сортировку
+          setNotes(retryResponse.data)
           setConnectionError(false)
           return
         } catch (retryError) {
@@ -241,21 +328,54 @@ function App() {
       if (searchQuery) {
         searchNotes()
       } else {
-        fetchNotes()
+        syncChanges()
       }
     } catch (error) {
       console.error('Ошибка при удалении заметки:', error)
     }
   }
 
-  const selectNote = (note) => {
+  const selectNote = async (note) => {
+    // Список приходит без текста заметок — догружаем текст и версию при открытии
+    try {
+      const response = await axios.get(`${API_URL}/notes/${note.id}`)
+      note = response.data
+    } catch (error) {
+      console.error('Ошибка при загрузке заметки:', error)
+      return
+    }
+    setConflict(null)
+    setNoteBase({ id: note.id, version: note.version, title: note.title, content: note.content })
     setSelectedNote(note)
     setTitle(note.title)
     setContent(note.content)
   }
 
+  // Загружает версию заметки с сервера; local — несохранённые правки, которые можно вернуть
+  const showConflict = async (id, local) => {
+    const response = await axios.get(`${API_URL}/notes/${id}`)
+    const note = response.data
+    setConflict(local)
+    setNoteBase({ id: note.id, version: note.version, title: note.title, content: note.content })
+    setSelectedNote(note)
+    setTitle(note.title)
+    setContent(note.content)
+    setNotes(prevNotes => sortNotes(prevNotes.map(item =>
+      item.id === note.id ? { ...item, title: note.title } : item
+    )))
+  }
+
+  // Возвращает свои правки поверх загруженной версии — автосохранение запишет их
+  const restoreConflict = () => {
+    setTitle(conflict.title)
+    setContent(conflict.content)
+    setConflict(null)
+  }
+
   const startNewNote = () => {
+    setConflict(null)
     setSelectedNote(null)
+    setNoteBase(null)
     setTitle('')
     setContent('')
   }
@@ -310,6 +430,14 @@ function App() {
         </div>
       )}
       
+      {conflict && (
+        <div className="save-error save-conflict">
+          Заметку изменили на другом устройстве — показана последняя версия.
+          <button onClick={restoreConflict}>Вернуть мои правки</button>
+          <button onClick={() => setConflict(null)}>Оставить</button>
+        </div>
+      )}
+      
       <aside className={`sidebar ${isSidebarOpen ? 'open' : ''}`}>
         <div className="sidebar-header">
           {user && (
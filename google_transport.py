@@ -0,0 +1,90 @@
+import os
+import re
+import threading
+import time
+
+import requests
+from google.auth.transport import requests as google_requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Таймауты запросов к Google (секунды)
+GOOGLE_CONNECT_TIMEOUT = float(os.environ.get('GOOGLE_CONNECT_TIMEOUT', '5'))
+GOOGLE_READ_TIMEOUT = float(os.environ.get('GOOGLE_READ_TIMEOUT', '10'))
+# Повторы с экспоненциальной паузой: backoff * 2 ** (номер попытки - 1)
+GOOGLE_RETRIES = int(os.environ.get('GOOGLE_RETRIES', '3'))
+GOOGLE_BACKOFF = 0.2
+# Сколько keep-alive соединений держать к одному хосту
+GOOGLE_POOL_SIZE = 20
+
+_max_age = re.compile(r'max-age=(\d+)')
+
+def new_session():
+    """Сессия с пулом keep-alive соединений и повторами.
+
+    Ошибки соединения повторяются для любых запросов, а ответы 429/5xx — только
+    для GET: код авторизации в POST одноразовый, повторять его обмен нельзя.
+    """
+    retry = Retry(
+        total=GOOGLE_RETRIES,
+        backoff_factor=GOOGLE_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET'}),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=GOOGLE_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+session = new_session()
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', (GOOGLE_CONNECT_TIMEOUT, GOOGLE_READ_TIMEOUT))
+    return session.get(url, **kwargs)
+
+def post(url, **kwargs):
+    kwargs.setdefault('timeout', (GOOGLE_CONNECT_TIMEOUT, GOOGLE_READ_TIMEOUT))
+    return session.post(url, **kwargs)
+
+def cache_max_age(headers):
+    """Срок жизни ответа в секундах из Cache-Control, 0 — не кэшировать"""
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = _max_age.search(cache_control)
+    return int(match.group(1)) if match else 0
+
+class CachingRequest(google_requests.Request):
+    """Транспорт google-auth поверх общей сессии, кэширующий GET-ответы по Cache-Control.
+
+    Так сертификаты Google для проверки id_token скачиваются раз в max-age,
+    а не при каждом входе.
+    """
+
+    def __init__(self, session=session):
+        super().__init__(session=session)
+        self.lock = threading.Lock()
+        # url -> (момент истечения, ответ)
+        self.cache = {}
+
+    def __call__(self, url, method='GET', body=None, headers=None, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (GOOGLE_CONNECT_TIMEOUT, GOOGLE_READ_TIMEOUT)
+        if method != 'GET' or body is not None:
+            return super().__call__(url, method, body, headers, timeout, **kwargs)
+
+        with self.lock:
+            entry = self.cache.get(url)
+        if entry is not None and time.monotonic() < entry[0]:
+            return entry[1]
+
+        response = super().__call__(url, method, body, headers, timeout, **kwargs)
+        max_age = cache_max_age(response.headers)
+        if response.status == 200 and max_age > 0:
+            with self.lock:
+                self.cache[url] = (time.monotonic() + max_age, response)
+        return response
+
+google_request = CachingRequest()
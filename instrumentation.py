@@ -0,0 +1,364 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+from flask import g, request
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+
+# Профилировщик включается, только если задан порог медленного запроса
+PROFILE_SLOW_MS = int(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_INTERVAL_MS = int(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+logger = logging.getLogger('notes.request')
+
+_metrics = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Монотонный счётчик в формате Prometheus"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in sorted(values.items())]
+
+class Gauge:
+    """Текущее значение в формате Prometheus"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in sorted(values.items())]
+
+class Histogram:
+    """Гистограмма с накопительными корзинами в формате Prometheus"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # метки -> [счётчики по корзинам, сумма, количество]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                labels = _format_labels(self.labels, key, [f'le="{bound}"'])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, key, ['le="+Inf"'])
+            lines.append(f'{self.name}_bucket{labels} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+def render_metrics():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+REQUEST_DURATION = Histogram('notes_request_duration_seconds', 'Время обработки запроса',
+                             ('method', 'route', 'status'))
+REQUEST_DB_QUERIES = Histogram('notes_request_db_queries', 'Число SQL-запросов за один HTTP-запрос',
+                               ('route',), QUERY_COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('notes_request_db_seconds', 'Время в SQLite за один HTTP-запрос', ('route',))
+DB_QUERIES = Counter('notes_db_queries_total', 'Выполненные SQL-запросы')
+DB_SECONDS = Counter('notes_db_seconds_total', 'Суммарное время в SQLite')
+FUZZY_WORDS_COMPARED = Counter('notes_fuzzy_words_compared_total', 'Слова, сравненные с запросом нечеткого поиска')
+LEVENSHTEIN_CALLS = Counter('notes_levenshtein_calls_total', 'Вычисленные расстояния Левенштейна')
+AUTOSAVE_COALESCED = Counter('notes_autosave_coalesced_total', 'Автосохранения, заменённые более новыми до записи')
+AUTOSAVE_WRITTEN = Counter('notes_autosave_written_total', 'Записанные отложенные автосохранения')
+AUTOSAVE_CONFLICTS = Counter('notes_autosave_conflicts_total', 'Отложенные автосохранения, не записанные из-за конфликта версий')
+AUTOSAVE_FLUSH_SECONDS = Histogram('notes_autosave_flush_seconds', 'Время записи отложенных автосохранений')
+NOTE_CACHE_HITS = Counter('notes_note_cache_hits_total', 'Запросы, обслуженные кэшем метаданных заметок без сверки с базой')
+NOTE_CACHE_MISSES = Counter('notes_note_cache_misses_total', 'Загрузки и сверки кэша метаданных заметок с базой')
+RESPONSE_BYTES = Counter('notes_response_bytes_total', 'Объём тел JSON-ответов после сжатия', ('encoding',))
+ENCODED_CACHE_HITS = Counter('notes_encoded_cache_hits_total', 'Списки заметок, отданные готовыми байтами')
+ENCODED_CACHE_MISSES = Counter('notes_encoded_cache_misses_total', 'Списки заметок, собранные заново')
+SEARCH_ACTIVE = Gauge('notes_search_active', 'Выполняемые сейчас дорогие поиски')
+SEARCH_QUEUED = Gauge('notes_search_queued', 'Поиски, ждущие места в очереди')
+SEARCH_QUEUE_SECONDS = Histogram('notes_search_queue_seconds', 'Время ожидания поиска в очереди')
+SEARCH_REJECTED = Counter('notes_search_rejected_total', 'Поиски, отклонённые с 429: rate — лимит пользователя, '
+                          'queue_full — очередь полна, timeout — не дождались места', ('reason',))
+
+# Статистика текущего запроса: у каждого потока своя
+_request = threading.local()
+
+def record_query(seconds):
+    DB_QUERIES.inc()
+    DB_SECONDS.inc(seconds)
+    if getattr(_request, 'active', False):
+        _request.db_queries += 1
+        _request.db_seconds += seconds
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий выполнение запросов и чтение результатов"""
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            record_query(time.perf_counter() - start)
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, *args)
+
+    def executescript(self, *args):
+        return self._timed(sqlite3.Cursor.executescript, *args)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _add_db_time(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _add_db_time(time.perf_counter() - start)
+
+def _add_db_time(seconds):
+    # Чтение результата — продолжение уже посчитанного запроса
+    DB_SECONDS.inc(seconds)
+    if getattr(_request, 'active', False):
+        _request.db_seconds += seconds
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого (в том числе из conn.execute) замеряются"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute создаёт курсор в обход cursor(), поэтому переопределяем и его
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись; поля из extra попадают в неё как есть"""
+
+    _standard = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self._standard)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging():
+    """Структурированные логи в stderr, если логирование ещё не настроено"""
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+def fold_stack(frame):
+    """Стек в свёрнутом формате flame graph: внешний;...;внутренний"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class SamplingProfiler:
+    """Семплирующий профилировщик запросов.
+
+    Отдельный поток раз в interval снимает стеки потоков, обрабатывающих запросы.
+    Стеки запросов дольше threshold сохраняются в свёрнутом формате —
+    его понимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, threshold_ms, interval_ms=PROFILE_INTERVAL_MS, directory=PROFILE_DIR):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self.lock = threading.Lock()
+        # id потока -> счётчик стеков
+        self.active = {}
+        self.thread = None
+        self.pid = None
+
+    def _ensure_running(self):
+        # Поток семплирования не переживает fork — запускаем свой в каждом процессе
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, stacks in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[fold_stack(frame)] += 1
+
+    def start(self):
+        with self.lock:
+            self._ensure_running()
+            self.active[threading.get_ident()] = StackCounter()
+
+    def stop(self, route, duration):
+        with self.lock:
+            stacks = self.active.pop(threading.get_ident(), None)
+        if not stacks or duration < self.threshold:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(duration * 1000)}ms-{route.strip('/').replace('/', '_') or 'root'}.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+profiler = SamplingProfiler(PROFILE_SLOW_MS) if PROFILE_SLOW_MS > 0 else None
+
+def _route():
+    # Шаблон маршрута, а не путь: иначе у метрик будет по метке на каждую заметку
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def before_request():
+    g.request_started = time.perf_counter()
+    _request.active = True
+    _request.db_queries = 0
+    _request.db_seconds = 0.0
+    if profiler is not None:
+        profiler.start()
+
+def after_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    route = _route()
+    _request.active = False
+
+    REQUEST_DURATION.observe(duration, method=request.method, route=route, status=response.status_code)
+    REQUEST_DB_QUERIES.observe(_request.db_queries, route=route)
+    REQUEST_DB_SECONDS.observe(_request.db_seconds, route=route)
+
+    profile = profiler.stop(route, duration) if profiler is not None else None
+    logger.info('request', extra={
+        'method': request.method,
+        'route': route,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 3),
+        'db_queries': _request.db_queries,
+        'db_ms': round(_request.db_seconds * 1000, 3),
+        **({'profile': profile} if profile else {})
+    })
+    return response
+
+def teardown_request(exception=None):
+    # Запрос, упавший до after_request, не должен оставаться активным
+    _request.active = False
+    if profiler is not None:
+        profiler.stop('', 0)
+
+def metrics_view():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def init_app(app):
+    configure_logging()
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import sys
+import time
+
+import db
+from note_bodies import preview, save_bodies
+
+# Сколько заметок переносится в одной транзакции
+BATCH_SIZE = 500
+# Пауза между пачками, чтобы запись приложения не ждала миграцию (секунды)
+BATCH_PAUSE = 0.05
+
+def migrate_bodies(path='notes.db', pause=BATCH_PAUSE):
+    conn = sqlite3.connect(path, timeout=5)
+    c = conn.cursor()
+
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_bodies'")
+    if c.fetchone() is None:
+        print(f"{path}: таблица note_bodies не найдена — запустите приложение, чтобы создать схему")
+        conn.close()
+        return
+
+    # Тексты переносятся из notes.content в note_bodies короткими транзакциями.
+    # Словарь пользователя обучается при первой записи его заметок — ещё по несжатым текстам
+    last_id = 0
+    moved = 0
+    while True:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('''
+            SELECT n.id, n.user_id, n.content FROM notes n
+            WHERE n.id > ? AND NOT EXISTS (SELECT 1 FROM note_bodies b WHERE b.note_id = n.id)
+            ORDER BY n.id
+            LIMIT ?
+        ''', (last_id, BATCH_SIZE))
+        rows = c.fetchall()
+        if not rows:
+            conn.commit()
+            break
+
+        by_user = {}
+        for note_id, user_id, content in rows:
+            by_user.setdefault(user_id, []).append((note_id, content))
+        for user_id, notes in by_user.items():
+            save_bodies(c, user_id, notes)
+        # updated_at не меняется: для клиентов и поиска заметка осталась прежней
+        c.executemany("UPDATE notes SET content = '', preview = ? WHERE id = ?",
+                      [(preview(content), note_id) for note_id, _, content in rows])
+        conn.commit()
+        last_id = rows[-1][0]
+        moved += len(rows)
+        print(f"{path}: перенесено заметок: {moved}")
+        time.sleep(pause)
+
+    # Освободившиеся страницы возвращаются в файл базы только после VACUUM
+    conn.close()
+    print(f"{path}: тексты {moved} заметок сжаты и перенесены в note_bodies; чтобы уменьшить файл базы, выполните VACUUM")
+
+if __name__ == "__main__":
+    # Без аргумента — каталог и все шарды
+    for path in sys.argv[1:2] or [path for path in db.shard_paths() if os.path.exists(path)]:
+        migrate_bodies(path)
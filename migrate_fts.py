@@ -0,0 +1,32 @@
+import os
+import sqlite3
+
+import db
+
+def migrate_fts(path='notes.db'):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    if c.fetchone() is None:
+        print(f"{path}: таблица notes_fts не найдена — запустите приложение, чтобы создать схему")
+        conn.close()
+        return
+    
+    # Полностью перестраиваем индекс по содержимому note_terms: заметки без нормализованной
+    # формы в индекс не попадут, поэтому сначала запустите migrate_terms.py
+    c.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+    c.execute("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')")
+    
+    c.execute('SELECT COUNT(*) FROM note_terms')
+    notes_count = c.fetchone()[0]
+    conn.commit()
+    conn.close()
+    
+    print(f"{path}: полнотекстовый индекс перестроен ({notes_count} заметок)")
+
+if __name__ == "__main__":
+    # Каталог и все шарды: в каждой базе свой индекс
+    for path in db.shard_paths():
+        if os.path.exists(path):
+            migrate_fts(path)
@@ -1,31 +1,58 @@
-import sqlite3
+import json
+import time
+
+import db
+from migrate_shards import BATCH_PAUSE, BATCH_SIZE, copy_notes
+
+def migrate_notes(pause=BATCH_PAUSE):
+    directory = db.connect()
+    c = directory.cursor()
 
-def migrate_notes():
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    
     # Находим ID первого созданного пользователя
     c.execute('SELECT id FROM users ORDER BY created_at ASC LIMIT 1')
     first_user = c.fetchone()
-    
+
     if not first_user:
         print("Нет пользователей в базе данных")
-        conn.close()
+        directory.close()
         return
-        
+
     first_user_id = first_user[0]
-    
-    # Обновляем ВСЕ заметки
-    c.execute('''
-        UPDATE notes 
-        SET user_id = ?
-    ''', (first_user_id,))
-    
-    updated_count = c.rowcount
-    conn.commit()
-    conn.close()
-    
+    target_path = db.shard_path(db.user_shard(directory, first_user_id))
+    target = directory if target_path == db.DB_PATH else db.connect(target_path)
+
+    # Заметки переходят пользователю короткими транзакциями в каждой базе:
+    # в его собственной базе меняется владелец, из остальных заметки переносятся к нему
+    updated_count = 0
+    for path in db.shard_paths():
+        conn = target if path == target_path else directory if path == db.DB_PATH else db.connect(path)
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            note_ids = [row[0] for row in conn.execute(
+                'SELECT id FROM notes WHERE user_id IS NOT ? ORDER BY id LIMIT ?', (first_user_id, BATCH_SIZE))]
+            if not note_ids:
+                conn.commit()
+                break
+            ids = json.dumps(note_ids)
+            if conn is target:
+                conn.execute('UPDATE notes SET user_id = ? WHERE id IN (SELECT value FROM json_each(?))',
+                             (first_user_id, ids))
+            else:
+                target.execute('BEGIN IMMEDIATE')
+                copy_notes(conn, target, note_ids, user_id=first_user_id)
+                target.commit()
+                conn.execute('DELETE FROM notes WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+            conn.commit()
+            updated_count += len(note_ids)
+            time.sleep(pause)
+        if conn is not target and conn is not directory:
+            conn.close()
+
+    if target is not directory:
+        target.close()
+    directory.close()
+
     print(f"Все заметки ({updated_count} шт.) перенесены пользователю с ID {first_user_id}")
 
 if __name__ == "__main__":
-    migrate_notes() 
\ No newline at end of file
+    migrate_notes()
@@ -0,0 +1,169 @@
+import json
+import time
+
+import db
+
+# Сколько заметок копируется за один запрос
+BATCH_SIZE = 500
+# Пауза между пользователями, чтобы запись приложения не ждала миграцию (секунды)
+BATCH_PAUSE = 0.05
+
+NOTE_COLUMNS = 'id, title, content, created_at, updated_at, user_id, version, preview'
+
+def copy_dictionaries(src, dst, condition, params):
+    """Копирует словари сжатия с их id: id уникальны во всех базах, а словари не меняются"""
+    rows = src.execute(f'SELECT id, user_id, data, created_at FROM compression_dictionaries WHERE {condition}',
+                       params).fetchall()
+    dst.executemany('''
+        INSERT OR IGNORE INTO compression_dictionaries (id, user_id, data, created_at) VALUES (?, ?, ?, ?)
+    ''', rows)
+
+def copy_notes(src, dst, note_ids, user_id=None, keep_versions=False):
+    """Копирует заметки вместе с текстами и нормализованной формой из src в dst.
+
+    user_id — новый владелец заметок. Версии заметок сохраняются только с keep_versions,
+    иначе их назначают триггеры dst, и клиенты увидят заметки при следующей синхронизации.
+    """
+    for start in range(0, len(note_ids), BATCH_SIZE):
+        ids = json.dumps(note_ids[start:start + BATCH_SIZE])
+        # Остатки прерванного переноса удаляются вместе с текстами и нормализованной формой
+        dst.execute('DELETE FROM notes WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+        copy_dictionaries(src, dst, '''id IN (SELECT dictionary_id FROM note_bodies
+                                              WHERE note_id IN (SELECT value FROM json_each(?)))''', (ids,))
+
+        rows = src.execute(f'SELECT {NOTE_COLUMNS} FROM notes WHERE id IN (SELECT value FROM json_each(?))',
+                           (ids,)).fetchall()
+        if user_id is not None:
+            rows = [row[:5] + (user_id,) + row[6:] for row in rows]
+        dst.executemany(f'INSERT INTO notes ({NOTE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        if keep_versions:
+            # UPDATE только колонки version триггеры не трогают
+            dst.executemany('UPDATE notes SET version = ? WHERE id = ?', [(row[6], row[0]) for row in rows])
+
+        for table, columns in (('note_bodies', 'note_id, dictionary_id, compressed, body'),
+                               ('note_terms', 'note_id, title, content')):
+            rows = src.execute(f'SELECT {columns} FROM {table} WHERE note_id IN (SELECT value FROM json_each(?))',
+                               (ids,)).fetchall()
+            placeholders = ', '.join('?' * len(rows[0])) if rows else ''
+            dst.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows)
+
+        dst.execute('DELETE FROM note_tombstones WHERE note_id IN (SELECT value FROM json_each(?))', (ids,))
+
+def notes_version(conn, user_id):
+    row = conn.execute('SELECT notes_version FROM note_versions WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+def move_user(directory, user_id, source, target, place=True):
+    """Переносит заметки пользователя из шарда source в шард target (None — каталог).
+
+    Источник заблокирован на запись, пока пользователь не переедет, поэтому запись его
+    заметок ждёт переноса, а чтение видит заметки на прежнем месте. С place=True
+    в каталоге меняется users.shard; без него в target дописываются заметки,
+    оставшиеся в source после прерванного переноса.
+    """
+    source_path, target_path = db.shard_path(source), db.shard_path(target)
+    src = directory if source_path == db.DB_PATH else db.connect(source_path)
+    dst = directory if target_path == db.DB_PATH else db.connect(target_path)
+    try:
+        src.execute('BEGIN IMMEDIATE')
+        dst.execute('BEGIN IMMEDIATE')
+
+        note_ids = [row[0] for row in src.execute('SELECT id FROM notes WHERE user_id = ? ORDER BY id', (user_id,))]
+        # Если в target пользователя ещё не было, заметки и удаления переезжают со своими версиями,
+        # и клиентам не нужно заново синхронизировать заметки
+        keep_versions = notes_version(dst, user_id) is None
+        copy_dictionaries(src, dst, 'user_id = ?', (user_id,))
+        copy_notes(src, dst, note_ids, keep_versions=keep_versions)
+
+        version = notes_version(src, user_id) or 0
+        if keep_versions:
+            rows =src.execute('SELECT user_id, note_id, version, deleted_at FROM note_tombstones WHERE user_id = ?',
+                               (user_id,)).fetchall()
+            dst.executemany('''
+                INSERT OR REPLACE INTO note_tombstones (user_id, note_id, version, deleted_at) VALUES (?, ?, ?, ?)
+            ''', rows)
+            dst.execute('INSERT OR REPLACE INTO note_versions (user_id, notes_version) VALUES (?, ?)',
+                        (user_id, version))
+        else:
+            dst.execute('''
+                INSERT INTO note_versions (user_id, notes_version) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET notes_version = MAX(notes_version, excluded.notes_version)
+            ''', (user_id, version))
+
+        if place:
+            # Каталог меняется в той же транзакции, что и база, которая в нём лежит
+            placement = dst if dst is directory else src if src is directory else None
+            if placement is None:
+                dst.commit()
+                directory.execute('UPDATE users SET shard = ? WHERE id = ?', (target, user_id))
+                directory.commit()
+            else:
+                placement.execute('UPDATE users SET shard = ? WHERE id = ?', (target, user_id))
+        if dst.in_transaction:
+            dst.commit()
+
+        src.execute('DELETE FROM notes WHERE user_id = ?', (user_id,))
+        src.execute('DELETE FROM note_tombstones WHERE user_id = ?', (user_id,))
+        src.execute('DELETE FROM note_versions WHERE user_id = ?', (user_id,))
+        # Словарём могут быть сжаты и заметки, переданные другому пользователю
+        src.execute('''
+            DELETE FROM compression_dictionaries WHERE user_id = ?
+            AND id NOT IN (SELECT dictionary_id FROM note_bodies WHERE dictionary_id IS NOT NULL)
+        ''', (user_id,))
+        src.commit()
+        return len(note_ids)
+    except Exception:
+        for conn in (src, dst, directory):
+            if conn.in_transaction:
+                conn.rollback()
+        raise
+    finally:
+        for conn in (src, dst):
+            if conn is not directory:
+                conn.close()
+
+def migrate_shards(pause=BATCH_PAUSE):
+    """Раскладывает пользователей по шардам согласно DB_SHARDS и убирает остатки прерванных переносов"""
+    directory = db.connect()
+    c = directory.cursor()
+
+    c.execute("SELECT 1 FROM pragma_table_info('users') WHERE name = 'shard'")
+    if c.fetchone() is None:
+        print("Колонка users.shard не найдена — запустите приложение, чтобы создать схему")
+        directory.close()
+        return
+
+    c.execute('SELECT id, shard FROM users ORDER BY id')
+    placement = dict(c.fetchall())
+    moved_users = moved_notes = 0
+    for user_id, shard in placement.items():
+        target = db.home_shard(user_id)
+        if shard == target:
+            continue
+        moved_notes += move_user(directory, user_id, shard, target)
+        placement[user_id] = target
+        moved_users += 1
+        print(f"Пользователь {user_id}: {db.shard_path(shard)} -> {db.shard_path(target)}")
+        time.sleep(pause)
+
+    # Заметки, попавшие не в ту базу, дописываются туда, где живёт пользователь
+    stray = 0
+    for shard in [None] + list(range(db.DB_SHARDS)):
+        conn = directory if shard is None else db.connect(db.shard_path(shard))
+        user_ids = [row[0] for row in conn.execute('''
+            SELECT user_id FROM notes WHERE user_id IS NOT NULL
+            UNION SELECT user_id FROM note_versions
+        ''')]
+        if conn is not directory:
+            conn.close()
+        for user_id in user_ids:
+            if user_id in placement and placement[user_id] != shard:
+                stray += move_user(directory, user_id, shard, placement[user_id], place=False)
+                time.sleep(pause)
+
+    directory.close()
+    print(f"Перенесено пользователей: {moved_users}, заметок: {moved_notes}; "
+          f"дописано заметок из прерванных переносов: {stray}")
+
+if __name__ == "__main__":
+    migrate_shards()
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import sys
+import time
+
+import db
+from note_bodies import load_bodies
+from search_index import save_note_terms
+
+# Сколько заметок нормализуется в одной транзакции
+BATCH_SIZE = 500
+# Пауза между пачками, чтобы запись приложения не ждала миграцию (секунды)
+BATCH_PAUSE = 0.05
+
+def migrate_terms(path='notes.db', pause=BATCH_PAUSE):
+    conn = sqlite3.connect(path, timeout=5)
+    c = conn.cursor()
+
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_terms'")
+    if c.fetchone() is None:
+        print(f"{path}: таблица note_terms не найдена — запустите приложение, чтобы создать схему")
+        conn.close()
+        return
+
+    # Идём по id короткими транзакциями: блокировка записи держится только на время одной пачки.
+    # Чтение и запись пачки — в одной транзакции, иначе можно затереть форму,
+    # которую приложение сохранило для только что изменённой заметки
+    last_id = 0
+    filled = 0
+    while True:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('''
+            SELECT n.id, n.title FROM notes n
+            WHERE n.id > ? AND NOT EXISTS (SELECT 1 FROM note_terms t WHERE t.note_id = n.id)
+            ORDER BY n.id
+            LIMIT ?
+        ''', (last_id, BATCH_SIZE))
+        rows = c.fetchall()
+        if not rows:
+            conn.commit()
+            break
+
+        bodies = load_bodies(c, [row[0] for row in rows])
+        save_note_terms(c, [(note_id, title, bodies.get(note_id, '')) for note_id, title in rows])
+        conn.commit()
+        last_id = rows[-1][0]
+        filled += len(rows)
+        print(f"{path}: нормализовано заметок: {filled}")
+        time.sleep(pause)
+
+    conn.close()
+    print(f"{path}: нормализованная форма заполнена для {filled} заметок")
+
+if __name__ == "__main__":
+    # Без аргумента — каталог и все шарды: заметки без нормализованной формы
+    # переезжают в шард как есть
+    for path in sys.argv[1:2] or [path for path in db.shard_paths() if os.path.exists(path)]:
+        migrate_terms(path)
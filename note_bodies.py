@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import zlib
+from collections import Counter, OrderedDict
+
+# Уровень сжатия текстов заметок (1–9)
+BODY_COMPRESSION_LEVEL = int(os.environ.get('BODY_COMPRESSION_LEVEL', '6'))
+# zlib ищет совпадения только в последних 32 КиБ, поэтому словарь длиннее бесполезен
+DICTIONARY_SIZE = 32 * 1024
+# Со скольких заметок пользователю обучается словарь и на скольких он обучается
+DICTIONARY_MIN_NOTES = 20
+DICTIONARY_SAMPLE_NOTES = 500
+# Сколько словарей держит процесс
+DICTIONARY_CACHE_SIZE = 256
+PREVIEW_LENGTH = 200
+
+def preview(content):
+    """Начало текста для списка заметок — хранится рядом с метаданными"""
+    return content[:PREVIEW_LENGTH]
+
+def train_dictionary(texts, size=DICTIONARY_SIZE):
+    """Общий словарь zlib из частых слов и пар слов; самые выгодные — в конце, ближе к тексту"""
+    counts = Counter()
+    for text in texts:
+        words = text.split()
+        counts.update(words)
+        counts.update(' '.join(pair) for pair in zip(words, words[1:]))
+
+    chosen = []
+    total = 0
+    for item, count in sorted(counts.items(), key=lambda entry: entry[1] * len(entry[0]), reverse=True):
+        if count < 2:
+            break
+        length = len(item.encode()) + 1
+        if total + length > size:
+            continue
+        chosen.append(item)
+        total += length
+    return ' '.join(reversed(chosen)).encode()
+
+# Словари не меняются после записи, поэтому кэш не нужно сбрасывать
+_dictionaries = OrderedDict()
+_dictionaries_lock = threading.Lock()
+
+def get_dictionary(c, dictionary_id):
+    with _dictionaries_lock:
+        data = _dictionaries.get(dictionary_id)
+        if data is not None:
+            _dictionaries.move_to_end(dictionary_id)
+            return data
+
+    c.execute('SELECT data FROM compression_dictionaries WHERE id = ?', (dictionary_id,))
+    data = c.fetchone()[0]
+    with _dictionaries_lock:
+        _dictionaries[dictionary_id] = data
+        while len(_dictionaries) > DICTIONARY_CACHE_SIZE:
+            _dictionaries.popitem(last=False)
+    return data
+
+def save_dictionary(c, user_id, texts):
+    """Обучает и сохраняет новый словарь пользователя; им сжимаются следующие записи"""
+    data = train_dictionary(texts)
+    if not data:
+        return None
+    c.execute('INSERT INTO compression_dictionaries (user_id, data) VALUES (?, ?)', (user_id, data))
+    return c.lastrowid
+
+def current_dictionary(c, user_id):
+    """id словаря, которым сжимаются новые тексты пользователя.
+
+    Пока словаря нет, он обучается, как только у пользователя наберётся DICTIONARY_MIN_NOTES заметок.
+    """
+    c.execute('SELECT MAX(id) FROM compression_dictionaries WHERE user_id = ?', (user_id,))
+    dictionary_id = c.fetchone()[0]
+    if dictionary_id is not None:
+        return dictionary_id
+
+    c.execute('SELECT id FROM notes WHERE user_id = ? ORDER BY id DESC LIMIT ?', (user_id, DICTIONARY_SAMPLE_NOTES))
+    ids = [row[0] for row in c.fetchall()]
+    if len(ids) < DICTIONARY_MIN_NOTES:
+        return None
+    return save_dictionary(c, user_id, load_bodies(c, ids).values())
+
+def encode(c, dictionary_id, content):
+    """Текст для note_bodies: (сжат ли, данные). Если сжатие не помогает, текст хранится как есть"""
+    raw = content.encode()
+    if dictionary_id is None:
+        compressor = zlib.compressobj(BODY_COMPRESSION_LEVEL)
+    else:
+        compressor = zlib.compressobj(BODY_COMPRESSION_LEVEL, zdict=get_dictionary(c, dictionary_id))
+    data = compressor.compress(raw) + compressor.flush()
+    if len(data) >= len(raw):
+        return False, raw
+    return True, data
+
+def decode(c, dictionary_id, compressed, data):
+    if not compressed:
+        return data.decode()
+    if dictionary_id is None:
+        return zlib.decompress(data).decode()
+    decompressor = zlib.decompressobj(zdict=get_dictionary(c, dictionary_id))
+    return (decompressor.decompress(data) + decompressor.flush()).decode()
+
+def save_bodies(c, user_id, notes):
+    """Сохраняет тексты заметок пользователя [(id, текст)] сжатыми его текущим словарём"""
+    dictionary_id = current_dictionary(c, user_id)
+    rows = []
+    for note_id, content in notes:
+        compressed, data = encode(c, dictionary_id, content)
+        rows.append((note_id, dictionary_id if compressed else None, compressed, data))
+    c.executemany('''
+        INSERT INTO note_bodies (note_id, dictionary_id, compressed, body) VALUES (?, ?, ?, ?)
+        ON CONFLICT (note_id) DO UPDATE
+        SET dictionary_id = excluded.dictionary_id, compressed = excluded.compressed, body = excluded.body
+    ''', rows)
+
+def load_bodies(c, note_ids):
+    """Тексты заметок: id -> текст. Распаковываются только запрошенные заметки.
+
+    Заметки, ещё не перенесённые migrate_bodies.py, читаются из notes.content.
+    """
+    note_ids = list(note_ids)
+    c.execute('''
+        SELECT note_id, dictionary_id, compressed, body FROM note_bodies
+        WHERE note_id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(note_ids),))
+    bodies = {note_id: decode(c, dictionary_id, compressed, data)
+              for note_id, dictionary_id, compressed, data in c.fetchall()}
+
+    missing = [note_id for note_id in note_ids if note_id not in bodies]
+    if missing:
+        c.execute('SELECT id, content FROM notes WHERE id IN (SELECT value FROM json_each(?))',
+                  (json.dumps(missing),))
+        bodies.update(c.fetchall())
+    return bodies
+
+def load_body(c, note_id):
+    return load_bodies(c, [note_id]).get(note_id, '')
@@ -0,0 +1,354 @@
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from operator import attrgetter
+
+import db
+import instrumentation
+from note_bodies import PREVIEW_LENGTH
+
+# Сколько памяти процесса отдаётся под метаданные заметок (байты); 0 — кэш выключен
+NOTE_CACHE_BYTES = int(os.environ.get('NOTE_CACHE_BYTES', str(64 * 1024 * 1024)))
+# Как часто запись кэша сверяется с базой (миллисекунды). Записи этого процесса попадают
+# в кэш сразу, а сверка нужна для записей других процессов и скриптов миграции
+NOTE_CACHE_CHECK_MS = int(os.environ.get('NOTE_CACHE_CHECK_MS', '1000'))
+# Пользователь, чьи заметки занимают больше этой доли кэша, не кэшируется
+NOTE_CACHE_MAX_USER_SHARE = 4
+# Сколько слишком больших пользователей помнится и через сколько секунд их можно загрузить снова
+NOTE_CACHE_OVERSIZED = 1024
+NOTE_CACHE_OVERSIZED_RETRY = 60
+
+# Число общих между процессами счётчиков изменений; пользователи распределяются по ним по id
+NOTE_CACHE_GENERATIONS = 65536
+
+# Поля заметки, которые можно отдать из кэша
+CACHED_FIELDS = frozenset(('id', 'title', 'created_at', 'updated_at', 'author', 'preview', 'version'))
+
+NOTE_COLUMNS = f'id, title, created_at, updated_at, version, COALESCE(preview, substr(content, 1, {PREVIEW_LENGTH}))'
+
+class NoteMeta:
+    """Метаданные заметки. Не меняются: при записи заметки создаётся новая запись"""
+
+    __slots__ = ('id', 'title', 'created_at', 'updated_at', 'version', 'preview', 'size')
+
+    def __init__(self, note_id, title, created_at, updated_at, version, preview):
+        self.id = note_id
+        self.title = title
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.version = version
+        self.preview = preview
+        self.size = sys.getsizeof(self) + sum(sys.getsizeof(value) for value in
+                                              (title, created_at, updated_at, preview))
+
+class UserEntry:
+    """Профиль пользователя и метаданные всех его заметок на версию version"""
+
+    __slots__ = ('user_id', 'email', 'username', 'created_at', 'shard', 'version', 'base_version',
+                 'notes', 'deleted', 'ordered', 'size', 'checked', 'stale', 'generation')
+
+    def __init__(self, user_id, profile, version):
+        self.user_id = user_id
+        self.email, self.username, self.created_at, self.shard = profile
+        self.version = version
+        # С этой версии известны все удаления — по ним выдаются изменения
+        self.base_version = version
+        self.notes = {}
+        # id удалённой заметки -> версия удаления
+        self.deleted = {}
+        # Заметки в порядке списка; строится при первом чтении после изменения
+        self.ordered = None
+        self.size = sys.getsizeof(self) + sum(sys.getsizeof(value) for value in profile)
+        self.checked = time.monotonic()
+        self.stale = False
+        # Значение общего счётчика изменений пользователя, с которым сверена запись
+        self.generation = None
+
+    def put(self, note):
+        old = self.notes.get(note.id)
+        if old is not None:
+            self.size -= old.size
+        self.notes[note.id] = note
+        self.size += note.size
+        if self.deleted.pop(note.id, None) is not None:
+            self.size -= DELETED_SIZE
+        self.ordered = None
+
+    def remove(self, note_id, version):
+        old = self.notes.pop(note_id, None)
+        if old is not None:
+            self.size -= old.size
+        if note_id not in self.deleted:
+            self.size += DELETED_SIZE
+        self.deleted[note_id] = version
+        self.ordered = None
+
+    def rows(self, notes, fields):
+        """Значения полей заметок кортежами в порядке fields"""
+        # attrgetter читает все поля за один вызов; на месте автора — id, его заменяет имя
+        # пользователя. Лишний id в конце делает результат кортежем и для одного поля
+        get = attrgetter(*('id' if field == 'author' else field for field in fields), 'id')
+        rows = [get(note)[:-1] for note in notes]
+        if 'author' in fields:
+            index = fields.index('author')
+            rows = [row[:index] + (self.username,) + row[index + 1:] for row in rows]
+        return rows
+
+    def page(self, fields, cursor=None, limit=None):
+        """Строки страницы списка в порядке (updated_at DESC, id) и позиция последней заметки, если есть ещё"""
+        ordered = self.ordered
+        if ordered is None:
+            # Сортировки устойчивы: сначала по id, потом по убыванию updated_at
+            ordered = sorted(self.notes.values(), key=lambda note: note.id)
+            ordered.sort(key=lambda note: note.updated_at or '', reverse=True)
+            self.ordered = ordered
+
+        notes = ordered
+        if cursor is not None:
+            updated_at, last_id = cursor
+            notes = [note for note in ordered
+                     if (note.updated_at or '') < updated_at or (note.updated_at == updated_at and note.id > last_id)]
+        next_cursor = None
+        if limit and len(notes) > limit:
+            notes = notes[:limit]
+            next_cursor = (notes[-1].updated_at, notes[-1].id)
+        return self.rows(notes, fields), next_cursor
+
+    def changes(self, fields, since):
+        """Заметки, изменённые после версии since, и id удалённых — как в /api/notes/changes"""
+        notes = sorted((note for note in self.notes.values() if note.version > since),
+                       key=lambda note: note.version)
+        deleted = sorted((version, note_id) for note_id, version in self.deleted.items() if version > since)
+        return ([dict(zip(fields, row)) for row in self.rows(notes, fields)],
+                [note_id for _, note_id in deleted])
+
+# Сколько примерно занимает одна запись об удалении
+DELETED_SIZE = 100
+
+class Generations:
+    """Счётчики изменений заметок в общей памяти процессов, форкнутых от одного мастера (serve.py).
+
+    Процесс, записавший заметки пользователя, увеличивает его счётчик, а остальные
+    при следующем чтении видят, что их запись кэша устарела, не дожидаясь сверки
+    по времени. Несколько пользователей могут делить счётчик — это лишь лишние сверки.
+    """
+
+    def __init__(self, slots=NOTE_CACHE_GENERATIONS):
+        self.slots = slots
+        # Анонимное отображение остаётся общим после fork
+        self.counters = mmap.mmap(-1, slots * 8)
+        self.lock = multiprocessing.Lock()
+
+    def get(self, user_id):
+        return struct.unpack_from('q', self.counters, user_id % self.slots * 8)[0]
+
+    def bump(self, user_id):
+        """Увеличивает счётчик пользователя и возвращает (прежнее значение, новое)"""
+        offset = user_id % self.slots * 8
+        with self.lock:
+            value = struct.unpack_from('q', self.counters, offset)[0]
+            struct.pack_into('q', self.counters, offset, value + 1)
+        return value, value + 1
+
+class NoteCache:
+    """LRU-кэш метаданных заметок и профилей активных пользователей с вытеснением по объёму.
+
+    Записи процесса обновляют кэш сразу после коммита. Если версия записи не следует
+    за версией кэша (заметки менял другой процесс), запись кэша помечается устаревшей
+    и при следующем чтении догружает изменения по notes.version и note_tombstones.
+    """
+
+    def __init__(self, max_bytes=NOTE_CACHE_BYTES, check_ms=NOTE_CACHE_CHECK_MS):
+        self.max_bytes = max_bytes
+        self.check = check_ms / 1000
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+        self.size = 0
+        self.oversized = OrderedDict()
+        self.generations = Generations()
+
+    def get(self, user_id):
+        """Запись пользователя, сверенная с базой не раньше чем NOTE_CACHE_CHECK_MS назад
+        и без изменений из соседних рабочих процессов с тех пор.
+
+        None — кэш выключен, пользователя нет или его заметки не помещаются в кэш.
+        Вызывается внутри запроса: сверка идёт через соединения запроса.
+        """
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            skipped = self.oversized.get(user_id)
+            if skipped is not None and time.monotonic() - skipped < NOTE_CACHE_OVERSIZED_RETRY:
+                return None
+            entry = self.users.get(user_id)
+            if entry is not None:
+                self.users.move_to_end(user_id)
+                if (not entry.stale and time.monotonic() - entry.checked < self.check
+                        and entry.generation == self.generations.get(user_id)):
+                    instrumentation.NOTE_CACHE_HITS.inc()
+                    return entry
+        instrumentation.NOTE_CACHE_MISSES.inc()
+
+        row = db.get_db().execute('SELECT email, username, created_at, shard FROM users WHERE id = ?',
+                                  (user_id,)).fetchone()
+        if row is None:
+            self.evict(user_id)
+            return None
+        if entry is not None and entry.shard != row[3]:
+            # Заметки пользователя переехали в другой шард
+            self.evict(user_id)
+            entry = None
+        return self._load(user_id, tuple(row), entry)
+
+    def _load(self, user_id, profile, entry, conn=None):
+        if conn is None:
+            conn = db.get_shard_db(profile[3])
+        # Счётчик читается до снимка: изменения после него вызовут новую сверку
+        generation = self.generations.get(user_id)
+        c = conn.cursor()
+        # Версия и заметки — из одного снимка базы
+        c.execute('BEGIN')
+        try:
+            c.execute('SELECT notes_version FROM note_versions WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
+            version = row[0] if row else 0
+            if entry is None:
+                c.execute(f'SELECT {NOTE_COLUMNS} FROM notes WHERE user_id = ?', (user_id,))
+                rows, deleted = c.fetchall(), []
+            elif version != entry.version:
+                c.execute(f'SELECT {NOTE_COLUMNS} FROM notes WHERE user_id = ? AND version > ?',
+                          (user_id, entry.version))
+                rows = c.fetchall()
+                c.execute('SELECT note_id, version FROM note_tombstones WHERE user_id = ? AND version > ?',
+                          (user_id, entry.version))
+                deleted = c.fetchall()
+            else:
+                rows = deleted = []
+        finally:
+            conn.commit()
+
+        with self.lock:
+            if entry is None:
+                entry = UserEntry(user_id, profile, version)
+                entry.generation = generation
+                for row in rows:
+                    entry.put(NoteMeta(*row))
+                if self._oversized(entry):
+                    return None
+                current = self.users.get(user_id)
+                if current is not None and current.version > version:
+                    # Пока мы читали, запись этого процесса уже обновила кэш
+                    return current
+                self._replace(user_id, entry)
+            elif self.users.get(user_id) is entry and entry.version <= version:
+                entry.email, entry.username, entry.created_at, entry.shard = profile
+                self.size -= entry.size
+                for note_id, deleted_version in deleted:
+                    entry.remove(note_id, deleted_version)
+                for row in rows:
+                    entry.put(NoteMeta(*row))
+                entry.version = version
+                entry.stale = False
+                entry.generation = generation
+                self.size += entry.size
+                if self._oversized(entry):
+                    return None
+            entry.checked = time.monotonic()
+            self._evict()
+        return entry
+
+    def _oversized(self, entry):
+        if entry.size * NOTE_CACHE_MAX_USER_SHARE <= self.max_bytes:
+            return False
+        if self.users.get(entry.user_id) is entry:
+            del self.users[entry.user_id]
+            self.size -= entry.size
+        self.oversized[entry.user_id] = time.monotonic()
+        self.oversized.move_to_end(entry.user_id)
+        while len(self.oversized) > NOTE_CACHE_OVERSIZED:
+            self.oversized.popitem(last=False)
+        return True
+
+    def _replace(self, user_id, entry):
+        old = self.users.pop(user_id, None)
+        if old is not None:
+            self.size -= old.size
+        self.users[user_id] = entry
+        self.size += entry.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.users:
+            _, entry = self.users.popitem(last=False)
+            self.size -= entry.size
+
+    def evict(self, user_id):
+        with self.lock:
+            entry = self.users.pop(user_id, None)
+            if entry is not None:
+                self.size -= entry.size
+            self.oversized.pop(user_id, None)
+
+    def _write(self, user_id, version, update):
+        previous, generation = self.generations.bump(user_id)
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None:
+                return
+            if version <= entry.version:
+                # Запись уже догружена из базы
+                return
+            if entry.stale or version != entry.version + 1:
+                # Между версиями кэша и записи были чужие изменения — догрузим их при чтении
+                entry.stale = True
+                return
+            self.size -= entry.size
+            update(entry)
+            entry.version = version
+            if entry.generation == previous:
+                entry.generation = generation
+            self.size += entry.size
+            self._evict()
+
+    def write_note(self, user_id, version, note_id, title, updated_at, preview, created_at=None):
+        """Записывает в кэш созданную или изменённую заметку; version — версия после записи"""
+        def update(entry):
+            old = entry.notes.get(note_id)
+            if old is None and created_at is None:
+                entry.stale = True
+                return
+            entry.put(NoteMeta(note_id, title, created_at or old.created_at, updated_at, version, preview))
+        self._write(user_id, version, update)
+
+    def delete_note(self, user_id, version, note_id):
+        """Убирает из кэша удалённую заметку; version — версия после удаления"""
+        self._write(user_id, version, lambda entry: entry.remove(note_id, version))
+
+    def sync(self, conn, user_id):
+        """Догружает в кэш изменения, записанные через conn, — после пакетных записей"""
+        self.generations.bump(user_id)
+        with self.lock:
+            entry = self.users.get(user_id)
+        if entry is not None:
+            self._load(user_id, (entry.email, entry.username, entry.created_at, entry.shard), entry, conn)
+
+    def page(self, entry, fields, cursor=None, limit=None):
+        """Страница списка заметок из записи кэша: (строки заметок, позиция для следующей страницы, версия)"""
+        with self.lock:
+            return entry.page(fields, cursor, limit) + (entry.version,)
+
+    def changes(self, entry, fields, since):
+        """Изменения после версии since из записи кэша: (заметки, удалённые id, версия).
+        None — удаления до since кэшу неизвестны"""
+        with self.lock:
+            if since is None:
+                return entry.changes(fields, -1)[0], [], entry.version
+            if since < entry.base_version:
+                return None
+            return entry.changes(fields, since) + (entry.version,)
+
+note_cache = NoteCache()
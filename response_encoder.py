@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import instrumentation
+
+# JSON-ответы меньше этого размера (байты) не сжимаются: выигрыш меньше заголовков
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+RESPONSE_GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', '6'))
+RESPONSE_BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', '5'))
+# Сколько памяти процесса отдаётся под готовые тела списков заметок (байты); 0 — кэш выключен
+ENCODED_CACHE_BYTES = int(os.environ.get('ENCODED_CACHE_BYTES', str(32 * 1024 * 1024)))
+# Кэшируются только списки не меньше этого размера до сжатия: маленькие дешевле собрать заново
+ENCODED_CACHE_MIN_BYTES = int(os.environ.get('ENCODED_CACHE_MIN_BYTES', str(16 * 1024)))
+
+# Сжатия в порядке предпочтения; brotli — если установлен
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def dumps(obj):
+    """JSON в байтах: orjson, если установлен, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+def encode_rows(fields, rows):
+    """Массив объектов из кортежей значений полей в порядке fields.
+
+    Словари собираются здесь, прямо перед сериализацией: с orjson это быстрее,
+    чем кодировать значения по одному и склеивать объекты из кусков.
+    """
+    return dumps([dict(zip(fields, row)) for row in rows])
+
+class JSONProvider(DefaultJSONProvider):
+    """jsonify через orjson, если он установлен; иначе — стандартный провайдер Flask"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._dumps(obj).decode()
+
+    def _dumps(self, obj):
+        # Даты и прочие типы, которые orjson кодирует иначе, сериализуются как во Flask
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._dumps(obj) + b'\n', mimetype=self.mimetype)
+
+def accepted_encoding():
+    """Сжатие для ответа на текущий запрос по Accept-Encoding или None"""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=RESPONSE_BROTLI_QUALITY)
+    compressor = zlib.compressobj(RESPONSE_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def encode_body(data, encoding):
+    """Тело ответа из JSON data: (байты, применённое сжатие или None)"""
+    if encoding is None or len(data) < RESPONSE_COMPRESS_MIN_BYTES:
+        return data, None
+    return compress(data, encoding), encoding
+
+def json_response(body, content_encoding=None):
+    """Ответ с готовым телом; content_encoding — если body уже сжато"""
+    response = current_app.response_class(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    return response
+
+def compress_response(response):
+    """Сжимает JSON-ответы jsonify, если клиент это принимает"""
+    if (response.mimetype != 'application/json' or response.is_streamed
+            or response.direct_passthrough or response.status_code != 200):
+        return response
+    encoding = response.headers.get('Content-Encoding')
+    if encoding is None and response.content_length >= RESPONSE_COMPRESS_MIN_BYTES:
+        response.vary.add('Accept-Encoding')
+        body, encoding = encode_body(response.get_data(), accepted_encoding())
+        if encoding is not None:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = encoding
+    if encoding is not None:
+        # Сжатое представление побайтно отличается от несжатого, поэтому валидатор — слабый
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+    instrumentation.RESPONSE_BYTES.inc(response.content_length, encoding=encoding or 'identity')
+    return response
+
+class EncodedCache:
+    """Готовые тела больших списков заметок по ключу (пользователь, запрос, сжатие).
+
+    Записи пользователя действительны для одной версии его заметок: при первом
+    обращении с новой версией старые записи удаляются. Вытесняются записи,
+    к которым дольше всех не обращались.
+    """
+
+    def __init__(self, max_bytes=ENCODED_CACHE_BYTES, min_bytes=ENCODED_CACHE_MIN_BYTES):
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.lock = threading.Lock()
+        # ключ -> (тело, его сжатие, курсор следующей страницы)
+        self.entries = OrderedDict()
+        # id пользователя -> (версия заметок, ключи его записей)
+        self.users = {}
+        self.size = 0
+
+    def _user_keys(self, user_id, version):
+        user = self.users.get(user_id)
+        if user is None or user[0] != version:
+            if user is not None:
+                for key in user[1]:
+                    self._remove(key)
+            user = self.users[user_id] = (version, set())
+        return user[1]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def get(self, user_id, version, key):
+        if self.max_bytes <= 0:
+            return None
+        key = (user_id,) + key
+        with self.lock:
+            user = self.users.get(user_id)
+            entry = self.entries.get(key) if user is not None and user[0] == version else None
+            if entry is None:
+                instrumentation.ENCODED_CACHE_MISSES.inc()
+                return None
+            self.entries.move_to_end(key)
+        instrumentation.ENCODED_CACHE_HITS.inc()
+        return entry
+
+    def put(self, user_id, version, key, data, body, content_encoding, next_cursor):
+        """Запоминает body, если несжатый JSON data достаточно велик"""
+        if len(data) < self.min_bytes or len(body) > self.max_bytes:
+            return
+        key = (user_id,) + key
+        with self.lock:
+            # Запись для старой версии, пришедшая после записи для новой, не нужна
+            user = self.users.get(user_id)
+            if user is not None and user[0] > version:
+                return
+            keys = self._user_keys(user_id, version)
+            self._remove(key)
+            self.entries[key] = (body, content_encoding, next_cursor)
+            self.size += len(body)
+            keys.add(key)
+
+            while self.size > self.max_bytes:
+                old_key, (old_body, _, _) = self.entries.popitem(last=False)
+                self.size -= len(old_body)
+                user = self.users.get(old_key[0])
+                if user is not None:
+                    user[1].discard(old_key)
+                    if not user[1]:
+                        del self.users[old_key[0]]
+
+encoded_cache = EncodedCache()
+
+def init_app(app):
+    app.json = JSONProvider(app)
+    app.after_request(compress_response)
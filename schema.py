@@ -0,0 +1,267 @@
+import os
+
+import db
+
+def run_migrations(conn, migrations, shard=None):
+    """Применяет к базе миграции, которых в ней ещё нет, и возвращает их число.
+
+    Номер последней применённой миграции хранится в PRAGMA user_version, поэтому
+    при обычном запуске проверка схемы — это одно чтение заголовка базы. Миграции
+    идут в одной транзакции записи: процесс, запущенный одновременно, дождётся её
+    и увидит уже новую версию.
+    """
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(migrations):
+        return 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        c = conn.cursor()
+        for number, migration in enumerate(migrations[version:], version + 1):
+            migration(c, shard)
+            conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return max(len(migrations) - version, 0)
+
+def add_column(c, table, column, definition):
+    """Добавляет колонку в существующую таблицу, если её ещё нет"""
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def replace_trigger(c, name, sql):
+    """Создаёт триггер или пересоздаёт его, если в базе он объявлен по-другому"""
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,))
+    row = c.fetchone()
+    if row is not None and row[0].split() == sql.split():
+        return
+    c.execute(f'DROP TRIGGER IF EXISTS main.{name}')
+    c.execute(sql)
+
+def init_notes_schema(c, shard=None):
+    """Таблицы заметок: одинаковы в каталоге и в каждом шарде"""
+    # Таблица заметок
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS notes
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         title TEXT NOT NULL,
+         content TEXT NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         user_id INTEGER,
+         FOREIGN KEY (user_id) REFERENCES users(id))
+    ''')
+    
+    # Индекс под постраничную выдачу списка заметок пользователя
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notes_user_updated
+        ON notes (user_id, updated_at DESC, id)
+    ''')
+    
+    # Счётчик изменений: note_versions.notes_version растёт при любом изменении заметок пользователя,
+    # а в notes.version записывается его значение на момент последнего изменения заметки.
+    # Счётчик лежит в той же базе, что и заметки: триггеры не видят подключённый каталог
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS note_versions
+        (user_id INTEGER PRIMARY KEY,
+         notes_version INTEGER NOT NULL DEFAULT 0)
+    ''')
+    add_column(c, 'notes', 'version', 'INTEGER NOT NULL DEFAULT 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_notes_user_version ON notes (user_id, version)')
+    # Индекс по user_id упорядочен ещё и по rowid — на нём экспорт идёт по возрастанию id
+    c.execute('CREATE INDEX IF NOT EXISTS idx_notes_user ON notes (user_id)')
+    
+    # Удалённые заметки, чтобы клиенты узнавали об удалении при синхронизации
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS note_tombstones
+        (user_id INTEGER NOT NULL,
+         note_id INTEGER NOT NULL,
+         version INTEGER NOT NULL,
+         deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         PRIMARY KEY (user_id, note_id))
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_note_tombstones_version ON note_tombstones (user_id, version)')
+    
+    # Нормализованные заголовок и текст (search_index.normalize_text): поиск читает их,
+    # а не исходный текст. Пишет их приложение; триггеры лишь убирают устаревшие строки,
+    # так что заметки, изменённые в обход приложения, поиск нормализует сам.
+    # Для существующих баз строки заполняет migrate_terms.py
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS note_terms
+        (note_id INTEGER PRIMARY KEY,
+         title TEXT NOT NULL,
+         content TEXT NOT NULL)
+    ''')
+    replace_trigger(c, 'note_terms_au', '''
+        CREATE TRIGGER note_terms_au AFTER UPDATE OF title, updated_at ON notes BEGIN
+            DELETE FROM note_terms WHERE note_id = new.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_terms_ad AFTER DELETE ON notes BEGIN
+            DELETE FROM note_terms WHERE note_id = old.id;
+        END
+    ''')
+    
+    # Полнотекстовый индекс по нормализованным заметкам. Триграммный токенизатор ищет
+    # подстроки; отдельной копии текста индекс не хранит — берёт его из note_terms
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    row = c.fetchone()
+    if row is not None and "content='note_terms'" not in row[0]:
+        # Прежний индекс читал текст из notes.content, который теперь пуст
+        for trigger in ('notes_fts_ai', 'notes_fts_ad', 'notes_fts_au'):
+            c.execute(f'DROP TRIGGER IF EXISTS main.{trigger}')
+        c.execute('DROP TABLE main.notes_fts')
+        row = None
+    fts_exists = row is not None
+    
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts
+        USING fts5(title, content, content='note_terms', content_rowid='note_id', tokenize='trigram')
+    ''')
+    
+    # Триггеры держат индекс в синхронизации с note_terms
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_terms_fts_ai AFTER INSERT ON note_terms BEGIN
+            INSERT INTO notes_fts (rowid, title, content) VALUES (new.note_id, new.title, new.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_terms_fts_ad AFTER DELETE ON note_terms BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, content)
+            VALUES ('delete', old.note_id, old.title, old.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_terms_fts_au AFTER UPDATE ON note_terms BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, content)
+            VALUES ('delete', old.note_id, old.title, old.content);
+            INSERT INTO notes_fts (rowid, title, content) VALUES (new.note_id, new.title, new.content);
+        END
+    ''')
+    
+    # Для существующих баз индекс строится один раз по уже нормализованным заметкам
+    if not fts_exists:
+        c.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+    
+    # Тексты заметок хранятся отдельно от метаданных и сжимаются zlib с общим словарём
+    # пользователя (note_bodies.py), поэтому списки заметок не читают страницы с текстами.
+    # В notes остаётся начало текста для списка; notes.content у новых заметок пуст,
+    # а у существующих баз его переносит migrate_bodies.py
+    add_column(c, 'notes', 'preview', 'TEXT')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS compression_dictionaries
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         user_id INTEGER NOT NULL,
+         data BLOB NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_compression_dictionaries_user ON compression_dictionaries (user_id)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS note_bodies
+        (note_id INTEGER PRIMARY KEY,
+         dictionary_id INTEGER,
+         compressed INTEGER NOT NULL,
+         body BLOB NOT NULL)
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_bodies_ad AFTER DELETE ON notes BEGIN
+            DELETE FROM note_bodies WHERE note_id = old.id;
+        END
+    ''')
+    
+    replace_trigger(c, 'notes_version_ai', '''
+        CREATE TRIGGER notes_version_ai AFTER INSERT ON notes BEGIN
+            INSERT OR IGNORE INTO note_versions (user_id) SELECT new.user_id WHERE new.user_id IS NOT NULL;
+            UPDATE note_versions SET notes_version = notes_version + 1 WHERE user_id = new.user_id;
+            UPDATE notes SET version = COALESCE((SELECT notes_version FROM note_versions WHERE user_id = new.user_id), 0)
+            WHERE id = new.id;
+        END
+    ''')
+    # Текст заметки меняется вместе с updated_at; notes.content больше не пишется
+    replace_trigger(c, 'notes_version_au', '''
+        CREATE TRIGGER notes_version_au AFTER UPDATE OF title, updated_at, user_id ON notes BEGIN
+            INSERT OR IGNORE INTO note_versions (user_id) SELECT new.user_id WHERE new.user_id IS NOT NULL;
+            UPDATE note_versions SET notes_version = notes_version + 1 WHERE user_id = new.user_id;
+            UPDATE notes SET version = COALESCE((SELECT notes_version FROM note_versions WHERE user_id = new.user_id), 0)
+            WHERE id = new.id;
+            DELETE FROM note_tombstones WHERE user_id = new.user_id AND note_id = new.id;
+            -- Для прежнего владельца перенесённая заметка выглядит как удалённая
+            UPDATE note_versions SET notes_version = notes_version + 1
+            WHERE user_id = old.user_id AND old.user_id IS NOT new.user_id;
+            INSERT OR REPLACE INTO note_tombstones (user_id, note_id, version)
+            SELECT old.user_id, old.id, notes_version FROM note_versions
+            WHERE user_id = old.user_id AND old.user_id IS NOT new.user_id;
+        END
+    ''')
+    replace_trigger(c, 'notes_version_ad', '''
+        CREATE TRIGGER notes_version_ad AFTER DELETE ON notes BEGIN
+            UPDATE note_versions SET notes_version = notes_version + 1 WHERE user_id = old.user_id;
+            INSERT OR REPLACE INTO note_tombstones (user_id, note_id, version)
+            SELECT old.user_id, old.id, notes_version FROM note_versions WHERE user_id = old.user_id;
+        END
+    ''')
+    
+    # id заметок и словарей шарда начинаются с его собственного диапазона,
+    # поэтому они не пересекаются между базами и не меняются при переносе пользователя
+    base = db.shard_id_base(shard)
+    if base:
+        for table in ('notes', 'compression_dictionaries'):
+            c.execute('''
+                INSERT INTO main.sqlite_sequence (name, seq)
+                SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM main.sqlite_sequence WHERE name = ?)
+            ''', (table, base, table))
+
+
+def init_directory_schema(c, shard=None):
+    """Каталог: пользователи и заметки тех, кто ещё не распределён по шардам"""
+    # Таблица пользователей
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         email TEXT UNIQUE NOT NULL,
+         username TEXT NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         last_login TIMESTAMP,
+         google_id TEXT UNIQUE)
+    ''')
+    # Шард с заметками пользователя; NULL — заметки лежат в самом каталоге
+    add_column(c, 'users', 'shard', 'INTEGER')
+    
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_versions'")
+    versions_exist = c.fetchone() is not None
+    init_notes_schema(c)
+    # Раньше счётчик изменений хранился в users.notes_version
+    c.execute('PRAGMA table_info(users)')
+    if not versions_exist and 'notes_version' in [row[1] for row in c.fetchall()]:
+        c.execute('INSERT INTO note_versions (user_id, notes_version) SELECT id, notes_version FROM users')
+
+# Миграции по порядку: номер миграции — её позиция в списке, начиная с 1. Первая приводит
+# к текущей схеме и новую базу, и базу, созданную до появления user_version. Новые изменения
+# схемы добавляются в конец списка, уже выпущенные миграции не меняются
+DIRECTORY_MIGRATIONS = (
+    init_directory_schema,
+)
+SHARD_MIGRATIONS = (
+    init_notes_schema,
+)
+
+def migrate():
+    """Доводит до текущей схемы каталог и все шарды"""
+    conn = db.connect()
+    try:
+        run_migrations(conn, DIRECTORY_MIGRATIONS)
+    finally:
+        conn.close()
+    
+    # Шарды с заметками: у каждого своя блокировка записи и свой файл для резервных копий
+    if db.DB_SHARDS:
+        os.makedirs(db.DB_SHARD_DIR, exist_ok=True)
+    for shard in range(db.DB_SHARDS):
+        conn = db.connect(db.shard_path(shard))
+        try:
+            run_migrations(conn, SHARD_MIGRATIONS, shard)
+        finally:
+            conn.close()
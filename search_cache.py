@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import OrderedDict
+
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '1024'))
+
+def normalize_query(query):
+    # Оба режима поиска регистронезависимы
+    return query.lower()
+
+def extends(query, base, strict):
+    """Можно ли искать query только среди результатов base.
+
+    Строгий поиск — это поиск подстроки, поэтому достаточно, чтобы base входил в query.
+    Для нечеткого ещё нужно, чтобы все слова base были словами query: расстояние
+    до недописанного слова может только вырасти.
+    """
+    if base not in query:
+        return False
+    if strict:
+        return True
+    return set(base.split()) <= set(query.split())
+
+class SearchCache:
+    """LRU-кэш результатов поиска по ключу (пользователь, запрос, режим, версия заметок).
+
+    Вместе с отданной клиенту выдачей хранится множество id всех найденных заметок —
+    по нему сужается поиск для продолжений запроса. Если оно неизвестно (выдачу обрезал
+    лимит), запись годится только для повторной выдачи.
+    """
+
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # ключ -> (limit, результаты, frozenset id или None)
+        self.entries = OrderedDict()
+        # id пользователя -> (версия заметок, ключи его записей)
+        self.users = {}
+        self.hits = 0
+        self.narrowed = 0
+        self.misses = 0
+
+    def _user_keys(self, user_id, version):
+        # Записи, сделанные до изменения заметок, больше не нужны
+        user = self.users.get(user_id)
+        if user is None or user[0] != version:
+            if user is not None:
+                for key in user[1]:
+                    self.entries.pop(key, None)
+            user = self.users[user_id] = (version, set())
+        return user[1]
+
+    def get(self, user_id, query, strict, version, limit):
+        """Возвращает (результаты, None) при попадании или (None, кандидаты) при промахе.
+
+        Кандидаты — найденные заметки самого длинного закэшированного запроса, который
+        продолжает query (или самого query с меньшим limit), либо None, если такого нет.
+        """
+        query = normalize_query(query)
+        key = (user_id, query, strict, version)
+        with self.lock:
+            keys = self._user_keys(user_id, version)
+            entry = self.entries.get(key)
+            # Выдача с большим лимитом или полная выдача подходит и для меньшего лимита
+            if entry is not None and (entry[0] >= limit or len(entry[1]) < entry[0]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1][:limit], None
+
+            base = None
+            for base_key in keys:
+                _, base_query, base_strict, _ = base_key
+                if (base_strict == strict and self.entries[base_key][2] is not None
+                        and extends(query, base_query, strict)
+                        and (base is None or len(base_query) > len(base[1]))):
+                    base = base_key
+            if base is None:
+                self.misses += 1
+                return None, None
+
+            self.narrowed += 1
+            self.entries.move_to_end(base)
+            return None, self.entries[base][2]
+
+    def put(self, user_id, query, strict, version, limit, results, ids=None):
+        key = (user_id, normalize_query(query), strict, version)
+        with self.lock:
+            keys = self._user_keys(user_id, version)
+            self.entries[key] = (limit, results, frozenset(ids) if ids is not None else None)
+            self.entries.move_to_end(key)
+            keys.add(key)
+
+            while len(self.entries) > self.maxsize:
+                old_key, _ = self.entries.popitem(last=False)
+                user = self.users.get(old_key[0])
+                if user is not None:
+                    user[1].discard(old_key)
+                    if not user[1]:
+                        del self.users[old_key[0]]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.narrowed + self.misses
+            return {
+                'hits': self.hits,
+                'narrowed': self.narrowed,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self.entries),
+                'maxsize': self.maxsize
+            }
+
+search_cache = SearchCache()
@@ -0,0 +1,174 @@
+import atexit
+import heapq
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import db
+from edit_distance import WordBatch
+from search_index import (CONTENT_FIELD, TITLE_FIELD, fetch_note_terms, normalize_fragment, rank_notes,
+                          score_fields)
+
+# Число процессов поиска; 0 — искать только в процессе запроса
+SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS', str(os.cpu_count() or 1)))
+# С какого числа заметок поиск имеет смысл распараллеливать
+SEARCH_PARALLEL_MIN_NOTES = int(os.environ.get('SEARCH_PARALLEL_MIN_NOTES', '5000'))
+# Сколько заметок в одном куске
+SEARCH_CHUNK_SIZE = int(os.environ.get('SEARCH_CHUNK_SIZE', '2000'))
+# Сколько ждать куски, прежде чем вернуть то, что успели найти (миллисекунды)
+SEARCH_DEADLINE_MS = int(os.environ.get('SEARCH_DEADLINE_MS', '500'))
+# Сколько подготовленных кусков держит каждый процесс
+WORKER_CACHE_CHUNKS = 64
+
+class Chunk:
+    """Заметки из диапазона id, уже разбитые на слова, — живут в памяти процесса поиска"""
+
+    def __init__(self, rows):
+        self.updated = {}
+        # Нормализованные тексты: id -> (заголовок, текст) — для поиска подстроки
+        self.texts = {}
+        # слово -> {id заметки: битовая маска полей}
+        self.postings = {}
+        for note_id, title, content, updated_at in rows:
+            self.updated[note_id] = updated_at
+            self.texts[note_id] = (title, content)
+            for text, field in ((title, TITLE_FIELD), (content, CONTENT_FIELD)):
+                for word in set(text.split()):
+                    notes = self.postings.setdefault(word, {})
+                    notes[note_id] = notes.get(note_id, 0) | field
+        self.words = WordBatch(self.postings)
+
+    def score(self, query, threshold):
+        """Близость заметок куска к запросу по правилам fuzzy_search: (id, поле) -> оценка"""
+        query = normalize_fragment(query)
+        query_words = query.split()
+        fields = score_fields(self.words, self.postings, query_words, threshold) if query_words else {}
+
+        for note_id, (title, content) in self.texts.items():
+            # Запрос из одних пробелов подходит к любой заметке
+            if not query_words or query in title:
+                fields[(note_id, TITLE_FIELD)] = 1.0
+            if query_words and query in content:
+                fields[(note_id, CONTENT_FIELD)] = 1.0
+
+        return fields
+
+# Подготовленные куски текущего процесса поиска
+_chunks = OrderedDict()
+
+def load_chunk(path, user_id, version, first_id, last_id):
+    key = (path, user_id, version, first_id, last_id)
+    chunk = _chunks.get(key)
+    if chunk is not None:
+        _chunks.move_to_end(key)
+        return chunk
+
+    conn = db.connect(path)
+    try:
+        rows = fetch_note_terms(conn.cursor(), 'n.user_id = ? AND n.id BETWEEN ? AND ?',
+                                (user_id, first_id, last_id))
+    finally:
+        conn.close()
+
+    chunk = _chunks[key] = Chunk(rows)
+    while len(_chunks) > WORKER_CACHE_CHUNKS:
+        _chunks.popitem(last=False)
+    return chunk
+
+def search_chunk(path, user_id, version, first_id, last_id, query, threshold, limit):
+    """Выполняется в процессе поиска: лучшие limit заметок куска в виде (оценка, updated_at, id)"""
+    chunk = load_chunk(path, user_id, version, first_id, last_id)
+    ranked = rank_notes(chunk.score(query, threshold), chunk.updated, limit)
+    return [(score, chunk.updated[note_id] or '', note_id) for note_id, score in ranked]
+
+class SearchExecutor:
+    """Нечеткий поиск по большим аккаунтам в пуле процессов.
+
+    Заметки пользователя делятся на куски по id. Процессы сами читают свои куски
+    из базы и держат их разобранными на слова, поэтому в запросе передаются только
+    границы кусков и текст запроса.
+    """
+
+    def __init__(self, workers=SEARCH_WORKERS, chunk_size=SEARCH_CHUNK_SIZE):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        # (база, пользователь, версия заметок) -> (число заметок, границы кусков)
+        self.bounds = OrderedDict()
+
+    def _get_executor(self):
+        with self.lock:
+            # Пул, созданный до fork, дочернему процессу не принадлежит
+            if self.executor is None or self.pid != os.getpid():
+                # spawn: форкать многопоточный сервер небезопасно
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.pid = os.getpid()
+            return self.executor
+
+    def chunk_bounds(self, conn, user_id, version):
+        """Число заметок и границы кусков [(первый id, последний id)] для текущей версии заметок"""
+        key = (conn.path, user_id, version)
+        with self.lock:
+            entry = self.bounds.get(key)
+            if entry is not None:
+                self.bounds.move_to_end(key)
+                return entry
+
+        ids = [row[0] for row in conn.execute('SELECT id FROM notes WHERE user_id = ? ORDER BY id', (user_id,))]
+        bounds = [(ids[i], ids[min(i + self.chunk_size, len(ids)) - 1])
+                  for i in range(0, len(ids), self.chunk_size)]
+
+        with self.lock:
+            entry = self.bounds[key] = (len(ids), bounds)
+            while len(self.bounds) > WORKER_CACHE_CHUNKS:
+                self.bounds.popitem(last=False)
+        return entry
+
+    def should_parallelize(self, conn, user_id, version):
+        if self.workers <= 0:
+            return False
+        count, bounds = self.chunk_bounds(conn, user_id, version)
+        return len(bounds) > 1 and count >= SEARCH_PARALLEL_MIN_NOTES
+
+    def search(self, conn, user_id, version, query, limit, threshold=3, deadline_ms=SEARCH_DEADLINE_MS):
+        """Возвращает ([(id, score)] от лучших к худшим, truncated).
+
+        truncated означает, что часть кусков не успела к сроку и результат неполный.
+        """
+        executor = self._get_executor()
+        # Процессы читают ту же базу, что и запрос: каталог или шард пользователя
+        path = conn.path
+        futures = {executor.submit(search_chunk, path, user_id, version, first_id, last_id, query, threshold, limit)
+                   for first_id, last_id in self.chunk_bounds(conn, user_id, version)[1]}
+
+        deadline = time.monotonic() + deadline_ms / 1000
+        found = []
+        pending = futures
+        while pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                found.extend(future.result())
+
+        # Начатые куски доработают и останутся в кэше процессов, остальные отменяем
+        for future in pending:
+            future.cancel()
+
+        top = heapq.nlargest(limit, found)
+        return [(note_id, score) for score, _, note_id in top], bool(pending)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+search_executor = SearchExecutor()
+atexit.register(search_executor.shutdown)
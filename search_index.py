@@ -0,0 +1,302 @@
+import datetime
+import heapq
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from edit_distance import WordBatch, bounded_levenshtein, np
+from instrumentation import FUZZY_WORDS_COMPARED, LEVENSHTEIN_CALLS
+from note_bodies import load_bodies
+
+# Когда «мёртвых» слов в хранилище становится больше живых, оно перестраивается
+WORD_STORE_MIN_REBUILD = 1000
+# Для скольких пользователей процесс держит словари нечеткого поиска
+SEARCH_INDEX_USERS = int(os.environ.get('SEARCH_INDEX_USERS', '1000'))
+
+TITLE_FIELD = 1
+CONTENT_FIELD = 2
+
+# Веса при ранжировании: совпадение в заголовке важнее, чем в тексте
+TITLE_WEIGHT = 1.0
+CONTENT_WEIGHT = 0.8
+# Доля свежести в итоговой оценке и срок, за который её вклад падает вдвое (дни)
+RECENCY_WEIGHT = 0.2
+RECENCY_HALF_LIFE_DAYS = 30
+
+def normalize_text(text):
+    """Текст в том виде, в каком по нему ищут: NFKC, casefold и слова через один пробел"""
+    return ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+
+def normalize_fragment(fragment):
+    """Запрос для поиска подстроки в normalize_text: пробелы по краям — граница слова, их оставляем"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', fragment).casefold())
+
+def save_note_terms(c, notes):
+    """Сохраняет нормализованные заголовок и текст заметок [(id, заголовок, текст)] в note_terms"""
+    # UPSERT, а не REPLACE: замена строки не вызывает триггер удаления, и полнотекстовый индекс разошёлся бы
+    c.executemany('''
+        INSERT INTO note_terms (note_id, title, content) VALUES (?, ?, ?)
+        ON CONFLICT (note_id) DO UPDATE SET title = excluded.title, content = excluded.content
+    ''', [(note_id, normalize_text(title), normalize_text(content)) for note_id, title, content in notes])
+
+def fetch_note_terms(c, condition, params=()):
+    """Нормализованные заметки [(id, заголовок, текст, updated_at)], подходящие под условие над notes n.
+
+    Текст заметок не читается. Заметки без сохранённой формы (записанные в обход
+    приложения или ещё не перенесённые migrate_terms.py) нормализуются на лету.
+    """
+    c.execute(f'''
+        SELECT n.id, t.title, t.content, n.updated_at
+        FROM notes n
+        LEFT JOIN note_terms t ON t.note_id = n.id
+        WHERE {condition}
+    ''', params)
+    rows = c.fetchall()
+    missing = [row[0] for row in rows if row[1] is None]
+    if not missing:
+        return rows
+
+    c.execute('SELECT id, title FROM notes WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(missing),))
+    titles = dict(c.fetchall())
+    bodies = load_bodies(c, list(titles))
+    texts = {note_id: (normalize_text(title), normalize_text(bodies.get(note_id, '')))
+             for note_id, title in titles.items()}
+    return [row if row[1] is not None else (row[0],) + texts[row[0]] + (row[3],)
+            for row in rows if row[1] is not None or row[0] in texts]
+
+def score_fields(store, postings, query_words, threshold, allowed=None):
+    """Близость заметок к запросу по полям: (заметка, поле) -> оценка от 0 до 1.
+
+    Поле подходит, если для каждого слова запроса в нём есть слово не дальше threshold;
+    оценка — средняя близость этих слов, как в rank_matches.
+    """
+    fields = None
+    for query_word in query_words:
+        best = {}
+        for word, distance in store.search(query_word, threshold):
+            notes = postings.get(word)
+            if notes is None:
+                continue
+            weight = 1 - distance / (threshold + 1)
+            for note, mask in notes.items():
+                if allowed is not None and note not in allowed:
+                    continue
+                for field in (TITLE_FIELD, CONTENT_FIELD):
+                    if mask & field and best.get((note, field), -1) < weight:
+                        best[(note, field)] = weight
+
+        if fields is None:
+            fields = best
+        else:
+            fields = {key: fields[key] + weight for key, weight in best.items() if key in fields}
+        if not fields:
+            return {}
+
+    return {key: total / len(query_words) for key, total in (fields or {}).items()}
+
+def note_score(title_score, content_score, updated_at, now):
+    """Итоговая оценка заметки: лучшее из полей с учётом их веса плюс свежесть"""
+    relevance = max(title_score * TITLE_WEIGHT, content_score * CONTENT_WEIGHT)
+    try:
+        age = (now - datetime.datetime.fromisoformat(updated_at)).total_seconds() / 86400
+    except (TypeError, ValueError):
+        return relevance * (1 - RECENCY_WEIGHT)
+    recency = 0.5 ** (max(age, 0) / RECENCY_HALF_LIFE_DAYS)
+    return relevance * (1 - RECENCY_WEIGHT) + recency * RECENCY_WEIGHT
+
+def rank_notes(field_scores, updated, limit):
+    """Лучшие limit заметок в виде [(id, оценка)] — выбор кучей, без полной сортировки"""
+    now = datetime.datetime.now()
+    notes = {}
+    for (note, field), score in field_scores.items():
+        scores = notes.setdefault(note, [0.0, 0.0])
+        scores[field - 1] = max(scores[field - 1], score)
+    return heapq.nlargest(limit, ((note, note_score(title, content, updated.get(note), now))
+                                  for note, (title, content) in notes.items()),
+                          key=lambda item: (item[1], updated.get(item[0]) or '', item[0]))
+
+class BKTree:
+    """BK-дерево слов для поиска кандидатов в пределах заданного расстояния"""
+
+    def __init__(self, words=()):
+        self.root = None
+        self.size = 0
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = [word, {}]
+            self.size = 1
+            return
+
+        node = self.root
+        while True:
+            distance = bounded_levenshtein(word, node[0], max(len(word), len(node[0])))
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [word, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word, threshold):
+        """Возвращает пары (слово, расстояние) для всех слов не дальше threshold"""
+        if self.root is None:
+            return []
+
+        results = []
+        calls = 0
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            # Дальше этого предела ни одна ветка уже не подойдёт
+            limit = threshold + (max(children) if children else 0)
+            distance = bounded_levenshtein(word, node_word, limit)
+            calls += 1
+            if distance <= threshold:
+                results.append((node_word, distance))
+            if distance > limit:
+                continue
+            for key, child in children.items():
+                if distance - threshold <= key <= distance + threshold:
+                    stack.append(child)
+
+        FUZZY_WORDS_COMPARED.inc(calls)
+        LEVENSHTEIN_CALLS.inc(calls)
+        return results
+
+def new_word_store(words=()):
+    """Хранилище слов словаря: с NumPy — пакетный подсчёт расстояний, без него — BK-дерево"""
+    if np is not None:
+        return WordBatch(words)
+    return BKTree(words)
+
+class VocabularyIndex:
+    """Словарь заметок одного пользователя: слово -> заметки и поля, где оно встречается"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.store = new_word_store()
+        # слово -> {id заметки: битовая маска полей}
+        self.postings = {}
+        # id заметки -> (слова заголовка, слова текста)
+        self.note_words = {}
+        # id заметки -> updated_at, для учёта свежести при ранжировании
+        self.updated = {}
+        # Версия заметок пользователя, до которой словарь уже доведён
+        self.version = None
+
+    def add_note(self, note_id, title, content, updated_at=None):
+        """Добавляет заметку по нормализованным заголовку и тексту (см. normalize_text)"""
+        with self.lock:
+            self.remove_note(note_id)
+            self.updated[note_id] = updated_at
+            title_words = frozenset(title.split())
+            content_words = frozenset(content.split())
+            self.note_words[note_id] = (title_words, content_words)
+
+            for words, field in ((title_words, TITLE_FIELD), (content_words, CONTENT_FIELD)):
+                for word in words:
+                    notes = self.postings.get(word)
+                    if notes is None:
+                        notes = self.postings[word] = {}
+                        self.store.add(word)
+                    notes[note_id] = notes.get(note_id, 0) | field
+
+    def remove_note(self, note_id):
+        with self.lock:
+            words = self.note_words.pop(note_id, None)
+            self.updated.pop(note_id, None)
+            if words is None:
+                return
+
+            for word in words[0] | words[1]:
+                notes = self.postings.get(word)
+                if notes is None:
+                    continue
+                notes.pop(note_id, None)
+                if not notes:
+                    del self.postings[word]
+
+            # Из хранилища слова не удаляются, поэтому периодически строим его заново
+            dead_words = self.store.size - len(self.postings)
+            if dead_words > max(WORD_STORE_MIN_REBUILD, len(self.postings)):
+                self.store = new_word_store(self.postings)
+
+    def sync(self, conn, user_id):
+        """Применяет изменения заметок, сделанные после последней синхронизации"""
+        with self.lock:
+            c = conn.cursor()
+            c.execute('SELECT notes_version FROM note_versions WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
+            version = row[0] if row else 0
+            if version == self.version:
+                return
+
+            if self.version is None:
+                self.store = new_word_store()
+                self.postings = {}
+                self.note_words = {}
+                self.updated = {}
+                rows = fetch_note_terms(c, 'n.user_id = ?', (user_id,))
+            else:
+                c.execute('SELECT note_id FROM note_tombstones WHERE user_id = ? AND version > ?',
+                          (user_id, self.version))
+                for (note_id,) in c.fetchall():
+                    self.remove_note(note_id)
+                rows = fetch_note_terms(c, 'n.user_id = ? AND n.version > ?', (user_id, self.version))
+
+            for note_id, title, content, updated_at in rows:
+                self.add_note(note_id, title, content, updated_at)
+            self.version = version
+
+    def score_notes(self, query, threshold=3, candidates=None):
+        """Близость заметок к запросу по словам: (id заметки, поле) -> оценка.
+
+        Если передано множество candidates, проверяются только эти заметки.
+        """
+        query_words = normalize_text(query).split()
+
+        with self.lock:
+            # Как и в fuzzy_search, запрос без слов подходит к любой заметке
+            if not query_words:
+                return {(note_id, TITLE_FIELD): 1.0 for note_id in self.note_words
+                        if candidates is None or note_id in candidates}
+            return score_fields(self.store, self.postings, query_words, threshold, candidates)
+
+    def substring_notes(self, fragment):
+        """Заметки, в словах которых встречается фрагмент без пробелов: id -> битовая маска полей"""
+        fragment = normalize_fragment(fragment)
+        with self.lock:
+            masks = {}
+            for word, notes in self.postings.items():
+                if fragment in word:
+                    for note_id, field in notes.items():
+                        masks[note_id] = masks.get(note_id, 0) | field
+            return masks
+
+# Индексы живут в памяти процесса и догоняют базу по счётчику изменений note_versions.notes_version,
+# поэтому остаются верными и тогда, когда заметки меняет другой процесс.
+# Хранятся индексы последних пользователей; вытесненный индекс соберётся заново при следующем поиске
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+def get_index(conn, user_id):
+    """Возвращает словарь пользователя, синхронизированный с текущей версией заметок"""
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is None:
+            index = _indexes[user_id] = VocabularyIndex()
+            while len(_indexes) > SEARCH_INDEX_USERS:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(user_id)
+
+    index.sync(conn, user_id)
+    return index
@@ -0,0 +1,116 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+# Адрес сервера и число рабочих процессов
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '5000'))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', str(os.cpu_count() or 1)))
+# Сколько ждать завершения рабочих процессов при остановке (секунды)
+SHUTDOWN_TIMEOUT = 30
+# Пауза перед перезапуском упавшего рабочего процесса (секунды)
+RESTART_DELAY = 1
+# Сигналы, которые обрабатывает мастер
+SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGALRM)
+
+logger = logging.getLogger('notes.server')
+
+def listen(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def exit_worker(signum, frame):
+    sys.exit(0)
+
+def run_worker(app, sock):
+    import uvicorn
+
+    # Остановку по SIGTERM/SIGINT обрабатывает сам uvicorn: дожидается запросов и lifespan,
+    # а затем повторяет сигнал — с этим обработчиком процесс завершается обычным образом
+    signal.signal(signal.SIGTERM, exit_worker)
+    signal.signal(signal.SIGINT, exit_worker)
+    uvicorn.Server(uvicorn.Config(app, lifespan='on')).run(sockets=[sock])
+
+def spawn(app, sock):
+    # Пока обработчики мастера не сброшены, сигнал в дочернем процессе остановил бы соседей
+    signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+    pid = os.fork()
+    if pid:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+        return pid
+    for signum in SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+    code = 0
+    try:
+        run_worker(app, sock)
+    except Exception:
+        logger.exception('worker failed')
+        code = 1
+    # sys.exit, а не os._exit: atexit записывает отложенные автосохранения
+    sys.exit(code)
+
+def main():
+    """Мастер-процесс: импортирует приложение и форкает рабочие процессы.
+
+    Модули, приложение и миграции схемы загружаются один раз до fork, поэтому
+    рабочие процессы стартуют сразу и делят эти страницы памяти с мастером
+    (copy-on-write). Мастер сам запросы не обслуживает: он перезапускает упавшие
+    рабочие процессы и останавливает их по SIGTERM.
+    """
+    # Очередь автосохранений общая для рабочих процессов (autosave.db), поэтому групповая
+    # запись работает и тогда, когда запросы пользователя попадают в разные процессы
+    if SERVER_WORKERS > 1:
+        # Пул процессов поиска свой у каждого рабочего процесса: делим ядра между ними,
+        # иначе процессов поиска было бы по числу ядер в квадрате
+        os.environ.setdefault('SEARCH_WORKERS', str(max(1, (os.cpu_count() or 1) // SERVER_WORKERS)))
+    # Приложение импортируется здесь, а не при импорте модуля: процессы поиска
+    # (spawn) заново импортируют главный модуль
+    import asgi
+
+    sock = listen(SERVER_HOST, SERVER_PORT)
+    # Объекты, созданные при импорте, сборщик мусора больше не обходит —
+    # иначе он записывал бы в их заголовки и страницы копировались бы в каждый процесс
+    gc.freeze()
+
+    workers = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        signal.alarm(SHUTDOWN_TIMEOUT)
+
+    def kill(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGKILL)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, kill)
+
+    for _ in range(SERVER_WORKERS):
+        workers.add(spawn(asgi.app, sock))
+    logger.info('server started', extra={'address': f'{SERVER_HOST}:{SERVER_PORT}', 'workers': SERVER_WORKERS})
+
+    while workers:
+        pid, status = os.wait()
+        workers.discard(pid)
+        if stopping:
+            continue
+        logger.warning('worker exited', extra={'pid': pid, 'code': os.waitstatus_to_exitcode(status)})
+        time.sleep(RESTART_DELAY)
+        workers.add(spawn(asgi.app, sock))
+
+if __name__ == '__main__':
+    main()